@@ -46,6 +46,12 @@ def get_info():
     """Returns package information"""
     return _get_pkg_info(os.path.dirname(__file__))
 
-from .pipeline import Node, MapNode, JoinNode, Workflow
-from .interfaces import (DataGrabber, DataSink, SelectFiles,
-                         IdentityInterface, Rename, Function, Select, Merge)
+# the pipeline and interfaces are imported on first use, see nipype.utils.lazy
+from .utils.lazy import lazy_attributes
+lazy_attributes(__name__, dict(
+    pipeline='.pipeline', interfaces='.interfaces',
+    Node='.pipeline', MapNode='.pipeline', JoinNode='.pipeline',
+    Workflow='.pipeline', DataGrabber='.interfaces', DataSink='.interfaces',
+    SelectFiles='.interfaces', IdentityInterface='.interfaces',
+    Rename='.interfaces', Function='.interfaces', Select='.interfaces',
+    Merge='.interfaces'))
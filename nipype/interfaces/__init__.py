@@ -9,5 +9,8 @@ Requires Packages to be installed
 from __future__ import print_function, division, unicode_literals, absolute_import
 __docformat__ = 'restructuredtext'
 
-from .io import DataGrabber, DataSink, SelectFiles
-from .utility import IdentityInterface, Rename, Function, Select, Merge
+from ..utils.lazy import lazy_attributes
+lazy_attributes(__name__, dict(
+    DataGrabber='.io', DataSink='.io', SelectFiles='.io',
+    IdentityInterface='.utility', Rename='.utility', Function='.utility',
+    Select='.utility', Merge='.utility'))
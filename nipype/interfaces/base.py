@@ -14,6 +14,7 @@ import gc
 from builtins import range, object, open, str, bytes
 
 from copy import deepcopy
+from multiprocessing.pool import ThreadPool
 import datetime
 from datetime import datetime as dt
 import errno
@@ -33,10 +34,10 @@ from packaging.version import Version
 import collections
 
 from .. import config, logging, LooseVersion, __version__
-from ..utils.provenance import write_provenance
 from ..utils.misc import is_container, trim, str2bool
 from ..utils.filemanip import (md5, hash_infile, FileNotFoundError, hash_timestamp,
-                               split_filename, to_str, read_stream)
+                               split_filename, to_str, read_stream,
+                               get_hash_algorithm)
 from .traits_extension import (
     traits, Undefined, TraitDictObject, TraitListObject, TraitError, isdefined,
     File, Directory, DictStrStr, has_metadata, ImageFile)
@@ -470,7 +471,7 @@ class BaseTraitedSpec(traits.HasTraits):
                     hash = hash_timestamp(afile)
                 elif config.get('execution',
                                 'hash_method').lower() == 'content':
-                    hash = hash_infile(afile)
+                    hash = hash_infile(afile, crypto=get_hash_algorithm())
                 else:
                     raise Exception("Unknown hash method: %s" %
                                     config.get('execution', 'hash_method'))
@@ -538,12 +539,15 @@ class BaseTraitedSpec(traits.HasTraits):
         return has_metadata(self.trait(name).trait_type, metadata, value,
                             recursive)
 
-    def get_hashval(self, hash_method=None):
+    def get_hashval(self, hash_method=None, hash_algorithm=None,
+                    hash_threads=None):
         """Return a dictionary of our items with hashes for each file.
 
         Searches through dictionary items and if an item is a file, it
-        calculates the md5 hash of the file contents and stores the
-        file name and hash value as the new key value.
+        calculates the hash of the file contents (with ``hash_algorithm``,
+        see :func:`~nipype.utils.filemanip.get_hash_algorithm`) and stores
+        the file name and hash value as the new key value. The files are
+        hashed by ``hash_threads`` threads.
 
         However, the overall bunch hash is calculated only on the hash
         value of a file. The path and name of the file are not used in
@@ -559,8 +563,7 @@ class BaseTraitedSpec(traits.HasTraits):
 
         """
 
-        dict_withhash = []
-        dict_nofilename = []
+        hashable = []
         for name, val in sorted(self.get().items()):
             if not isdefined(val) or self.has_metadata(name, "nohash", True):
                 # skip undefined traits and traits with nohash=True
@@ -568,16 +571,75 @@ class BaseTraitedSpec(traits.HasTraits):
 
             hash_files = (not self.has_metadata(name, "hash_files", False) and not
                           self.has_metadata(name, "name_source"))
+            hashable.append((name, val, hash_files))
+
+        # Hash all the files once, before building the sorted dictionaries
+        file_hashes = self._hash_files(
+            [val for _, val, hash_files in hashable if hash_files],
+            hash_method=hash_method, hash_algorithm=hash_algorithm,
+            hash_threads=hash_threads)
+
+        dict_withhash = []
+        dict_nofilename = []
+        for name, val, hash_files in hashable:
             dict_nofilename.append((name,
                                     self._get_sorteddict(val, hash_method=hash_method,
-                                                         hash_files=hash_files)))
+                                                         hash_files=hash_files,
+                                                         hash_algorithm=hash_algorithm,
+                                                         file_hashes=file_hashes)))
             dict_withhash.append((name,
                                   self._get_sorteddict(val, True, hash_method=hash_method,
-                                                       hash_files=hash_files)))
+                                                       hash_files=hash_files,
+                                                       hash_algorithm=hash_algorithm,
+                                                       file_hashes=file_hashes)))
         return dict_withhash, md5(to_str(dict_nofilename).encode()).hexdigest()
 
+    def _hash_files(self, values, hash_method=None, hash_algorithm=None,
+                    hash_threads=None):
+        """Hash the files found in ``values``
+
+        Returns a dictionary mapping each string in ``values`` (searched
+        recursively) to the hash of the file it points to, or ``None`` if it
+        is not a file. The files are hashed by a pool of ``hash_threads``
+        threads (by default, the ``hash_threads`` option of the ``execution``
+        configuration section), in which case the order of the files and the
+        hashes are the same as in a serial run.
+        """
+        paths = []
+
+        def _collect(objekt):
+            if isinstance(objekt, dict):
+                objekt = [val for _, val in sorted(objekt.items())]
+            if isinstance(objekt, (list, tuple)):
+                for val in objekt:
+                    if isdefined(val):
+                        _collect(val)
+            elif isinstance(objekt, (str, bytes)):
+                paths.append(objekt)
+        _collect(values)
+        # Unique paths, in order of appearance
+        paths = list(collections.OrderedDict.fromkeys(paths))
+
+        def _hash(path):
+            if not os.path.isfile(path):
+                return None
+            return _hash_file(path, hash_method, hash_algorithm)
+
+        if hash_threads is None:
+            hash_threads = config.get('execution', 'hash_threads', 1)
+        nthreads = min(int(hash_threads), len(paths))
+        if nthreads > 1:
+            pool = ThreadPool(nthreads)
+            try:
+                hashes = pool.map(_hash, paths, chunksize=1)
+            finally:
+                pool.close()
+        else:
+            hashes = [_hash(path) for path in paths]
+        return dict(zip(paths, hashes))
+
     def _get_sorteddict(self, objekt, dictwithhash=False, hash_method=None,
-                        hash_files=True):
+                        hash_files=True, hash_algorithm=None, file_hashes=None):
         if isinstance(objekt, dict):
             out = []
             for key, val in sorted(objekt.items()):
@@ -585,29 +647,29 @@ class BaseTraitedSpec(traits.HasTraits):
                     out.append((key,
                                 self._get_sorteddict(val, dictwithhash,
                                                      hash_method=hash_method,
-                                                     hash_files=hash_files)))
+                                                     hash_files=hash_files,
+                                                     hash_algorithm=hash_algorithm,
+                                                     file_hashes=file_hashes)))
         elif isinstance(objekt, (list, tuple)):
             out = []
             for val in objekt:
                 if isdefined(val):
                     out.append(self._get_sorteddict(val, dictwithhash,
                                                     hash_method=hash_method,
-                                                    hash_files=hash_files))
+                                                    hash_files=hash_files,
+                                                    hash_algorithm=hash_algorithm,
+                                                    file_hashes=file_hashes))
             if isinstance(objekt, tuple):
                 out = tuple(out)
         else:
             if isdefined(objekt):
-                if (hash_files and isinstance(objekt, (str, bytes)) and
-                        os.path.isfile(objekt)):
-                    if hash_method is None:
-                        hash_method = config.get('execution', 'hash_method')
-
-                    if hash_method.lower() == 'timestamp':
-                        hash = hash_timestamp(objekt)
-                    elif hash_method.lower() == 'content':
-                        hash = hash_infile(objekt)
-                    else:
-                        raise Exception("Unknown hash method: %s" % hash_method)
+                hash = None
+                if hash_files and isinstance(objekt, (str, bytes)):
+                    if file_hashes is not None and objekt in file_hashes:
+                        hash = file_hashes[objekt]
+                    elif os.path.isfile(objekt):
+                        hash = _hash_file(objekt, hash_method, hash_algorithm)
+                if hash is not None:
                     if dictwithhash:
                         out = (objekt, hash)
                     else:
@@ -619,6 +681,18 @@ class BaseTraitedSpec(traits.HasTraits):
         return out
 
 
+def _hash_file(afile, hash_method=None, hash_algorithm=None):
+    """Hash a file with the given method (``timestamp`` or ``content``)"""
+    if hash_method is None:
+        hash_method = config.get('execution', 'hash_method')
+
+    if hash_method.lower() == 'timestamp':
+        return hash_timestamp(afile)
+    elif hash_method.lower() == 'content':
+        return hash_infile(afile, crypto=get_hash_algorithm(hash_algorithm))
+    raise Exception("Unknown hash method: %s" % hash_method)
+
+
 class DynamicTraitedSpec(BaseTraitedSpec):
     """ A subclass to handle dynamic traits
 
@@ -1114,6 +1188,8 @@ class BaseInterface(Interface):
 
             # Add provenance (if required)
             if store_provenance:
+                # prov is only imported when provenance is tracked
+                from ..utils.provenance import write_provenance
                 # Provenance will only throw a warning if something went wrong
                 results.provenance = write_provenance(results)
 
@@ -27,16 +27,21 @@ import string
 import os
 import os.path as op
 import shutil
+import stat
 import subprocess
 import re
 import tempfile
+from collections import OrderedDict
 from warnings import warn
 
 import sqlite3
 
 from .. import config, logging
-from ..utils.filemanip import copyfile, list_to_filename, filename_to_list
-from ..utils.misc import human_order_sorted, str2bool
+from ..utils.filemanip import (copyfile, list_to_filename,
+                               filename_to_list, split_filename,
+                               get_directory_index)
+from ..utils.misc import (human_order_sorted, human_order_argsort,
+                          str2bool)
 from .base import (
     TraitedSpec, traits, Str, File, Directory, BaseInterface, InputMultiPath,
     isdefined, OutputMultiPath, DynamicTraitedSpec, Undefined, BaseInterfaceInputSpec)
@@ -96,6 +101,15 @@ def copytree(src, dst, use_hardlink=False):
         raise Exception(errors)
 
 
+def _glob(pathname):
+    """:func:`glob.glob`, answered by the directory index if enabled (see
+    :func:`nipype.utils.filemanip.get_directory_index`)"""
+    index = get_directory_index()
+    if index is None:
+        return glob.glob(pathname)
+    return index.glob(pathname)
+
+
 def add_traits(base, names, trait_type=None):
     """ Add traits to a traited class.
 
@@ -171,6 +185,36 @@ class ProgressPercentage(object):
             sys.stdout.flush()
 
 
+def s3_etag(filename, part_size=None, blocksize=1024 ** 2):
+    """The ETag of a file once uploaded to S3
+
+    Objects uploaded in a single part have the MD5 of their content as ETag.
+    Objects uploaded in parts of ``part_size`` bytes have the MD5 of the
+    concatenated MD5s of the parts, followed by ``-<number of parts>``. The
+    file is read in blocks, never as a whole.
+    """
+    import hashlib
+
+    def _md5(fp, size):
+        md5 = hashlib.md5()
+        while size is None or size > 0:
+            data = fp.read(blocksize if size is None else min(blocksize, size))
+            if not data:
+                break
+            md5.update(data)
+            if size is not None:
+                size -= len(data)
+        return md5
+
+    with open(filename, 'rb') as fp:
+        if part_size is None:
+            return _md5(fp, None).hexdigest()
+        nparts = max(1, -(-os.path.getsize(filename) // part_size))
+        digests = b''.join(_md5(fp, part_size).digest()
+                           for _ in range(nparts))
+    return '%s-%d' % (hashlib.md5(digests).hexdigest(), nparts)
+
+
 # DataSink inputs
 class DataSinkInputSpec(DynamicTraitedSpec, BaseInterfaceInputSpec):
     '''
@@ -209,6 +253,16 @@ class DataSinkInputSpec(DynamicTraitedSpec, BaseInterfaceInputSpec):
     bucket = traits.Any(desc='Boto3 S3 bucket for manual override of bucket')
     # Set this if user wishes to have local copy of files as well
     local_copy = Str(desc='Copy files locally as well as to S3 bucket')
+    copy_threads = traits.Int(
+        1, usedefault=True,
+        desc='Number of files copied concurrently to the local directory')
+    s3_upload_threads = traits.Int(
+        1, usedefault=True,
+        desc='Number of files uploaded to the S3 bucket concurrently')
+    s3_part_size = traits.Int(
+        8 * 1024 ** 2, usedefault=True,
+        desc='Size (in bytes) of the parts of the multipart uploads to S3; '
+             'files at least as large are uploaded in parts')
 
     # Set call-able inputs attributes
     def __setattr__(self, key, value):
@@ -343,23 +397,45 @@ class DataSink(IOBase):
             dst = dst[1:]
         return dst
 
+    # Compile the substitutions
+    def _get_substitutions(self):
+        """The substitutions as (pattern, compiled regexp or None, replacement)
+        steps, compiled once as long as the inputs do not change, and the
+        memo of the substituted paths"""
+        substitutions = ()
+        if isdefined(self.inputs.substitutions):
+            substitutions = tuple(self.inputs.substitutions)
+        regexp_substitutions = ()
+        if isdefined(self.inputs.regexp_substitutions):
+            regexp_substitutions = tuple(self.inputs.regexp_substitutions)
+        inputs = (substitutions, regexp_substitutions)
+        if getattr(self, '_substitutions', (None, ))[0] != inputs:
+            steps = ([(key, None, val) for key, val in substitutions] +
+                     [(key, re.compile(key), val)
+                      for key, val in regexp_substitutions])
+            self._substitutions = (inputs, steps, {})
+        return self._substitutions[1:]
+
     # Substitute paths in substitutions dictionary parameter
     def _substitute(self, pathstr):
+        steps, memo = self._get_substitutions()
         pathstr_ = pathstr
-        if isdefined(self.inputs.substitutions):
-            for key, val in self.inputs.substitutions:
-                oldpathstr = pathstr
-                pathstr = pathstr.replace(key, val)
-                if pathstr != oldpathstr:
-                    iflogger.debug('sub.str: %s -> %s using %r -> %r',
-                                   oldpathstr, pathstr, key, val)
-        if isdefined(self.inputs.regexp_substitutions):
-            for key, val in self.inputs.regexp_substitutions:
+        if pathstr_ in memo:
+            pathstr = memo[pathstr_]
+        else:
+            for key, regexp, val in steps:
                 oldpathstr = pathstr
-                pathstr, _ = re.subn(key, val, pathstr)
+                if regexp is None:
+                    pathstr = pathstr.replace(key, val)
+                # parsing a replacement template with backreferences costs
+                # more than searching the (rarely matching) pattern
+                elif '\\' not in val or regexp.search(pathstr):
+                    pathstr = regexp.sub(val, pathstr)
                 if pathstr != oldpathstr:
-                    iflogger.debug('sub.regexp: %s -> %s using %r -> %r',
+                    iflogger.debug('sub.%s: %s -> %s using %r -> %r',
+                                   'str' if regexp is None else 'regexp',
                                    oldpathstr, pathstr, key, val)
+            memo[pathstr_] = pathstr
         if pathstr_ != pathstr:
             iflogger.info('sub: %s -> %s', pathstr_, pathstr)
         return pathstr
@@ -563,16 +639,19 @@ class DataSink(IOBase):
         '''
         Method to upload outputs to S3 bucket instead of on local disk
         '''
+        self._upload_files_to_s3(bucket, self._s3_uploads(bucket, src, dst))
+
+    # List the files to upload to S3
+    def _s3_uploads(self, bucket, src, dst):
+        '''
+        Method to list the (source file, destination key) pairs of an
+        output uploaded to S3, expanding directories
+        '''
 
         # Import packages
-        import hashlib
-        import logging
         import os
 
-        from botocore.exceptions import ClientError
-
         # Init variables
-        iflogger = logging.getLogger('interface')
         s3_str = 's3://'
         s3_prefix = s3_str + bucket.name
 
@@ -594,39 +673,180 @@ class DataSink(IOBase):
             src_files = [src]
             dst_files = [dst]
 
-        # Iterate over src and copy to dst
-        for src_idx, src_f in enumerate(src_files):
-            # Get destination filename/keyname
-            dst_f = dst_files[src_idx]
-            dst_k = dst_f.replace(s3_prefix, '').lstrip('/')
+        return [(src_f, dst_f.replace(s3_prefix, '').lstrip('/'))
+                for src_f, dst_f in zip(src_files, dst_files)]
 
-            # See if same file is already up there
+    # List the objects already in S3
+    def _list_s3_objects(self, bucket, keys):
+        '''
+        Method to return the {key: (ETag, size)} of the existing objects
+        of the S3 folders of the given keys, with a single listing request
+        (per thousand objects) per folder instead of one request per key
+        '''
+
+        # Import packages
+        import logging
+        import posixpath
+
+        from botocore.exceptions import ClientError
+
+        # Init variables
+        iflogger = logging.getLogger('interface')
+
+        folders = {}
+        for key in keys:
+            folders.setdefault(posixpath.dirname(key), []).append(key)
+        objects = {}
+        for folder in sorted(folders):
+            prefix = folder + '/' if folder else ''
             try:
-                dst_obj = bucket.Object(key=dst_k)
-                dst_md5 = dst_obj.e_tag.strip('"')
-
-                # See if same file is already there
-                src_read = open(src_f, 'rb').read()
-                src_md5 = hashlib.md5(src_read).hexdigest()
-                # Move to next loop iteration
-                if dst_md5 == src_md5:
-                    iflogger.info('File %s already exists on S3, skipping...', dst_f)
-                    continue
-                else:
-                    iflogger.info('Overwriting previous S3 file...')
+                for obj in bucket.objects.filter(Prefix=prefix,
+                                                 Delimiter='/'):
+                    objects[obj.key] = (obj.e_tag.strip('"'), obj.size)
+                continue
+            except ClientError as exc:
+                # e.g. write-only credentials, without s3:ListBucket
+                iflogger.debug('Could not list s3://%s/%s: %s', bucket.name,
+                               prefix, exc)
+            # Look the keys up one by one, and upload those not found
+            for key in folders[folder]:
+                try:
+                    obj = bucket.Object(key)
+                    objects[key] = (obj.e_tag.strip('"'), obj.content_length)
+                except ClientError:
+                    pass
+        return objects
+
+    # Check whether a file is the same as an S3 object
+    def _same_as_s3_object(self, src_f, etag, size):
+        '''
+        Method to compare a file with the ETag and size of an S3 object,
+        without reading the file when the sizes differ
+        '''
 
-            except ClientError:
+        # Import packages
+        import os
+
+        if os.path.getsize(src_f) != size:
+            return False
+        if '-' not in etag:
+            return s3_etag(src_f) == etag
+        # Multipart upload, with a part size which is not recorded: try
+        # ours, then the smallest whole number of MiB giving that many parts
+        nparts = int(etag.split('-')[1])
+        mib = 1024 ** 2
+        part_sizes = [self.inputs.s3_part_size,
+                      mib * max(1, -(-size // (nparts * mib)))]
+        for part_size in part_sizes:
+            if max(1, -(-size // part_size)) == nparts and \
+                    s3_etag(src_f, part_size) == etag:
+                return True
+        return False
+
+    # Upload files to S3
+    def _upload_files_to_s3(self, bucket, uploads):
+        '''
+        Method to upload a list of (source file, destination key) pairs to
+        an S3 bucket, skipping the files already there. Up to
+        s3_upload_threads files are uploaded at once.
+        '''
+
+        # Import packages
+        import logging
+        from multiprocessing.pool import ThreadPool
+
+        from boto3.s3.transfer import TransferConfig
+
+        # Init variables
+        iflogger = logging.getLogger('interface')
+        existing = self._list_s3_objects(bucket, [key for _, key in uploads])
+        part_size = self.inputs.s3_part_size
+        transfer_config = TransferConfig(multipart_threshold=part_size,
+                                         multipart_chunksize=part_size)
+        if self.inputs.encrypt_bucket_keys:
+            extra_args = {'ServerSideEncryption' : 'AES256'}
+        else:
+            extra_args = {}
+
+        def _upload(upload):
+            src_f, dst_k = upload
+            # See if same file is already up there
+            if dst_k in existing:
+                if self._same_as_s3_object(src_f, *existing[dst_k]):
+                    iflogger.info('File %s already exists on S3, skipping...',
+                                  dst_k)
+                    return
+                iflogger.info('Overwriting previous S3 file...')
+            else:
                 iflogger.info('New file to S3')
 
-            # Copy file up to S3 (either encrypted or not)
+            # Copy file up to S3 (either encrypted or not); the clients of
+            # boto3, unlike its resources, can be shared by threads
             iflogger.info('Uploading %s to S3 bucket, %s, as %s...', src_f,
-                          bucket.name, dst_f)
-            if self.inputs.encrypt_bucket_keys:
-                extra_args = {'ServerSideEncryption' : 'AES256'}
-            else:
-                extra_args = {}
-            bucket.upload_file(src_f, dst_k, ExtraArgs=extra_args,
-                               Callback=ProgressPercentage(src_f))
+                          bucket.name, dst_k)
+            bucket.meta.client.upload_file(
+                src_f, bucket.name, dst_k, ExtraArgs=extra_args,
+                Callback=ProgressPercentage(src_f), Config=transfer_config)
+
+        nthreads = min(self.inputs.s3_upload_threads, len(uploads))
+        if nthreads > 1:
+            pool = ThreadPool(nthreads)
+            try:
+                pool.map(_upload, uploads, chunksize=1)
+            finally:
+                pool.close()
+        else:
+            for upload in uploads:
+                _upload(upload)
+
+    # Copy files locally
+    def _copy_files(self, copies, use_hardlink=False):
+        '''
+        Method to copy a list of (source, destination) files, with up to
+        copy_threads files at once. The destinations of a different size
+        than their source are replaced without comparing their content.
+        Otherwise, the (cached) content hashes of the files are compared
+        as in copyfile, which also uses hard links or reflinks where the
+        filesystem allows.
+        '''
+
+        # Import packages
+        from multiprocessing.pool import ThreadPool
+
+        # Files with the same destination name (e.g., an image and its
+        # header, which copyfile also copies as related files) are copied
+        # in order by the same thread
+        groups = OrderedDict()
+        for src, dst in copies:
+            dirname, fname, _ = split_filename(dst)
+            groups.setdefault((dirname, fname), []).append((src, dst))
+
+        def _copy(group):
+            for src, dst in group:
+                try:
+                    dst_stat = os.lstat(dst)
+                except OSError:
+                    pass
+                else:
+                    if stat.S_ISLNK(dst_stat.st_mode) or \
+                            dst_stat.st_size != os.path.getsize(src):
+                        iflogger.debug('replacing: %s', dst)
+                        os.unlink(dst)
+                iflogger.debug('copyfile: %s %s', src, dst)
+                copyfile(src, dst, copy=True, hashmethod='content',
+                         use_hardlink=use_hardlink)
+
+        groups = list(groups.values())
+        nthreads = min(self.inputs.copy_threads, len(groups))
+        if nthreads > 1:
+            pool = ThreadPool(nthreads)
+            try:
+                pool.map(_copy, groups, chunksize=1)
+            finally:
+                pool.close()
+        else:
+            for group in groups:
+                _copy(group)
 
     # List outputs, main run routine
     def _list_outputs(self):
@@ -692,6 +912,13 @@ class DataSink(IOBase):
                     else:
                         raise(inst)
 
+        # Files and directories to copy locally, and files to upload to S3,
+        # all at once after going through the outputs
+        local_dirs = set()
+        local_files = []
+        local_trees = []
+        s3_uploads = []
+
         # Iterate through outputs attributes {key : path(s)}
         for key, files in list(self.inputs._outputs.items()):
             if not isdefined(files):
@@ -717,7 +944,8 @@ class DataSink(IOBase):
             for src in filename_to_list(files):
                 # Format src and dst files
                 src = os.path.abspath(src)
-                if not os.path.isfile(src):
+                src_isfile = os.path.isfile(src)
+                if not src_isfile:
                     src = os.path.join(src, '')
                 dst = self._get_dst(src)
                 if s3_flag:
@@ -729,34 +957,43 @@ class DataSink(IOBase):
 
                 # If we're uploading to S3
                 if s3_flag:
-                    self._upload_to_s3(bucket, src, s3dst)
+                    s3_uploads.extend(self._s3_uploads(bucket, src, s3dst))
                     out_files.append(s3dst)
                 # Otherwise, copy locally src -> dst
                 if not s3_flag or isdefined(self.inputs.local_copy):
                     # Create output directory if it doesnt exist
-                    if not os.path.exists(path):
-                        try:
-                            os.makedirs(path)
-                        except OSError as inst:
-                            if 'File exists' in inst.strerror:
-                                pass
-                            else:
-                                raise(inst)
+                    local_dirs.add(path)
                     # If src is a file, copy it to dst
-                    if os.path.isfile(src):
-                        iflogger.debug('copyfile: %s %s', src, dst)
-                        copyfile(src, dst, copy=True, hashmethod='content',
-                                 use_hardlink=use_hardlink)
+                    if src_isfile:
+                        local_files.append((src, dst))
                         out_files.append(dst)
                     # If src is a directory, copy entire contents to dst dir
                     elif os.path.isdir(src):
-                        if os.path.exists(dst) and self.inputs.remove_dest_dir:
-                            iflogger.debug('removing: %s', dst)
-                            shutil.rmtree(dst)
-                        iflogger.debug('copydir: %s %s', src, dst)
-                        copytree(src, dst)
+                        local_trees.append((src, dst))
                         out_files.append(dst)
 
+        # Create each output directory once
+        for path in sorted(local_dirs):
+            if not os.path.exists(path):
+                try:
+                    os.makedirs(path)
+                except OSError as inst:
+                    if 'File exists' in inst.strerror:
+                        pass
+                    else:
+                        raise(inst)
+        for src, dst in local_trees:
+            if os.path.exists(dst) and self.inputs.remove_dest_dir:
+                iflogger.debug('removing: %s', dst)
+                shutil.rmtree(dst)
+            iflogger.debug('copydir: %s %s', src, dst)
+            copytree(src, dst)
+        if local_files:
+            self._copy_files(local_files, use_hardlink)
+
+        if s3_uploads:
+            self._upload_files_to_s3(bucket, s3_uploads)
+
         # Return outputs dictionary
         outputs['out_file'] = out_files
 
@@ -1123,7 +1360,7 @@ class DataGrabber(IOBase):
             else:
                 template = os.path.abspath(template)
             if not args:
-                filelist = glob.glob(template)
+                filelist = _glob(template)
                 if len(filelist) == 0:
                     msg = 'Output key: %s Template: %s returned no files' % (
                         key, template)
@@ -1161,7 +1398,7 @@ class DataGrabber(IOBase):
                             filledtemplate = template % tuple(argtuple)
                         except TypeError as e:
                             raise TypeError(e.message + ": Template %s failed to convert with args %s" % (template, str(tuple(argtuple))))
-                    outfiles = glob.glob(filledtemplate)
+                    outfiles = _glob(filledtemplate)
                     if len(outfiles) == 0:
                         msg = 'Output key: %s Template: %s returned no files' % (key, filledtemplate)
                         if self.inputs.raise_on_empty:
@@ -1313,7 +1550,7 @@ class SelectFiles(IOBase):
 
             # Fill in the template and glob for files
             filled_template = template.format(**info)
-            filelist = glob.glob(filled_template)
+            filelist = _glob(filled_template)
 
             # Handle the case where nothing matched
             if not filelist:
@@ -1434,6 +1671,8 @@ class DataFinder(IOBase):
                 [re.compile(regex)
                  for regex in self.inputs.ignore_regexes]
         self.result = None
+        index = get_directory_index()
+        walk = os.walk if index is None else index.walk
         for root_path in self.inputs.root_paths:
             # Handle tilda/env variables and remove extra seperators
             root_path = os.path.normpath(os.path.expandvars(os.path.expanduser(root_path)))
@@ -1443,7 +1682,7 @@ class DataFinder(IOBase):
                     self._match_path(root_path)
                 continue
             # Walk through directory structure checking paths
-            for curr_dir, sub_dirs, files in os.walk(root_path):
+            for curr_dir, sub_dirs, files in walk(root_path):
                 # Determine the current depth from the root_path
                 curr_depth = (curr_dir.count(os.sep) -
                               root_path.count(os.sep))
@@ -1465,13 +1704,9 @@ class DataFinder(IOBase):
                 self.result[key] = vals[0]
         else:
             # sort all keys acording to out_paths
+            order = human_order_argsort(self.result["out_paths"])
             for key in list(self.result.keys()):
-                if key == "out_paths":
-                    continue
-                sort_tuples = human_order_sorted(list(zip(self.result["out_paths"],
-                                                          self.result[key])))
-                self.result[key] = [x for (_, x) in sort_tuples]
-            self.result["out_paths"] = human_order_sorted(self.result["out_paths"])
+                self.result[key] = [self.result[key][i] for i in order]
 
         if not self.result:
             raise RuntimeError("Regular expression did not match any files!")
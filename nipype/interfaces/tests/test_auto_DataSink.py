@@ -9,6 +9,8 @@ def test_DataSink_inputs():
     base_directory=dict(),
     bucket=dict(),
     container=dict(),
+    copy_threads=dict(usedefault=True,
+    ),
     creds_path=dict(),
     encrypt_bucket_keys=dict(),
     ignore_exception=dict(nohash=True,
@@ -20,6 +22,10 @@ def test_DataSink_inputs():
     regexp_substitutions=dict(),
     remove_dest_dir=dict(usedefault=True,
     ),
+    s3_part_size=dict(usedefault=True,
+    ),
+    s3_upload_threads=dict(usedefault=True,
+    ),
     strip_dir=dict(),
     substitutions=dict(),
     )
@@ -344,6 +344,38 @@ def test_TraitedSpec_withNoFileHashing(setup_file):
     assert hashval1[1] != hashval2[1]
 
 
+@pytest.mark.parametrize('hash_method', ['content', 'timestamp'])
+def test_TraitedSpec_parallel_hashing(tmpdir, hash_method):
+    files = []
+    for i in range(20):
+        tmpfile = tmpdir.join('file%02d.txt' % i)
+        tmpfile.write('%d' % i * (i + 1) * 1000)
+        files.append(tmpfile.strpath)
+
+    class spec(nib.TraitedSpec):
+        moo = nib.File(exists=True)
+        doo = nib.traits.List(nib.File(exists=True))
+        goo = nib.traits.Dict(nib.traits.Str, nib.traits.Any)
+        noo = nib.File(exists=True, hash_files=False)
+    infields = spec(moo=files[0], doo=files[::-1],
+                    goo={'a': files[3], 'b': [files[4], 'notafile', 1.5]},
+                    noo=files[5])
+
+    saved = config.get('execution', 'hash_threads')
+    try:
+        config.set('execution', 'hash_threads', '1')
+        serial = infields.get_hashval(hash_method=hash_method)
+        config.set('execution', 'hash_threads', '8')
+        parallel = infields.get_hashval(hash_method=hash_method)
+    finally:
+        config.set('execution', 'hash_threads', saved)
+    assert parallel == serial
+    assert infields.get_hashval(hash_method=hash_method,
+                                hash_threads=8) == serial
+    assert dict(serial[0])['noo'] == files[5]
+    assert dict(serial[0])['goo'][1][1][1] == 'notafile'
+
+
 def test_Interface():
     assert nib.Interface.input_spec == None
     assert nib.Interface.output_spec == None
@@ -11,12 +11,18 @@ import shutil
 import os.path as op
 from subprocess import Popen
 import hashlib
+import random
+import re
 from collections import namedtuple
 
+import mock
 import pytest
 import nipype
 import nipype.interfaces.io as nio
+import nipype.pipeline.engine as pe
 from nipype.interfaces.base import Undefined
+from nipype.utils import filemanip
+from nipype import config
 
 # Check for boto
 noboto = False
@@ -30,6 +36,7 @@ except ImportError:
 noboto3 = False
 try:
     import boto3
+    from botocore.exceptions import ClientError
     from botocore.utils import fix_s3_host
 except ImportError:
     noboto3 = True
@@ -43,6 +50,16 @@ try:
 except CalledProcessError:
     fakes3 = False
 
+# Check for moto, the S3 stand-in
+nomoto = False
+try:
+    try:
+        from moto import mock_aws as mock_s3
+    except ImportError:  # moto < 5
+        from moto import mock_s3
+except ImportError:
+    nomoto = True
+
 
 def test_datagrabber():
     dg = nio.DataGrabber()
@@ -247,6 +264,76 @@ def test_datasink_to_s3(dummy_input, tmpdir):
     assert src_md5 == dst_md5
 
 
+def test_s3_etag(tmpdir):
+    data = os.urandom(2500)
+    path = tmpdir.join('data.bin')
+    path.write_binary(data)
+    assert nio.s3_etag(path.strpath, blocksize=100) == \
+        hashlib.md5(data).hexdigest()
+    digests = b''.join(hashlib.md5(data[i:i + 1000]).digest()
+                       for i in range(0, 2500, 1000))
+    assert nio.s3_etag(path.strpath, 1000, blocksize=300) == \
+        hashlib.md5(digests).hexdigest() + '-3'
+
+
+# Test concurrent uploads, and the skipping of the files already uploaded
+@pytest.mark.skipif(noboto3 or nomoto, reason="boto3 or moto library is not available")
+def test_datasink_s3_uploads(tmpdir, monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'mykey')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'mysecret')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    part_size = 5 * 1024 ** 2  # the smallest part size of S3
+    inputs = tmpdir.mkdir('inputs')
+    for name, size in (('small1.txt', 10), ('small2.txt', 20),
+                       ('large.bin', part_size + 10)):
+        inputs.join(name).write_binary(os.urandom(size))
+
+    with mock_s3():
+        resource = boto3.resource('s3', region_name='us-east-1')
+        bucket = resource.create_bucket(Bucket='test')
+        client = bucket.meta.client
+
+        def sink():
+            ds = nio.DataSink(base_directory='s3://test', container='outputs',
+                              bucket=bucket, s3_upload_threads=3,
+                              s3_part_size=part_size)
+            setattr(ds.inputs, 'files.@files',
+                    sorted(inputs.listdir(), key=str))
+            with mock.patch.object(client, 'upload_file',
+                                   wraps=client.upload_file) as upload:
+                ds.run()
+            return sorted(call[0][0] for call in upload.call_args_list)
+
+        assert len(sink()) == 3
+        objects = dict((obj.key, obj.e_tag.strip('"'))
+                       for obj in bucket.objects.all())
+        assert objects['outputs/files/large.bin'].endswith('-2')
+        for name in ('small1.txt', 'large.bin'):
+            assert objects['outputs/files/' + name] == nio.s3_etag(
+                inputs.join(name).strpath,
+                part_size if name == 'large.bin' else None)
+
+        # nothing changed
+        assert sink() == []
+        inputs.join('small2.txt').write_binary(b'changed')
+        assert sink() == [inputs.join('small2.txt').strpath]
+
+        # without the permission to list the bucket, the objects are looked
+        # up one by one, or uploaded if they cannot be read either
+        denied_operations = set(['ListObjects'])
+        make_api_call = client._make_api_call
+
+        def _make_api_call(operation, params):
+            if operation in denied_operations:
+                raise ClientError({'Error': {'Code': 'AccessDenied'}},
+                                  operation)
+            return make_api_call(operation, params)
+        monkeypatch.setattr(client, '_make_api_call', _make_api_call)
+        assert sink() == []
+        denied_operations.add('HeadObject')
+        assert len(sink()) == 3
+
+
 # Test AWS creds read from env vars
 @pytest.mark.skipif(noboto3 or not fakes3, reason="boto3 or fakes3 library is not available")
 def test_aws_keys_from_env():
@@ -310,6 +397,40 @@ def test_datasink_localcopy(dummy_input, tmpdir):
     assert src_md5 == dst_md5
 
 
+def test_datasink_copy_threads(tmpdir):
+    indir = tmpdir.mkdir('inputs')
+    names = ['image%d.%s' % (i, ext) for i in range(5) for ext in ('img', 'hdr')]
+    for name in names:
+        indir.join(name).write(name)
+
+    def sink():
+        ds = nio.DataSink(base_directory=tmpdir.join('outputs').strpath,
+                          copy_threads=4)
+        setattr(ds.inputs, 'images.@files',
+                [indir.join(name).strpath for name in names])
+        setattr(ds.inputs, 'more.images',
+                [indir.join(name).strpath for name in names[:2]])
+        return ds.run().outputs.out_file
+
+    out_files = sink()
+    outdir = tmpdir.join('outputs')
+    assert out_files == ([outdir.join('images', name).strpath
+                          for name in names] +
+                         [outdir.join('more', 'images', name).strpath
+                          for name in names[:2]])
+    for out_file in out_files:
+        assert open(out_file).read() == os.path.basename(out_file)
+        assert not os.path.islink(out_file)
+
+    # modified inputs, of the same size or not, replace the outputs
+    indir.join('image0.img').write('IMAGE0.IMG')
+    indir.join('image1.hdr').write('longer header')
+    sink()
+    assert outdir.join('images', 'image0.img').read() == 'IMAGE0.IMG'
+    assert outdir.join('images', 'image1.hdr').read() == 'longer header'
+    assert outdir.join('images', 'image1.img').read() == 'image1.img'
+
+
 def test_datasink_substitutions(tmpdir):
     indir = tmpdir.mkdir('-Tmp-nipype_ds_subs_in')
     outdir = tmpdir.mkdir('-Tmp-nipype_ds_subs_out')
@@ -335,6 +456,48 @@ def test_datasink_substitutions(tmpdir):
               x in glob.glob(os.path.join(str(outdir), '*'))]) \
               == ['!-yz-b.n', 'ABABAB.n']  # so we got re used 2nd and both patterns
 
+def _substitute_sequentially(pathstr, substitutions, regexp_substitutions):
+    """The reference semantics of the DataSink substitutions"""
+    for key, val in substitutions:
+        pathstr = pathstr.replace(key, val)
+    for key, val in regexp_substitutions:
+        pathstr, _ = re.subn(key, val, pathstr)
+    return pathstr
+
+
+def test_datasink_substitutions_equivalence():
+    rng = random.Random(0)
+    alphabet = 'ab_/.'
+    patterns = ['a', 'b+', '_(a|b)', r'(\w+)\.', '^/', 'a$', r'/(\w)_', '[ab]{2}',
+                r'(?P<x>b)a', '/', r'\.$', '.*/']
+    replacements = ['', 'A', '_', 'x/', r'\1', r'<\g<0>>', r'\g<0>\g<0>']
+
+    def word(maxlen):
+        return ''.join(rng.choice(alphabet)
+                       for _ in range(rng.randint(0, maxlen)))
+
+    for _ in range(200):
+        substitutions = [(word(3) or 'a', word(3)) for _ in range(rng.randint(0, 5))]
+        regexp_substitutions = []
+        for _ in range(rng.randint(0, 5)):
+            pattern = rng.choice(patterns)
+            replacement = rng.choice(replacements)
+            if '\\1' in replacement and '(' not in pattern:
+                replacement = 'B'
+            regexp_substitutions.append((pattern, replacement))
+        ds = nio.DataSink(substitutions=substitutions,
+                          regexp_substitutions=regexp_substitutions)
+        paths = ['/' + word(20) for _ in range(20)]
+        # repeated paths are answered by the memo
+        for path in paths + paths:
+            assert ds._substitute(path) == _substitute_sequentially(
+                path, substitutions, regexp_substitutions)
+        # changed substitutions are taken into account
+        ds.inputs.substitutions = [('/', '|')]
+        assert ds._substitute(paths[0]) == _substitute_sequentially(
+            paths[0], [('/', '|')], regexp_substitutions)
+
+
 @pytest.fixture()
 def _temp_analyze_files(tmpdir):
     """Generate temporary analyze file pair."""
@@ -400,6 +563,70 @@ def test_datafinder_unpack(tmpdir):
     assert result.outputs.out_paths == single_res
 
 
+def test_grabbers_directory_index(tmpdir, monkeypatch):
+    for subject in range(1, 4):
+        for name in ('anat/T1w.nii.gz', 'func/run-1_bold.nii.gz',
+                     'func/run-2_bold.nii.gz'):
+            tmpdir.join('sub-%02d' % subject, name).ensure()
+    # old enough to be remembered
+    for root, _, _ in os.walk(tmpdir.strpath):
+        os.utime(root, (0, 0))
+
+    def grab():
+        results = []
+        for subject in ('sub-01', 'sub-02'):
+            sf = nio.SelectFiles({'bold': '{subject}/func/*_bold.nii.gz'},
+                                 base_directory=tmpdir.strpath)
+            sf.inputs.subject = subject
+            results.append(sf.run().outputs.bold)
+            dg = nio.DataGrabber(infields=['subject'], outfields=['anat'],
+                                 base_directory=tmpdir.strpath,
+                                 template='%s/anat/*.nii.gz',
+                                 sort_filelist=True)
+            dg.inputs.subject = subject
+            results.append(dg.run().outputs.anat)
+        df = nio.DataFinder(root_paths=tmpdir.strpath,
+                            match_regex=r'.+/(?P<subject>sub-\d+)/func/.+')
+        results.append(df.run().outputs.get())
+        return results
+
+    expected = grab()
+    config.set('execution', 'directory_index', 'true')
+    try:
+        index = nio.get_directory_index()
+        index.clear()
+        assert grab() == expected
+        monkeypatch.setattr(index, 'listdir', mock.Mock(wraps=index.listdir))
+        scandir = mock.Mock(wraps=filemanip.scandir)
+        monkeypatch.setattr(filemanip, 'scandir', scandir)
+        # the second time, from the remembered listings
+        assert grab() == expected
+        assert index.listdir.call_count > 0
+        assert scandir.call_count == 0
+    finally:
+        config.set('execution', 'directory_index', 'false')
+
+
+def test_grabbers_directory_index_option(tmpdir):
+    data = tmpdir.join('data')
+    data.join('sub-01', 'anat', 'T1w.nii.gz').ensure()
+    for root, _, _ in os.walk(data.strpath):
+        os.utime(root, (0, 0))
+    index = filemanip.get_directory_index(True)
+    index.clear()
+
+    # the option of the workflow reaches the grabbers of its nodes
+    for enabled in (False, True):
+        wf = pe.Workflow(name='wf%d' % enabled, base_dir=tmpdir.strpath)
+        wf.config['execution']['directory_index'] = str(enabled).lower()
+        wf.add_nodes([pe.Node(nio.SelectFiles(
+            {'anat': 'sub-01/anat/*.nii.gz'},
+            base_directory=data.strpath), name='grab')])
+        wf.run()
+        assert bool(index._listings) is enabled
+    assert filemanip.get_directory_index() is None
+
+
 def test_freesurfersource():
     fss = nio.FreeSurferSource()
     assert fss.inputs.hemi == 'both'
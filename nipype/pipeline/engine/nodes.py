@@ -24,6 +24,7 @@ from collections import OrderedDict
 from copy import deepcopy
 import pickle
 from glob import glob
+from fnmatch import fnmatch
 import gzip
 import os
 import os.path as op
@@ -42,7 +43,8 @@ from ...utils.filemanip import (save_json, FileNotFoundError,
                                 copyfiles, fnames_presuffix, loadpkl,
                                 split_filename, load_json, savepkl,
                                 write_rst_header, write_rst_dict,
-                                write_rst_list, to_str)
+                                write_rst_list, to_str,
+                                set_directory_index_option)
 from ...interfaces.base import (traits, InputMultiPath, CommandLine,
                                 Undefined, TraitedSpec, DynamicTraitedSpec,
                                 Bunch, InterfaceResult, md5, Interface,
@@ -50,11 +52,64 @@ from ...interfaces.base import (traits, InputMultiPath, CommandLine,
 from .utils import (generate_expanded_graph, modify_paths,
                     export_graph, make_output_dir, write_workflow_prov,
                     clean_working_directory, format_dot, topological_sort,
-                    get_print_name, merge_dict, evaluate_connect_function)
+                    get_print_name, merge_dict, evaluate_connect_function,
+                    ResultIndex)
 from .base import EngineBase
 
 logger = logging.getLogger('workflow')
 
+# Hash indices read by this process: {path: (size read, {outdir: hash})}
+_hash_indices = {}
+
+
+def _read_hash_index(filename):
+    """Return the hash index of a workflow as ``{outdir: hashvalue}``
+
+    Each line of the index holds the hash of a finished node and its
+    output directory (relative to the index). Lines are only appended, so
+    only the lines added since the last call are read.
+    """
+    try:
+        size = os.stat(filename).st_size
+    except OSError:
+        return {}
+    offset, index = _hash_indices.get(filename, (0, {}))
+    if size < offset:
+        # The index was truncated or replaced
+        offset, index = 0, {}
+    if size > offset:
+        dirname = op.dirname(filename)
+        with open(filename, 'rb') as fp:
+            fp.seek(offset)
+            for line in fp:
+                if not line.endswith(b'\n'):
+                    # Line still being written
+                    break
+                offset += len(line)
+                hashvalue, _, outdir = line.decode().rstrip('\n').partition('\t')
+                index[op.normpath(op.join(dirname, outdir))] = hashvalue
+        _hash_indices[filename] = (offset, index)
+    return index
+
+
+def _outputs_dict(result):
+    """The outputs of a result, as a dictionary"""
+    try:
+        return result.outputs.get()
+    except TypeError:
+        return result.outputs.dictcopy()  # outputs was a bunch
+
+
+def _append_hash_index(filename, outdir, hashvalue):
+    """Record the hash of a finished node in the hash index"""
+    line = '%s\t%s\n' % (hashvalue, op.relpath(outdir, op.dirname(filename)))
+    try:
+        # Single small write in append mode, safe with concurrent writers
+        with open(filename, 'ab') as fp:
+            fp.write(line.encode())
+    except (IOError, OSError) as exc:
+        logger.debug('Could not update the hash index %s: %s', filename, exc)
+
 
 class Node(EngineBase):
     """Wraps interface objects for use in pipeline
@@ -181,6 +236,7 @@ class Node(EngineBase):
         if needed_outputs:
             self.needed_outputs = sorted(needed_outputs)
         self._got_inputs = False
+        self._outdir_listing = None
 
     @property
     def interface(self):
@@ -273,27 +329,100 @@ class Node(EngineBase):
         self._interface.help()
 
     def hash_exists(self, updatehash=False):
+        """Check whether the node has already been run with the same inputs
+
+        The output directory is listed only once, and the listing is kept
+        (in ``_outdir_listing``) for :meth:`run`. With the ``hash_index``
+        option, nodes recorded as finished in the index of the workflow
+        (see :meth:`_hash_index_file`) are checked with a single ``stat``.
+        """
         # Get a dictionary with hashed filenames and a hashvalue
         # of the dictionary itself.
         hashed_inputs, hashvalue = self._get_hashval()
         outdir = self.output_dir()
-        if op.exists(outdir):
-            logger.debug('Output dir: %s', to_str(os.listdir(outdir)))
-        hashfiles = glob(op.join(outdir, '_0x*.json'))
+        hashfile = op.join(outdir, '_0x%s.json' % hashvalue)
+
+        index_file = self._hash_index_file()
+        if (index_file and not updatehash and
+                _read_hash_index(index_file).get(outdir) == hashvalue and
+                op.exists(hashfile)):
+            logger.debug('Found hashfile in index: %s', hashfile)
+            # Finished nodes have all their files, no need to list them
+            self._outdir_listing = None
+            return True, hashvalue, hashfile, hashed_inputs
+
+        listing = self._list_outdir(outdir)
+        if listing is not None:
+            logger.debug('Output dir: %s', to_str(sorted(listing)))
+        hashfiles = self._hashfiles()
         logger.debug('Found hashfiles: %s', to_str(hashfiles))
         if len(hashfiles) > 1:
             logger.info(hashfiles)
             logger.info('Removing multiple hashfiles and forcing node to rerun')
-            for hashfile in hashfiles:
-                os.unlink(hashfile)
-        hashfile = op.join(outdir, '_0x%s.json' % hashvalue)
+            for filename in hashfiles:
+                os.unlink(op.join(outdir, filename))
+                listing.discard(filename)
         logger.debug('Final hashfile: %s', hashfile)
-        if updatehash and op.exists(outdir):
+        if updatehash and listing is not None:
             logger.debug("Updating hash: %s", hashvalue)
-            for file in glob(op.join(outdir, '_0x*.json')):
-                os.remove(file)
+            for filename in self._hashfiles():
+                os.remove(op.join(outdir, filename))
+                listing.discard(filename)
             self._save_hashfile(hashfile, hashed_inputs)
-        return op.exists(hashfile), hashvalue, hashfile, hashed_inputs
+            listing.add(op.basename(hashfile))
+            if index_file:
+                _append_hash_index(index_file, outdir, hashvalue)
+        hash_exists = listing is not None and op.basename(hashfile) in listing
+        return hash_exists, hashvalue, hashfile, hashed_inputs
+
+    def _list_outdir(self, outdir):
+        """List the output directory (``None`` if it does not exist)"""
+        try:
+            self._outdir_listing = set(os.listdir(outdir))
+        except OSError:
+            self._outdir_listing = None
+        return self._outdir_listing
+
+    def _hashfiles(self, pattern='_0x*.json'):
+        """Sorted names of the hash files in the last output dir listing"""
+        return sorted(name for name in self._outdir_listing or []
+                      if fnmatch(name, pattern))
+
+    def _hash_index_file(self):
+        """Path to the hash index of the workflow, or ``None`` if disabled
+
+        The index is a ``_hashindex.txt`` file in the directory of the
+        top-level workflow, listing the hash of each finished node.
+        """
+        return self._index_file('hash_index', '_hashindex.txt')
+
+    def _result_index(self):
+        """The :class:`~.utils.ResultIndex` of the workflow, or ``None``
+
+        Enabled by the ``result_index`` option.
+        """
+        filename = self._index_file('result_index', '_results.sqlite')
+        if filename is None:
+            return None
+        try:
+            return ResultIndex.open(filename)
+        except Exception as exc:
+            logger.debug('Could not open the result index %s: %s',
+                         filename, exc)
+            return None
+
+    def _index_file(self, option, filename):
+        """Path to an index in the directory of the top-level workflow,
+        or ``None`` if ``option`` is disabled"""
+        if not (self.config and str2bool(
+                self.config['execution'].get(option, False))):
+            return None
+        if self.base_dir is None:
+            return None
+        index_dir = self.base_dir
+        if self._hierarchy:
+            index_dir = op.join(index_dir, self._hierarchy.split('.')[0])
+        return op.abspath(op.join(index_dir, filename))
 
     def run(self, updatehash=False):
         """Execute the node in its directory.
@@ -315,10 +444,10 @@ class Node(EngineBase):
             self._got_inputs = True
         outdir = self.output_dir()
         logger.info("Executing node %s in dir: %s", self.fullname, outdir)
-        if op.exists(outdir):
-            logger.debug('Output dir: %s', to_str(os.listdir(outdir)))
         hash_info = self.hash_exists(updatehash=updatehash)
         hash_exists, hashvalue, hashfile, hashed_inputs = hash_info
+        # Single listing of the output directory, made by hash_exists
+        listing = self._outdir_listing
         logger.debug(
             'updatehash=%s, overwrite=%s, always_run=%s, hash_exists=%s',
             updatehash, self.overwrite, self._interface.always_run, hash_exists)
@@ -327,24 +456,26 @@ class Node(EngineBase):
                                  self.overwrite) or not
                                 hash_exists)):
             logger.debug("Node hash: %s", hashvalue)
+            if listing is None and hash_exists:
+                # Found in the hash index, but must be rerun
+                listing = self._list_outdir(outdir)
 
             # by rerunning we mean only nodes that did finish to run previously
-            json_pat = op.join(outdir, '_0x*.json')
-            json_unfinished_pat = op.join(outdir, '_0x*_unfinished.json')
-            need_rerun = (op.exists(outdir) and not
+            need_rerun = (listing is not None and not
                           isinstance(self, MapNode) and
-                          len(glob(json_pat)) != 0 and
-                          len(glob(json_unfinished_pat)) == 0)
+                          len(self._hashfiles()) != 0 and
+                          len(self._hashfiles('_0x*_unfinished.json')) == 0)
             if need_rerun:
                 logger.debug(
                     "Rerunning node:\n"
                     "updatehash = %s, self.overwrite = %s, self._interface.always_run = %s, "
                     "os.path.exists(%s) = %s, hash_method = %s", updatehash, self.overwrite,
-                    self._interface.always_run, hashfile, op.exists(hashfile),
+                    self._interface.always_run, hashfile, hash_exists,
                     self.config['execution']['hash_method'].lower())
                 log_debug = config.get('logging', 'workflow_level') == 'DEBUG'
-                if log_debug and not op.exists(hashfile):
-                    exp_hash_paths = glob(json_pat)
+                if log_debug and not hash_exists:
+                    exp_hash_paths = [op.join(outdir, filename)
+                                      for filename in self._hashfiles()]
                     if len(exp_hash_paths) == 1:
                         split_out = split_filename(exp_hash_paths[0])
                         exp_hash_file_base = split_out[1]
@@ -366,10 +497,10 @@ class Node(EngineBase):
             hashfile_unfinished = op.join(outdir,
                                           '_0x%s_unfinished.json' %
                                           hashvalue)
-            if op.exists(hashfile):
+            if hash_exists:
                 os.remove(hashfile)
-            rm_outdir = (op.exists(outdir) and not
-                         (op.exists(hashfile_unfinished) and
+            rm_outdir = (listing is not None and not
+                         (op.basename(hashfile_unfinished) in listing and
                              self._interface.can_resume) and not
                          isinstance(self, MapNode))
             if rm_outdir:
@@ -395,8 +526,9 @@ class Node(EngineBase):
                     hashfile_unfinished)
                 if isinstance(self, MapNode):
                     # remove old json files
-                    for filename in glob(op.join(outdir, '_0x*.json')):
-                        os.unlink(filename)
+                    for filename in self._hashfiles():
+                        if filename != op.basename(hashfile):
+                            os.unlink(op.join(outdir, filename))
             outdir = make_output_dir(outdir)
             self._save_hashfile(hashfile_unfinished, hashed_inputs)
             self.write_report(report_type='preexec', cwd=outdir)
@@ -410,12 +542,16 @@ class Node(EngineBase):
                 raise
             shutil.move(hashfile_unfinished, hashfile)
             self.write_report(report_type='postexec', cwd=outdir)
+            index_file = self._hash_index_file()
+            if index_file:
+                _append_hash_index(index_file, outdir, hashvalue)
         else:
-            if not op.exists(op.join(outdir, '_inputs.pklz')):
+            # listing is None if the node was found in the hash index
+            if listing is not None and '_inputs.pklz' not in listing:
                 logger.debug('%s: creating inputs file', self.name)
                 savepkl(op.join(outdir, '_inputs.pklz'),
                         self.inputs.get_traitsfree())
-            if not op.exists(op.join(outdir, '_node.pklz')):
+            if listing is not None and '_node.pklz' not in listing:
                 logger.debug('%s: creating node file', self.name)
                 savepkl(op.join(outdir, '_node.pklz'), self)
             logger.debug("Hashfile exists. Skipping execution")
@@ -442,7 +578,10 @@ class Node(EngineBase):
             self._get_inputs()
             self._got_inputs = True
         hashed_inputs, hashvalue = self.inputs.get_hashval(
-            hash_method=self.config['execution']['hash_method'])
+            hash_method=self.config['execution']['hash_method'],
+            hash_algorithm=self.config['execution'].get(
+                'content_hash_algorithm'),
+            hash_threads=self.config['execution'].get('hash_threads'))
         rm_extra = self.config['execution']['remove_unnecessary_outputs']
         if str2bool(rm_extra) and self.needed_outputs:
             hashobject = md5()
@@ -478,25 +617,31 @@ class Node(EngineBase):
         other data sources (e.g., XNAT, HTTP, etc.,.)
         """
         logger.debug('Setting node inputs')
+        # Outputs of each upstream node, looked up all at once in the
+        # result index of the workflow if enabled, or loaded from the
+        # results files otherwise
+        outputs = {}
+        index = self._result_index()
+        if index is not None:
+            outputs = index.get(set(info[0]
+                                    for info in self.input_source.values()))
         for key, info in list(self.input_source.items()):
             logger.debug('input: %s', key)
             results_file = info[0]
             logger.debug('results file: %s', results_file)
-            results = loadpkl(results_file)
+            if results_file not in outputs:
+                outputs[results_file] = _outputs_dict(loadpkl(results_file))
             output_value = Undefined
             if isinstance(info[1], tuple):
                 output_name = info[1][0]
-                value = getattr(results.outputs, output_name)
+                value = outputs[results_file][output_name]
                 if isdefined(value):
                     output_value = evaluate_connect_function(info[1][1],
                                                              info[1][2],
                                                              value)
             else:
                 output_name = info[1]
-                try:
-                    output_value = results.outputs.get()[output_name]
-                except TypeError:
-                    output_value = results.outputs.dictcopy()[output_name]
+                output_value = outputs[results_file][output_name]
             logger.debug('output: %s', output_name)
             try:
                 self.set_input(key, deepcopy(output_value))
@@ -519,6 +664,7 @@ class Node(EngineBase):
 
     def _save_results(self, result, cwd):
         resultsfile = op.join(cwd, 'result_%s.pklz' % self.name)
+        compacted = self._compact_result(result)
         if result.outputs:
             try:
                 outputs = result.outputs.get()
@@ -529,9 +675,71 @@ class Node(EngineBase):
 
         savepkl(resultsfile, result)
         logger.debug('saved results in %s', resultsfile)
+        index = self._result_index()
+        if index is not None and result.outputs:
+            index.add(resultsfile, _outputs_dict(result))
 
         if result.outputs:
             result.outputs.set(**outputs)
+        # only the results file is compacted, not the returned result
+        self._restore_environ(compacted)
+
+    def _new_runtime(self, **kwargs):
+        """A runtime record of the current process, with the environment
+        stored as configured by ``runtime_environ``"""
+        runtime = Bunch(environ=dict(os.environ),
+                        hostname=socket.gethostname(), **kwargs)
+        self._compact_environ(runtime)
+        return runtime
+
+    def _compact_result(self, result):
+        """Compact the runtime records of a result (see
+        :meth:`_compact_environ`), e.g. before it is pickled"""
+        runtime = getattr(result, 'runtime', None)
+        if runtime is None:
+            return []
+        return self._compact_environ(runtime)
+
+    @staticmethod
+    def _restore_environ(compacted):
+        """Restore the full environments of the compacted runtime records"""
+        for runtime, environ in compacted:
+            runtime.environ = environ
+            del runtime.environ_fingerprint
+
+    def _compact_environ(self, runtime):
+        """Drop the inherited environment variables from a runtime record
+
+        With ``runtime_environ = compact`` (the default), only the variables
+        declared by the interface are kept in ``runtime.environ``, and the
+        whole environment is summarized by ``runtime.environ_fingerprint``.
+        Set ``runtime_environ = full`` to store the full environment.
+
+        Returns the ``(runtime, environ)`` pairs that were compacted, so that
+        the full environments can be restored.
+        """
+        if isinstance(runtime, list):
+            # MapNodes collate the runtimes of their subnodes
+            compacted = []
+            for item in runtime:
+                compacted.extend(self._compact_environ(item))
+            return compacted
+        mode = 'compact'
+        if self.config:
+            mode = self.config['execution'].get('runtime_environ', mode)
+        environ = getattr(runtime, 'environ', None)
+        if (mode.lower() != 'compact' or not isinstance(environ, dict) or
+                hasattr(runtime, 'environ_fingerprint')):
+            return []
+        declared = getattr(self._interface.inputs, 'environ', None)
+        declared = list(declared) if isdefined(declared) and declared else []
+        if getattr(self._interface, '_redirect_x', False):
+            declared.append('DISPLAY')
+        runtime.environ_fingerprint = md5(
+            to_str(sorted(environ.items())).encode()).hexdigest()
+        runtime.environ = dict((key, environ[key]) for key in declared
+                               if key in environ)
+        return [(runtime, environ)]
 
     def _load_resultfile(self, cwd):
         """Load results if it exists in cwd
@@ -601,10 +809,7 @@ class Node(EngineBase):
                 self._copyfiles_to_wd(cwd, True, linksonly=True)
                 aggouts = self._interface.aggregate_outputs(
                     needed_outputs=self.needed_outputs)
-                runtime = Bunch(cwd=cwd,
-                                returncode=0,
-                                environ=dict(os.environ),
-                                hostname=socket.gethostname())
+                runtime = self._new_runtime(cwd=cwd, returncode=0)
                 result = InterfaceResult(
                     interface=self._interface.__class__,
                     runtime=runtime,
@@ -622,9 +827,7 @@ class Node(EngineBase):
         if execute and copyfiles:
             self._originputs = deepcopy(self._interface.inputs)
         if execute:
-            runtime = Bunch(returncode=1,
-                            environ=dict(os.environ),
-                            hostname=socket.gethostname())
+            runtime = self._new_runtime(returncode=1)
             result = InterfaceResult(
                 interface=self._interface.__class__,
                 runtime=runtime,
@@ -646,12 +849,17 @@ class Node(EngineBase):
                 message += ', a CommandLine Interface with command:\n%s' % cmd
             logger.info(message + '.', self.name, self._interface.__module__,
                         self._interface.__class__.__name__)
+            # the grabbers follow the directory_index option of the node
+            previous = set_directory_index_option(
+                self.config['execution'].get('directory_index'))
             try:
                 result = self._interface.run()
             except Exception as msg:
                 self._save_results(result, cwd)
                 self._result.runtime.stderr = msg
                 raise
+            finally:
+                set_directory_index_option(previous)
 
             dirs2keep = None
             if isinstance(self, MapNode):
@@ -1116,7 +1324,10 @@ class MapNode(Node):
             else:
                 setattr(hashinputs, name, getattr(self._inputs, name))
         hashed_inputs, hashvalue = hashinputs.get_hashval(
-            hash_method=self.config['execution']['hash_method'])
+            hash_method=self.config['execution']['hash_method'],
+            hash_algorithm=self.config['execution'].get(
+                'content_hash_algorithm'),
+            hash_threads=self.config['execution'].get('hash_threads'))
         rm_extra = self.config['execution']['remove_unnecessary_outputs']
         if str2bool(rm_extra) and self.needed_outputs:
             hashobject = md5()
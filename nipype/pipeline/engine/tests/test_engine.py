@@ -798,3 +798,235 @@ def test_io_subclass():
         if 'Module testkv has no output called test' in e:
             exception_not_raised = False
     assert exception_not_raised
+
+
+def _count_listdir(monkeypatch, paths):
+    """Count the listings of ``paths``"""
+    calls = []
+    listdir = os.listdir
+
+    def _listdir(path='.'):
+        if path in paths:
+            calls.append(path)
+        return listdir(path)
+    monkeypatch.setattr(os, 'listdir', _listdir)
+    return calls
+
+
+def _hash_test_workflow(base_dir, hash_index):
+    from nipype.interfaces.utility import Function
+
+    def func1(a):
+        return a
+
+    def func2(a):
+        return a + 1
+    n1 = pe.Node(Function(input_names=['a'], output_names=['a'],
+                          function=func1), name='n1')
+    n2 = pe.Node(Function(input_names=['a'], output_names=['b'],
+                          function=func2), name='n2')
+    n1.inputs.a = 1
+    w1 = pe.Workflow(name='test', base_dir=base_dir)
+    w1.connect(n1, 'a', n2, 'a')
+    w1.config['execution'] = {'crashdump_dir': base_dir,
+                              'hash_index': hash_index}
+    return w1, n1
+
+
+def test_hash_exists_single_listing(tmpdir, monkeypatch):
+    w1, n1 = _hash_test_workflow(tmpdir.strpath, 'false')
+    w1.run(plugin='Linear')
+    outdirs = [os.path.join(tmpdir.strpath, 'test', name)
+               for name in ('n1', 'n2')]
+    assert not os.path.exists(os.path.join(tmpdir.strpath, 'test',
+                                           '_hashindex.txt'))
+
+    # cached rerun: one listing per node
+    calls = _count_listdir(monkeypatch, outdirs)
+    w1.run(plugin='Linear')
+    assert sorted(calls) == outdirs
+
+    # a change in the inputs reruns the nodes, still listing them once
+    del calls[:]
+    n1.inputs.a = 2
+    eg = w1.run(plugin='Linear')
+    assert sorted(calls) == outdirs
+    node = [node for node in eg.nodes() if node.name == 'n2'][0]
+    assert node.get_output('b') == 3
+    assert len(glob(os.path.join(outdirs[1], '_0x*.json'))) == 1
+
+
+def test_hash_index(tmpdir, monkeypatch):
+    from nipype.pipeline.engine.nodes import _read_hash_index
+    w1, n1 = _hash_test_workflow(tmpdir.strpath, 'true')
+    w1.run(plugin='Linear')
+    outdirs = [os.path.join(tmpdir.strpath, 'test', name)
+               for name in ('n1', 'n2')]
+    index_file = os.path.join(tmpdir.strpath, 'test', '_hashindex.txt')
+    index = dict(_read_hash_index(index_file))
+    assert sorted(index) == outdirs
+    for outdir, hashvalue in index.items():
+        assert os.path.exists(os.path.join(outdir, '_0x%s.json' % hashvalue))
+
+    # fully cached rerun: no listing at all
+    calls = _count_listdir(monkeypatch, outdirs)
+    w1.run(plugin='Linear')
+    assert calls == []
+
+    # the index is only trusted if the hash file is still there
+    os.remove(os.path.join(outdirs[1], '_0x%s.json' % index[outdirs[1]]))
+    w1.run(plugin='Linear')
+    assert calls == outdirs[1:]
+
+    # changed inputs: the nodes are rerun and the index updated
+    del calls[:]
+    n1.inputs.a = 2
+    eg = w1.run(plugin='Linear')
+    assert sorted(calls) == outdirs
+    node = [node for node in eg.nodes() if node.name == 'n2'][0]
+    assert node.get_output('b') == 3
+    assert _read_hash_index(index_file) != index
+    with open(index_file) as fp:
+        assert len(fp.readlines()) == 5
+
+
+def test_result_index(tmpdir, monkeypatch):
+    from nipype.interfaces.utility import Function
+    from nipype.pipeline.engine import nodes
+
+    def func1(a):
+        return a
+
+    def func2(a):
+        return sum(a)
+    source = pe.Node(Function(input_names=['a'], output_names=['a'],
+                              function=func1), name='source')
+    source.iterables = ('a', list(range(5)))
+    fanin = pe.JoinNode(Function(input_names=['a'], output_names=['b'],
+                                 function=func2),
+                        joinsource='source', joinfield=['a'], name='fanin')
+    w1 = pe.Workflow(name='test', base_dir=tmpdir.strpath)
+    w1.connect(source, 'a', fanin, 'a')
+    w1.config['execution'] = {'crashdump_dir': tmpdir.strpath,
+                              'result_index': 'true'}
+
+    def _run():
+        eg = w1.run(plugin='Linear')
+        return [node for node in eg.nodes()
+                if node.name == 'fanin'][0].get_output('b')
+
+    assert _run() == 10
+    assert os.path.exists(os.path.join(tmpdir.strpath, 'test',
+                                       '_results.sqlite'))
+
+    # inputs are retrieved from the index
+    loaded = []
+    loadpkl = nodes.loadpkl
+
+    def _loadpkl(infile):
+        loaded.append(infile)
+        return loadpkl(infile)
+    monkeypatch.setattr(nodes, 'loadpkl', _loadpkl)
+    assert _run() == 10
+    assert [name for name in loaded if 'result_source' in name] == []
+
+    # new results are indexed as they are saved
+    source.iterables = ('a', [0, 1, 2, 3, 5])
+    assert _run() == 11
+    assert [name for name in loaded if 'result_source' in name] == []
+
+    # modified results files are loaded
+    resultsfile = os.path.join(tmpdir.strpath, 'test', '_a_0', 'source',
+                               'result_source.pklz')
+    os.utime(resultsfile, (0, 12345))
+    assert _run() == 11
+    assert [name for name in loaded if 'result_source' in name] == \
+        [resultsfile]
+
+
+@pytest.mark.parametrize('mode', ['compact', 'full'])
+def test_runtime_environ(tmpdir, mode):
+    from nipype.utils.filemanip import loadpkl
+    echo = pe.Node(nib.CommandLine('echo'), name='echo',
+                   base_dir=tmpdir.strpath)
+    echo.inputs.environ = {'MYENV': 'foo'}
+    echo.config = {'execution': {'runtime_environ': mode}}
+    returned = echo.run()
+    # the returned result keeps the full environment
+    assert returned.runtime.environ['PATH'] == os.environ['PATH']
+    assert not hasattr(returned.runtime, 'environ_fingerprint')
+    result = loadpkl(os.path.join(echo.output_dir(), 'result_echo.pklz'))
+    assert result.runtime.environ['MYENV'] == 'foo'
+    assert result.runtime.returncode == 0
+    if mode == 'compact':
+        assert result.runtime.environ == {'MYENV': 'foo'}
+        assert len(result.runtime.environ_fingerprint) == 32
+    else:
+        assert result.runtime.environ['PATH'] == os.environ['PATH']
+        assert not hasattr(result.runtime, 'environ_fingerprint')
+
+
+def fail(value):
+    raise ValueError(value)
+
+
+def test_runtime_environ_transfers(tmpdir):
+    from nipype.interfaces.utility import Function
+    from nipype.utils.filemanip import loadpkl
+    from nipype.pipeline.plugins.multiproc import run_node
+    from nipype.pipeline.plugins.tools import report_crash
+
+    def compact(runtime):
+        return 'PATH' not in runtime.environ and \
+            len(runtime.environ_fingerprint) == 32
+
+    config = {'execution': {'crashdump_dir': tmpdir.strpath,
+                            'crashfile_format': 'pklz'}}
+    echo = pe.Node(nib.CommandLine('echo'), name='echo',
+                   base_dir=tmpdir.strpath)
+    echo.config = config
+    echo.overwrite = True
+    # the crash files
+    returned = echo.run()
+    crash = loadpkl(report_crash(echo, traceback=['traceback']))
+    assert compact(crash['node']._result.runtime)
+    assert returned.runtime.environ['PATH'] == os.environ['PATH']
+    # the results sent back by the MultiProc workers
+    assert compact(run_node(echo, False, 1)['result'].runtime)
+
+    # the runtime records of the failed nodes
+    failing = pe.Node(Function(function=fail, input_names=['value'],
+                               output_names=['out']),
+                      name='fail', base_dir=tmpdir.strpath)
+    failing.inputs.value = 1
+    failing.config = config
+    result = run_node(failing, False, 2)
+    assert result['traceback']
+    assert compact(result['result'].runtime)
+
+
+def test_node_hash_threads(tmpdir, monkeypatch):
+    from multiprocessing.pool import ThreadPool
+    from nipype import config
+    import nipype.interfaces.utility as niu
+    files = []
+    for i in range(4):
+        tmpfile = tmpdir.join('file%d.txt' % i)
+        tmpfile.write('%d' % i)
+        files.append(tmpfile.strpath)
+    threads = []
+
+    class CountingPool(ThreadPool):
+        def __init__(self, processes=None):
+            threads.append(processes)
+            super(CountingPool, self).__init__(processes)
+    monkeypatch.setattr(nib, 'ThreadPool', CountingPool)
+    monkeypatch.setitem(config._sections['execution'], 'hash_threads', '1')
+
+    # the node configuration overrides the global one
+    ident = pe.Node(niu.IdentityInterface(fields=['files']), name='ident',
+                    base_dir=tmpdir.strpath)
+    ident.inputs.files = files
+    ident.config = {'execution': {'hash_threads': '3'}}
+    ident.run()
+    assert threads and set(threads) == set([3])
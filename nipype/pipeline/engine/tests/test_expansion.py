@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Tests and benchmark for the expansion of iterables in the execution graph
+
+The tests count the expansion operations; run as a script to print the
+expansion timings::
+
+    python test_expansion.py
+"""
+from __future__ import print_function, division
+import gc
+from copy import deepcopy
+from time import time
+
+import pytest
+
+from nipype import logging
+from nipype.interfaces import utility as niu
+from nipype.pipeline import engine as pe
+from nipype.pipeline.engine import utils
+from nipype.pipeline.engine.utils import sweep_iterables
+
+
+def first(a, b):
+    return a
+
+
+def _sweep_workflow(num_subjects, num_sessions, num_steps):
+    """Subjects x sessions iterables feeding a chain of nodes, joined over
+    the subjects"""
+    wf = pe.Workflow(name='sweep')
+    subjects = pe.Node(niu.IdentityInterface(fields=['subject']),
+                       name='subjects')
+    subjects.iterables = ('subject', list(range(num_subjects)))
+    sessions = pe.Node(niu.IdentityInterface(fields=['session']),
+                       name='sessions')
+    sessions.iterables = ('session', list(range(num_sessions)))
+    prev = pe.Node(niu.Function(function=first, input_names=['a', 'b'],
+                                output_names=['out']), name='step0')
+    wf.connect([(subjects, prev, [('subject', 'a')]),
+                (sessions, prev, [('session', 'b')])])
+    for i in range(1, num_steps):
+        step = pe.Node(niu.Function(function=first, input_names=['a', 'b'],
+                                    output_names=['out']), name='step%d' % i)
+        wf.connect(prev, 'out', step, 'a')
+        prev = step
+    join = pe.JoinNode(niu.IdentityInterface(fields=['out']),
+                       joinsource='subjects', joinfield='out', name='join')
+    wf.connect(prev, 'out', join, 'out')
+    wf._create_flat_graph()
+    return wf
+
+
+def _time_expansion(num_subjects, num_sessions=4, num_steps=10):
+    graph = deepcopy(_sweep_workflow(num_subjects, num_sessions,
+                                     num_steps)._graph)
+    # Keep garbage collection pauses out of the measurement
+    gc.collect()
+    gc.disable()
+    try:
+        tic = time()
+        execgraph = pe.generate_expanded_graph(graph)
+        return time() - tic, len(execgraph)
+    finally:
+        gc.enable()
+
+
+def _expanded(graph):
+    """Expand the graph, and key its nodes by name and parameterization, as
+    the iternames depend on the iteration order of networkx"""
+    execgraph = pe.generate_expanded_graph(deepcopy(graph))
+
+    def key(node):
+        return node.name, frozenset(node.parameterization)
+    nodes = dict((key(node), node) for node in execgraph.nodes())
+    assert len(nodes) == len(execgraph)
+    edges = set((key(u), key(v), str(data['connect']))
+                for u, v, data in execgraph.edges(data=True))
+    return nodes, edges
+
+
+def test_expansion():
+    wf = _sweep_workflow(3, 2, 2)
+    nodes, edges = _expanded(wf._graph)
+    assert len(nodes) == 3 * 2 * 2 + 2
+    replicates = set(frozenset(['_session_%d' % session,
+                                '_subject_%d' % subject])
+                     for session in range(2) for subject in range(3))
+    for name in ('step0', 'step1'):
+        assert set(params for node_name, params in nodes
+                   if node_name == name) == replicates
+    step0 = nodes['step0', frozenset(['_session_1', '_subject_2'])]
+    assert step0.inputs.a == 2
+    assert step0.inputs.b == 1
+    # every subject replicate is connected to its own join slot
+    joins = {}
+    for source, dest, connect in edges:
+        if dest[0] == 'join':
+            joins.setdefault(dest[1], {})[source[1]] = connect
+    assert set(joins) == set([frozenset(['_session_0']),
+                              frozenset(['_session_1'])])
+    for params, sources in joins.items():
+        assert len(sources) == 3
+        assert all(source >= params for source in sources)
+        assert sorted(sources.values()) == [
+            "[('out', 'outJ%d')]" % slot for slot in (1, 2, 3)]
+
+    # Nodes which cannot be pickled are deep-copied instead
+    for node in wf._graph.nodes():
+        node.plugin_args = {'unpicklable': lambda: None}
+    fallback_nodes, fallback_edges = _expanded(wf._graph)
+    assert set(fallback_nodes) == set(nodes)
+    assert fallback_edges == edges
+    for key, node in fallback_nodes.items():
+        assert node.inputs.get() == nodes[key].inputs.get()
+
+
+def add(a, b):
+    return a + b
+
+
+@pytest.mark.parametrize('plugin', ['Linear', 'MultiProc'])
+def test_expansion_batches(tmpdir, plugin):
+    wf = pe.Workflow(name='batches', base_dir=tmpdir.strpath)
+    subjects = pe.Node(niu.IdentityInterface(fields=['subject']),
+                       name='subjects')
+    subjects.iterables = ('subject', [10, 20, 30, 40, 50])
+    sessions = pe.Node(niu.IdentityInterface(fields=['session']),
+                       name='sessions')
+    sessions.iterables = ('session', [1, 2])
+    step = pe.Node(niu.Function(function=add, input_names=['a', 'b'],
+                                output_names=['out']), name='step')
+    join = pe.JoinNode(niu.IdentityInterface(fields=['out']),
+                       joinsource='sessions', joinfield='out', name='join')
+    wf.connect([(subjects, step, [('subject', 'a')]),
+                (sessions, step, [('session', 'b')]),
+                (step, join, [('out', 'out')])])
+
+    # the joined iterables cannot be split in batches
+    node, params = sweep_iterables(wf._create_flat_graph())
+    assert node.name == 'subjects'
+    assert len(params) == 5
+
+    wf.config['execution']['expansion_batch_size'] = 2
+    wf.config['execution']['poll_sleep_duration'] = 0.1
+    execgraph = wf.run(plugin=plugin, plugin_args={'n_procs': 2})
+    # only the nodes of the last batch are returned
+    assert sorted(node.get_output('out') for node in execgraph.nodes()
+                  if node.name == 'join') == [[51, 52]]
+    for subject in (10, 20, 30, 40, 50):
+        outdir = tmpdir.join('batches', '_subject_%d' % subject, 'join')
+        assert outdir.join('result_join.pklz').check()
+        for session in (1, 2):
+            assert tmpdir.join('batches', '_session_%d' % session,
+                               '_subject_%d' % subject, 'step',
+                               'result_step.pklz').check()
+
+
+def _count_expansion(monkeypatch, num_subjects):
+    """Expand the sweep workflow, and count the subgraph templates, the
+    cloned subgraphs and nodes, and the itername indexes"""
+    counts = dict(templates=0, clones=0, cloned_nodes=0, indexes=0)
+    subgraph_template = utils._subgraph_template
+    clone_subgraph = utils._clone_subgraph
+    itername_index = utils._itername_index
+
+    def count_template(subgraph):
+        counts['templates'] += 1
+        return subgraph_template(subgraph)
+
+    def count_clone(template):
+        nodes, edges = clone_subgraph(template)
+        counts['clones'] += 1
+        counts['cloned_nodes'] += len(nodes)
+        return nodes, edges
+
+    def count_index(graph):
+        counts['indexes'] += 1
+        return itername_index(graph)
+    monkeypatch.setattr(utils, '_subgraph_template', count_template)
+    monkeypatch.setattr(utils, '_clone_subgraph', count_clone)
+    monkeypatch.setattr(utils, '_itername_index', count_index)
+    graph = _sweep_workflow(num_subjects, 4, 10)._graph
+    try:
+        counts['nodes'] = len(pe.generate_expanded_graph(deepcopy(graph)))
+    finally:
+        monkeypatch.undo()
+    return counts
+
+
+def test_expansion_scaling(monkeypatch):
+    """Expanding iterables must do work linear in the number of nodes"""
+    small = _count_expansion(monkeypatch, 25)
+    large = _count_expansion(monkeypatch, 100)
+    # one template per iterable node, and one itername index per expansion
+    # step, whatever the number of iterable values
+    assert small['templates'] == large['templates'] == 2
+    assert small['indexes'] == large['indexes'] == 1
+    # one clone per iterable value
+    assert small['clones'] == 25 + 4
+    assert large['clones'] == 100 + 4
+    # 4x the number of nodes are cloned for 4x the number of subjects
+    assert large['nodes'] == 4 * small['nodes'] - 12
+    assert large['cloned_nodes'] <= 4 * small['cloned_nodes']
+
+
+if __name__ == '__main__':
+    logging.getLogger('workflow').setLevel('ERROR')
+    print('subjects  nodes  time (s)  us/node')
+    for num_subjects in (100, 250, 500, 1000):
+        elapsed, num_nodes = _time_expansion(num_subjects)
+        print('%8d  %5d  %8.3f  %7.1f' % (
+            num_subjects, num_nodes, elapsed, 1e6 * elapsed / num_nodes))
@@ -15,7 +15,8 @@ from ... import engine as pe
 from ....interfaces import base as nib
 from ....interfaces import utility as niu
 from .... import config
-from ..utils import merge_dict, clean_working_directory, write_workflow_prov
+from ..utils import (merge_dict, clean_working_directory, write_workflow_prov,
+                     topological_sort, walk_files, wait_for_cleanup)
 
 
 def test_identitynode_removal(tmpdir):
@@ -49,6 +50,21 @@ def test_identitynode_removal(tmpdir):
     assert len(eg.nodes()) == 8
 
 
+def test_topological_sort_depth_first():
+    import networkx as nx
+    graph = nx.DiGraph()
+    graph.add_edges_from([(1, 3), (2, 4), (3, 5), (4, 6), (2, 7)])
+    graph.add_node(8)
+    nodes, groups = topological_sort(graph, depth_first=True)
+    # the nodes of each connected component are grouped together, in
+    # topological order
+    assert sorted(groups) == groups
+    assert sorted(sorted(n for n, g in zip(nodes, groups) if g == group)
+                  for group in set(groups)) == [[1, 3, 5], [2, 4, 6, 7], [8]]
+    position = dict((node, i) for i, node in enumerate(nodes))
+    assert all(position[u] < position[v] for u, v in graph.edges())
+
+
 def test_clean_working_directory(tmpdir):
     class OutputSpec(nib.TraitedSpec):
         files = nib.traits.List(nib.File)
@@ -90,6 +106,64 @@ def test_clean_working_directory(tmpdir):
     config.set_default_config()
 
 
+@pytest.mark.parametrize('background', [False, True])
+def test_clean_working_directory_dirs(tmpdir, background):
+    class OutputSpec(nib.TraitedSpec):
+        outdir = nib.Directory()
+        others = nib.File()
+
+    outputs = OutputSpec()
+    for path in ('out/a/b.txt', 'out/c.txt', 'out2/d.txt', 'mapflow/e/f.txt',
+                 'other/g/h.txt', 'i.txt', '_report/report.rst'):
+        tmpdir.join(path).write('dummy', ensure=True)
+    # the directory symlinks are not followed
+    os.symlink(tmpdir.join('other').strpath, tmpdir.join('link').strpath)
+    outputs.outdir = tmpdir.join('out').strpath
+    outputs.others = tmpdir.join('i.txt').strpath
+    cfg = deepcopy(config._sections)
+    cfg['execution']['remove_unnecessary_outputs'] = 'true'
+    cfg['execution']['background_cleanup'] = str(background)
+    clean_working_directory(outputs, tmpdir.strpath, nib.TraitedSpec(),
+                            ['outdir'], cfg,
+                            dirs2keep=[tmpdir.join('mapflow').strpath])
+    wait_for_cleanup()
+    remaining = sorted(os.path.relpath(f, tmpdir.strpath)
+                       for f in walk_files(tmpdir.strpath))
+    # the needed directories are matched as path prefixes
+    assert remaining == ['_report/report.rst', 'mapflow/e/f.txt',
+                         'out/a/b.txt', 'out/c.txt', 'out2/d.txt']
+    assert tmpdir.join('link').check()
+
+
+def write_scratch():
+    with open('scratch.txt', 'w') as fp:
+        fp.write('dummy')
+    return 1
+
+
+def test_run_waits_for_cleanup(tmpdir, monkeypatch):
+    from time import sleep
+    from .. import utils
+    remove_files = utils._remove_files
+
+    def slow_remove_files(files):
+        sleep(0.5)
+        remove_files(files)
+    monkeypatch.setattr(utils, '_remove_files', slow_remove_files)
+
+    wf = pe.Workflow(name='cleanup', base_dir=tmpdir.strpath)
+    wf.add_nodes([pe.Node(niu.Function(function=write_scratch,
+                                       input_names=[], output_names=['out']),
+                          name='scratch')])
+    wf.config['execution']['remove_unnecessary_outputs'] = 'true'
+    wf.config['execution']['background_cleanup'] = 'true'
+    wf.run()
+    # the background removals are over once the workflow returns
+    assert tmpdir.join('cleanup', 'scratch', 'result_scratch.pklz').check()
+    assert not tmpdir.join('cleanup', 'scratch', 'scratch.txt').check()
+    assert utils._cleanup_threads == []
+
+
 def test_outputs_removal(tmpdir):
 
     def test_function(arg1):
@@ -9,19 +9,28 @@ from builtins import str, open, map, next, zip, range
 import sys
 from future import standard_library
 standard_library.install_aliases()
-from collections import defaultdict
+from bisect import bisect_left, bisect_right
+from collections import defaultdict, deque
 
 from copy import deepcopy
-from glob import glob
+import fnmatch
 try:
     from inspect import signature
 except ImportError:
     from funcsigs import signature
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 import os
 import re
 import pickle
-from functools import reduce
+import threading
+from functools import partial, reduce
 import numpy as np
 from distutils.version import LooseVersion
 
@@ -34,11 +43,12 @@ from ...utils.functions import create_function_from_source
 from ...interfaces.base import (CommandLine, isdefined, Undefined,
                                 InterfaceResult)
 from ...interfaces.utility import IdentityInterface
-from ...utils.provenance import ProvStore, pm, nipype_ns, get_id
 
 from ... import logging, config
 logger = logging.getLogger('workflow')
 PY3 = sys.version_info[0] > 2
+# the threads removing files in the background
+_cleanup_threads = []
 
 try:
     dfs_preorder = nx.dfs_preorder
@@ -201,6 +211,82 @@ def modify_paths(object, relative=True, basedir=None):
     return out
 
 
+class ResultIndex(object):
+    """
+    Index of the outputs of the nodes of a workflow
+
+    Maps the path of each results file (``result_<name>.pklz``) to the
+    outputs it stores, so that downstream nodes can retrieve their inputs
+    with a single query instead of loading each results file. Entries are
+    only used if the results file was not modified since it was indexed.
+
+    The index is a SQLite database, shared by all the processes running
+    the workflow. Use :meth:`open` to reuse connections within a process.
+    """
+    _instances = {}
+
+    def __init__(self, filename):
+        import sqlite3
+        self.filename = filename
+        self._db = sqlite3.connect(filename, timeout=60)
+        self._db.execute('CREATE TABLE IF NOT EXISTS results ('
+                         'path TEXT PRIMARY KEY, mtime INTEGER, '
+                         'size INTEGER, outputs BLOB)')
+        self._db.commit()
+
+    @classmethod
+    def open(cls, filename):
+        """Return the index stored in ``filename`` for this process"""
+        key = (os.getpid(), filename)
+        if key not in cls._instances:
+            cls._instances[key] = cls(filename)
+        return cls._instances[key]
+
+    @staticmethod
+    def _stamp(path):
+        stat = os.stat(path)
+        mtime = getattr(stat, 'st_mtime_ns', None)
+        if mtime is None:
+            mtime = int(stat.st_mtime * 1e9)
+        return mtime, stat.st_size
+
+    def add(self, resultsfile, outputs):
+        """Index the outputs of a results file that was just written"""
+        try:
+            blob = pickle.dumps(outputs, pickle.HIGHEST_PROTOCOL)
+            with self._db:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)',
+                    (resultsfile,) + self._stamp(resultsfile) + (blob,))
+        except Exception as exc:
+            logger.debug('Could not index the outputs of %s: %s',
+                         resultsfile, exc)
+
+    def get(self, resultsfiles):
+        """Return ``{results file: outputs}`` for the indexed files"""
+        found = {}
+        resultsfiles = list(resultsfiles)
+        # Stay below the limit on the number of SQL variables
+        for start in range(0, len(resultsfiles), 500):
+            chunk = resultsfiles[start:start + 500]
+            try:
+                rows = self._db.execute(
+                    'SELECT path, mtime, size, outputs FROM results '
+                    'WHERE path IN (%s)' % ', '.join('?' * len(chunk)),
+                    chunk).fetchall()
+            except Exception as exc:
+                logger.debug('Could not read the result index %s: %s',
+                             self.filename, exc)
+                return found
+            for path, mtime, size, blob in rows:
+                try:
+                    if self._stamp(path) == (mtime, size):
+                        found[path] = pickle.loads(blob)
+                except Exception:
+                    pass
+        return found
+
+
 def get_print_name(node, simple_form=True):
     """Get the name of the node
 
@@ -344,6 +430,43 @@ def expand_iterables(iterables, synchronize=False):
         return list(walk(list(iterables.items())))
 
 
+def sweep_iterables(graph):
+    """Returns the iterable node of a flat graph whose expansions can be run
+    in batches, along with the list of its {field: value} expansions
+
+    The node is the one with the most expansions among the iterable nodes
+    which are neither the join source nor the itersource of another node,
+    and whose expansions all set the same fields. Returns None if there
+    is no such node.
+    """
+    joinsources = set(getattr(node, 'joinsource', None)
+                      for node in graph.nodes())
+    itersources = set(node.itersource[0] for node in graph.nodes()
+                      if node.itersource)
+    sweep = None
+    for node in graph.nodes():
+        if (not node.iterables or node.itersource or
+                node.name in joinsources or node.name in itersources):
+            continue
+        _standardize_iterables(node)
+        params = expand_iterables(node.iterables, node.synchronize)
+        if len(set(tuple(sorted(param)) for param in params)) != 1:
+            continue
+        if sweep is None or len(params) > len(sweep[1]):
+            sweep = (node, params)
+    return sweep
+
+
+def batch_iterables(params):
+    """Converts a list of {field: value} expansions to the synchronized
+    {field: function} iterables which expand to the same list"""
+    def make_field_func(field):
+        values = [param[field] for param in params]
+        return field, lambda: values
+
+    return dict([make_field_func(field) for field in params[0]])
+
+
 def count_iterables(iterables, synchronize=False):
     """Return the number of iterable expansion nodes.
 
@@ -451,6 +574,37 @@ def get_levels(G):
     return levels
 
 
+def _subgraph_template(subgraph):
+    """Returns a template to clone the nodes and edges of a subgraph
+
+    The template is the pickled list of nodes and edges, which is much
+    cheaper to load than to deepcopy the subgraph for every iterable value.
+    A subgraph which cannot be pickled is deep-copied instead.
+    """
+    nodes = list(subgraph.nodes())
+    position = dict((node, idx) for idx, node in enumerate(nodes))
+    edges = [(position[u], position[v], data)
+             for u, v, data in subgraph.edges(data=True)]
+    try:
+        return pickle.dumps((nodes, edges), pickle.HIGHEST_PROTOCOL)
+    except Exception as e:
+        logger.debug('Cannot pickle the subgraph (%s), falling back to '
+                     'deepcopy', e)
+        return nodes, edges
+
+
+def _clone_subgraph(template):
+    """Returns new copies of the nodes and edges of a subgraph template
+
+    The nodes are in the order of the original subgraph nodes.
+    """
+    if isinstance(template, tuple):
+        nodes, edges = deepcopy(template)
+    else:
+        nodes, edges = pickle.loads(template)
+    return nodes, [(nodes[u], nodes[v], data) for u, v, data in edges]
+
+
 def _merge_graphs(supergraph, nodes, subgraph, nodeid, iterables,
                   prefix, synchronize=False):
     """Merges two graphs that share a subset of nodes.
@@ -482,24 +636,22 @@ def _merge_graphs(supergraph, nodes, subgraph, nodeid, iterables,
     """
     # Retrieve edge information connecting nodes of the subgraph to other
     # nodes of the supergraph.
-    supernodes = supergraph.nodes()
-    ids = [n._hierarchy + n._id for n in supernodes]
-    if len(np.unique(ids)) != len(ids):
+    supernodes = dict((n._hierarchy + n._id, n) for n in supergraph.nodes())
+    if len(supernodes) != supergraph.number_of_nodes():
         # This should trap the problem of miswiring when multiple iterables are
         # used at the same level. The use of the template below for naming
         # updates to nodes is the general solution.
         raise Exception(("Execution graph does not have a unique set of node "
                          "names. Please rerun the workflow"))
-    edgeinfo = {}
-    for n in list(subgraph.nodes()):
-        nidx = ids.index(n._hierarchy + n._id)
-        for edge in supergraph.in_edges(list(supernodes)[nidx]):
-                # make sure edge is not part of subgraph
-            if edge[0] not in subgraph.nodes():
-                if n._hierarchy + n._id not in list(edgeinfo.keys()):
-                    edgeinfo[n._hierarchy + n._id] = []
-                edgeinfo[n._hierarchy + n._id].append((edge[0],
-                                                       supergraph.get_edge_data(*edge)))
+    subnodes = list(subgraph.nodes())
+    # the {subgraph node position: [(source node, edge data)]} dictionary
+    edgeinfo = defaultdict(list)
+    for idx, n in enumerate(subnodes):
+        for edge in supergraph.in_edges(supernodes[n._hierarchy + n._id]):
+            # make sure edge is not part of subgraph
+            if edge[0] not in subgraph:
+                edgeinfo[idx].append((edge[0],
+                                      supergraph.get_edge_data(*edge)))
     supergraph.remove_nodes_from(nodes)
     # Add copies of the subgraph depending on the number of iterables
     iterable_params = expand_iterables(iterables, synchronize)
@@ -509,12 +661,16 @@ def _merge_graphs(supergraph, nodes, subgraph, nodeid, iterables,
     # Make an iterable subgraph node id template
     count = len(iterable_params)
     template = '.%s%%0%dd' % (prefix, np.ceil(np.log10(count)))
+    # The copies share the position of the root node and the levels of the
+    # nodes in the subgraph
+    nodeidx = [n._hierarchy + n._id for n in subnodes].index(nodeid)
+    levels = get_levels(subgraph)
+    levels = [levels[n] for n in subnodes]
+    subgraph_template = _subgraph_template(subgraph)
     # Copy the iterable subgraphs
     for i, params in enumerate(iterable_params):
-        Gc = deepcopy(subgraph)
-        ids = [n._hierarchy + n._id for n in Gc.nodes()]
-        nodeidx = ids.index(nodeid)
-        rootnode = list(Gc.nodes())[nodeidx]
+        Gc_nodes, Gc_edges = _clone_subgraph(subgraph_template)
+        rootnode = Gc_nodes[nodeidx]
         paramstr = ''
         for key, val in sorted(params.items()):
             paramstr = '{}_{}_{}'.format(
@@ -522,8 +678,7 @@ def _merge_graphs(supergraph, nodes, subgraph, nodeid, iterables,
             rootnode.set_input(key, val)
 
         logger.debug('Parameterization: paramstr=%s', paramstr)
-        levels = get_levels(Gc)
-        for n in Gc.nodes():
+        for n, path_length in zip(Gc_nodes, levels):
             """
             update parameterization of the node to reflect the location of
             the output directory.  For example, if the iterables along a
@@ -532,7 +687,6 @@ def _merge_graphs(supergraph, nodes, subgraph, nodeid, iterables,
             with iterable 'b' will be placed in a directory
             _a_aval/_b_bval/.
             """
-            path_length = levels[n]
             # enter as negative numbers so that earlier iterables with longer
             # path lengths get precedence in a sort
             paramlist = [(-path_length, paramstr)]
@@ -540,12 +694,11 @@ def _merge_graphs(supergraph, nodes, subgraph, nodeid, iterables,
                 n.parameterization = paramlist + n.parameterization
             else:
                 n.parameterization = paramlist
-        supergraph.add_nodes_from(Gc.nodes())
-        supergraph.add_edges_from(Gc.edges(data=True))
-        for node in Gc.nodes():
-            if node._hierarchy + node._id in list(edgeinfo.keys()):
-                for info in edgeinfo[node._hierarchy + node._id]:
-                    supergraph.add_edges_from([(info[0], node, info[1])])
+        supergraph.add_nodes_from(Gc_nodes)
+        supergraph.add_edges_from(Gc_edges)
+        for idx, node in enumerate(Gc_nodes):
+            for info in edgeinfo.get(idx, []):
+                supergraph.add_edges_from([(info[0], node, info[1])])
             node._id += template % i
     return supergraph
 
@@ -726,9 +879,8 @@ def generate_expanded_graph(graph_in):
                 src_fields = [src_fields]
             # find the unique iterable source node in the graph
             try:
-                iter_src = next((node for node in graph_in.nodes()
-                                 if node.name == src_name and
-                                 nx.has_path(graph_in, node, inode)))
+                iter_src = next((node for node in _ancestors(graph_in, inode)
+                                 if node.name == src_name))
             except StopIteration:
                 raise ValueError("The node %s itersource %s was not found"
                                  " among the iterable predecessor nodes"
@@ -791,16 +943,17 @@ def generate_expanded_graph(graph_in):
                                  iterables, iterable_prefix, inode.synchronize)
 
         # reconnect the join nodes
+        if jnodes:
+            itername_index = _itername_index(graph_in)
         for jnode in jnodes:
             # the {node id: edge data} dictionary for edges connecting
             # to the join node in the unexpanded graph
             old_edge_dict = jedge_dict[jnode]
             # the edge source node replicates
             expansions = defaultdict(list)
-            for node in graph_in.nodes():
-                for src_id, edge_data in list(old_edge_dict.items()):
-                    if node.itername.startswith(src_id):
-                        expansions[src_id].append(node)
+            for src_id in old_edge_dict:
+                expansions[src_id].extend(_nodes_with_prefix(itername_index,
+                                                             src_id))
             for in_id, in_nodes in list(expansions.items()):
                 logger.debug("The join node %s input %s was expanded"
                              " to %d nodes." % (jnode, in_id, len(in_nodes)))
@@ -863,6 +1016,36 @@ def generate_expanded_graph(graph_in):
     return _remove_nonjoin_identity_nodes(graph_in)
 
 
+def _itername_index(graph):
+    """Returns the iternames of the graph nodes in sorted order, along with
+    the nodes in the same order"""
+    items = sorted(((node.itername, node) for node in graph.nodes()),
+                   key=lambda item: item[0])
+    return [name for name, _ in items], [node for _, node in items]
+
+
+def _nodes_with_prefix(itername_index, prefix):
+    """Returns the nodes of an itername index whose itername starts with
+    the given prefix"""
+    names, nodes = itername_index
+    start = end = bisect_left(names, prefix)
+    while end < len(names) and names[end].startswith(prefix):
+        end += 1
+    return nodes[start:end]
+
+
+def _ancestors(graph, node):
+    """Iterates over the ancestors of a node, closest first"""
+    seen = set([node])
+    queue = deque([node])
+    while queue:
+        for pred in graph.predecessors(queue.popleft()):
+            if pred not in seen:
+                seen.add(pred)
+                queue.append(pred)
+                yield pred
+
+
 def _iterable_nodes(graph_in):
     """Returns the iterable nodes in the given graph and their join
     dependencies.
@@ -1118,10 +1301,70 @@ def walk_outputs(object):
     return out
 
 
-def walk_files(cwd):
-    for path, _, files in os.walk(cwd):
-        for f in files:
-            yield os.path.join(path, f)
+def walk_files(cwd, skip_dir=None):
+    """Yields the paths of the files under cwd, in a single scandir pass
+
+    The directories for which ``skip_dir(path)`` is true are not
+    descended into. Symbolic links to directories are not followed.
+    """
+    if scandir is None:
+        for path, dirs, files in os.walk(cwd):
+            if skip_dir is not None:
+                dirs[:] = [d for d in dirs
+                           if not skip_dir(os.path.join(path, d))]
+            for f in files:
+                yield os.path.join(path, f)
+        return
+    stack = [cwd]
+    while stack:
+        path = stack.pop()
+        try:
+            entries = list(scandir(path))
+        except OSError:
+            continue
+        subdirs = []
+        for entry in entries:
+            fullpath = os.path.join(path, entry.name)
+            if entry.is_dir():
+                if not entry.is_symlink() and \
+                        (skip_dir is None or not skip_dir(fullpath)):
+                    subdirs.append(fullpath)
+            else:
+                yield fullpath
+        stack.extend(reversed(subdirs))
+
+
+def _prefix_index(prefixes):
+    """Returns the sorted prefixes, leaving out the prefixes which extend
+    another one"""
+    index = []
+    for prefix in sorted(set(prefixes)):
+        if not index or not prefix.startswith(index[-1]):
+            index.append(prefix)
+    return index
+
+
+def _has_prefix(index, path):
+    """Tests whether the path starts with one of the prefixes of an index
+
+    Any prefix of the path sorts just before it among the other prefixes.
+    """
+    pos = bisect_right(index, path)
+    return pos > 0 and path.startswith(index[pos - 1])
+
+
+def _remove_files(files):
+    for f in files:
+        try:
+            os.remove(f)
+        except OSError as e:
+            logger.debug('Could not remove %s: %s', f, e)
+
+
+def wait_for_cleanup():
+    """Waits for the files removed in the background to be removed"""
+    while _cleanup_threads:
+        _cleanup_threads.pop().join()
 
 
 def clean_working_directory(outputs, cwd, inputs, needed_outputs, config,
@@ -1145,42 +1388,57 @@ def clean_working_directory(outputs, cwd, inputs, needed_outputs, config,
         inputdict = inputs.get()
         input_files.extend(walk_outputs(inputdict))
         needed_files += [path for path, type in input_files if type == 'f']
+    try:
+        if scandir is None:
+            cwd_names = os.listdir(cwd)
+        else:
+            cwd_names = [entry.name for entry in scandir(cwd)]
+    except OSError:
+        cwd_names = []
     for extra in ['_0x*.json', 'provenance.*', 'pyscript*.m', 'pyjobs*.mat',
                   'command.txt', 'result*.pklz', '_inputs.pklz', '_node.pklz']:
-        needed_files.extend(glob(os.path.join(cwd, extra)))
+        needed_files.extend(os.path.join(cwd, name)
+                            for name in fnmatch.filter(cwd_names, extra))
     if files2keep:
         needed_files.extend(filename_to_list(files2keep))
     needed_dirs = [path for path, type in output_files if type == 'd']
     if dirs2keep:
         needed_dirs.extend(filename_to_list(dirs2keep))
     for extra in ['_nipype', '_report']:
-        needed_dirs.extend(glob(os.path.join(cwd, extra)))
-    temp = []
-    for filename in needed_files:
-        temp.extend(get_related_files(filename))
-    needed_files = temp
+        needed_dirs.extend(os.path.join(cwd, name)
+                           for name in fnmatch.filter(cwd_names, extra))
+    needed_files = set(related for filename in needed_files
+                       for related in get_related_files(filename))
     logger.debug('Needed files: %s' % (';'.join(needed_files)))
     logger.debug('Needed dirs: %s' % (';'.join(needed_dirs)))
     files2remove = []
     if str2bool(config['execution']['remove_unnecessary_outputs']):
-        for f in walk_files(cwd):
-            if f not in needed_files:
-                if len(needed_dirs) == 0:
-                    files2remove.append(f)
-                elif not any([f.startswith(dname) for dname in needed_dirs]):
-                    files2remove.append(f)
+        # the files under a needed directory are all kept
+        dir_index = _prefix_index(needed_dirs)
+        for f in walk_files(cwd, partial(_has_prefix, dir_index)):
+            if f not in needed_files and not _has_prefix(dir_index, f):
+                files2remove.append(f)
     else:
         if not str2bool(config['execution']['keep_inputs']):
             input_files = []
             inputdict = inputs.get()
             input_files.extend(walk_outputs(inputdict))
-            input_files = [path for path, type in input_files if type == 'f']
+            input_files = set(path for path, type in input_files
+                              if type == 'f')
             for f in walk_files(cwd):
                 if f in input_files and f not in needed_files:
                     files2remove.append(f)
     logger.debug('Removing files: %s' % (';'.join(files2remove)))
-    for f in files2remove:
-        os.remove(f)
+    if files2remove and str2bool(config['execution'].get(
+            'background_cleanup', 'false')):
+        # remove the files while the results are saved and sent back
+        thread = threading.Thread(target=_remove_files, args=(files2remove,))
+        thread.start()
+        _cleanup_threads[:] = [t for t in _cleanup_threads if t.is_alive()]
+        _cleanup_threads.append(thread)
+    else:
+        for f in files2remove:
+            os.remove(f)
     for key in outputs.copyable_trait_names():
         if key not in outputs_to_keep:
             setattr(outputs, key, Undefined)
@@ -1235,6 +1493,7 @@ def merge_bundles(g1, g2):
 def write_workflow_prov(graph, filename=None, format='all'):
     """Write W3C PROV Model JSON file
     """
+    from ...utils.provenance import ProvStore, pm, nipype_ns, get_id
     if not filename:
         filename = os.path.join(os.getcwd(), 'workflow_provenance')
 
@@ -1382,20 +1641,21 @@ def topological_sort(graph, depth_first=False):
     if not depth_first:
         return nodesort, None
     logger.debug("Performing depth first search")
-    nodes = []
-    groups = []
-    group = 0
     G = nx.Graph()
     G.add_nodes_from(graph.nodes())
     G.add_edges_from(graph.edges())
-    components = nx.connected_components(G)
-    for desc in components:
-        group += 1
-        indices = []
-        for node in desc:
-            indices.append(nodesort.index(node))
-        nodes.extend(np.array(nodesort)[np.array(indices)[np.argsort(indices)]].tolist())
+    # group the nodes by connected component, keeping the topological order
+    # within each group
+    node_groups = {}
+    for group, desc in enumerate(nx.connected_components(G), 1):
         for node in desc:
-            nodesort.remove(node)
-        groups.extend([group] * len(desc))
+            node_groups[node] = group
+    members = defaultdict(list)
+    for node in nodesort:
+        members[node_groups[node]].append(node)
+    nodes = []
+    groups = []
+    for group in range(1, len(members) + 1):
+        nodes.extend(members[group])
+        groups.extend([group] * len(members[group]))
     return nodes, groups
@@ -21,6 +21,7 @@ from builtins import range, object, str, bytes, open
 from future import standard_library
 standard_library.install_aliases()
 
+from collections import defaultdict
 from datetime import datetime
 
 from copy import deepcopy
@@ -49,13 +50,14 @@ from ...utils.filemanip import (save_json, FileNotFoundError,
                                 copyfiles, fnames_presuffix, loadpkl,
                                 split_filename, load_json, savepkl,
                                 write_rst_header, write_rst_dict,
-                                write_rst_list, to_str)
+                                write_rst_list, to_str, get_directory_index)
 from .utils import (generate_expanded_graph, modify_paths,
                     export_graph, make_output_dir, write_workflow_prov,
                     write_workflow_resources,
                     clean_working_directory, format_dot, topological_sort,
                     get_print_name, merge_dict, evaluate_connect_function,
-                    _write_inputs, format_node)
+                    _write_inputs, format_node, sweep_iterables,
+                    batch_iterables, wait_for_cleanup)
 
 from .base import EngineBase
 from .nodes import Node, MapNode
@@ -553,6 +555,14 @@ connected.
             execution.
         plugin_args : dictionary containing arguments to be sent to plugin
             constructor. see individual plugin doc strings for details.
+
+        Returns
+        -------
+
+        execgraph : the executed graph. With ``expansion_batch_size``, it only
+            holds the nodes of the last batch, as the nodes of the previous
+            batches are released to bound the memory use; their results are
+            in their output directories.
         """
         if plugin is None:
             plugin = config.get('execution', 'plugin')
@@ -578,7 +588,42 @@ connected.
             self.config['execution']['crashdump_dir'] = crash_dir
             del self.config['crashdump_dir']
         logger.info('Workflow %s settings: %s', self.name, to_str(sorted(self.config)))
+        # e.g., the nodes run on their own before the workflow
+        wait_for_cleanup()
+        index = get_directory_index(
+            self.config['execution'].get('directory_index'))
+        if index is not None:
+            # the listings are shared by the grabbers of a run only
+            index.clear()
         self._set_needed_outputs(flatgraph)
+        batch_size = int(self.config['execution'].get(
+            'expansion_batch_size', 0) or 0)
+        sweep = sweep_iterables(flatgraph) if batch_size > 0 else None
+        if sweep is None or len(sweep[1]) <= batch_size:
+            return self._run_flatgraph(runner, flatgraph, plugin, plugin_args,
+                                       updatehash)
+        # Expand and run the largest iterable sweep a batch at a time, so that
+        # only the nodes of the current batch are held in memory
+        node, params = sweep
+        num_batches = (len(params) + batch_size - 1) // batch_size
+        logger.info('Running the %d expansions of %s in %d batches',
+                    len(params), node.fullname, num_batches)
+        node.synchronize = True
+        for batch in range(num_batches):
+            node.iterables = batch_iterables(
+                params[batch * batch_size:(batch + 1) * batch_size])
+            # release the nodes of the previous batch before the expansion
+            execgraph = None
+            execgraph = self._run_flatgraph(runner, flatgraph, plugin,
+                                            plugin_args, updatehash,
+                                            batch=batch)
+        return execgraph
+
+    # PRIVATE API AND FUNCTIONS
+
+    def _run_flatgraph(self, runner, flatgraph, plugin, plugin_args,
+                       updatehash, batch=None):
+        """Expands the flat graph and runs the resulting execution graph"""
         execgraph = generate_expanded_graph(deepcopy(flatgraph))
         for index, node in enumerate(execgraph.nodes()):
             node.config = merge_dict(deepcopy(self.config), node.config)
@@ -589,11 +634,16 @@ connected.
         self._configure_exec_nodes(execgraph)
         if str2bool(self.config['execution']['create_report']):
             self._write_report_info(self.base_dir, self.name, execgraph)
-        runner.run(execgraph, updatehash=updatehash, config=self.config)
+        try:
+            runner.run(execgraph, updatehash=updatehash, config=self.config)
+        finally:
+            # the files removed in the background are gone once run returns
+            wait_for_cleanup()
+        suffix = '' if batch is None else '_batch%d' % batch
         datestr = datetime.utcnow().strftime('%Y%m%dT%H%M%S')
         if str2bool(self.config['execution']['write_provenance']):
             prov_base = op.join(self.base_dir,
-                                'workflow_provenance_%s' % datestr)
+                                'workflow_provenance_%s%s' % (datestr, suffix))
             logger.info('Provenance file prefix: %s' % prov_base)
             write_workflow_prov(execgraph, prov_base, format='all')
 
@@ -601,7 +651,8 @@ connected.
             base_dir = self.base_dir or os.getcwd()
             write_workflow_resources(
                 execgraph,
-                filename=op.join(base_dir, self.name, 'resource_monitor.json')
+                filename=op.join(base_dir, self.name,
+                                 'resource_monitor%s.json' % suffix)
             )
         return execgraph
 
@@ -620,33 +671,31 @@ connected.
                                 '..', '..', 'external', 'd3.js'),
                         op.join(report_dir, 'd3.js'))
         nodes, groups = topological_sort(graph, depth_first=True)
+        # the position of every node in the depth first order
+        position = dict((node, i) for i, node in enumerate(nodes))
+        group_procs = defaultdict(list)
+        for i, gid in enumerate(groups):
+            group_procs[gid].append(i)
+        maxN = max([len(procs) for procs in group_procs.values()] or [0])
+
+        def node_items():
+            for i, node in enumerate(nodes):
+                node_dir = node.output_dir().replace(report_dir, '')
+                yield dict(name='%d_%s' % (i, node.name),
+                           report="%s/_report/report.rst" % node_dir,
+                           result="%s/result_%s.pklz" % (node_dir, node.name),
+                           group=groups[i])
+
         graph_file = op.join(report_dir, 'graph1.json')
-        json_dict = {'nodes': [], 'links': [], 'groups': [], 'maxN': 0}
-        for i, node in enumerate(nodes):
-            report_file = "%s/_report/report.rst" % \
-                          node.output_dir().replace(report_dir, '')
-            result_file = "%s/result_%s.pklz" % \
-                          (node.output_dir().replace(report_dir, ''),
-                           node.name)
-            json_dict['nodes'].append(dict(name='%d_%s' % (i, node.name),
-                                           report=report_file,
-                                           result=result_file,
-                                           group=groups[i]))
-        maxN = 0
-        for gid in np.unique(groups):
-            procs = [i for i, val in enumerate(groups) if val == gid]
-            N = len(procs)
-            if N > maxN:
-                maxN = N
-            json_dict['groups'].append(dict(procs=procs,
-                                            total=N,
-                                            name='Group_%05d' % gid))
-        json_dict['maxN'] = maxN
-        for u, v in graph.in_edges():
-            json_dict['links'].append(dict(source=nodes.index(u),
-                                           target=nodes.index(v),
-                                           value=1))
-        save_json(graph_file, json_dict)
+        json_dict = {
+            'nodes': node_items(),
+            'links': (dict(source=position[u], target=position[v], value=1)
+                      for u, v in graph.in_edges()),
+            'groups': (dict(procs=procs, total=len(procs),
+                            name='Group_%05d' % gid)
+                       for gid, procs in sorted(group_procs.items())),
+            'maxN': maxN}
+        save_json(graph_file, json_dict, stream=True)
         graph_file = op.join(report_dir, 'graph.json')
         # Avoid RuntimeWarning: divide by zero encountered in log10
         num_nodes = len(nodes)
@@ -660,16 +709,16 @@ connected.
             name_parts = u.fullname.split('.')
             # return '.'.join(name_parts[:-1] + [template % i + name_parts[-1]])
             return template % i + name_parts[-1]
-        json_dict = []
-        for i, node in enumerate(nodes):
-            imports = []
-            for u, v in graph.in_edges(nbunch=node):
-                imports.append(getname(u, nodes.index(u)))
-            json_dict.append(dict(name=getname(node, i),
-                                  size=1,
-                                  group=groups[i],
-                                  imports=imports))
-        save_json(graph_file, json_dict)
+
+        def classes():
+            for i, node in enumerate(nodes):
+                imports = [getname(u, position[u])
+                           for u, v in graph.in_edges(nbunch=node)]
+                yield dict(name=getname(node, i),
+                           size=1,
+                           group=groups[i],
+                           imports=imports)
+        save_json(graph_file, classes(), stream=True)
 
     def _set_needed_outputs(self, graph):
         """Initialize node with list of which outputs are needed."""
@@ -19,5 +19,6 @@ from .sgegraph import SGEGraphPlugin
 from .lsf import LSFPlugin
 from .slurm import SLURMPlugin
 from .slurmgraph import SLURMGraphPlugin
+from .pilot import PilotPlugin
 
 from . import  semaphore_singleton
@@ -10,23 +10,40 @@ from copy import deepcopy
 from glob import glob
 import os
 import shutil
+import subprocess
 import sys
+import threading
 from time import sleep, time
 from traceback import format_exc
 
 import numpy as np
-import scipy.sparse as ssp
 
 from ... import logging
 from ...utils.filemanip import loadpkl
 from ...utils.misc import str2bool
+from ...utils.profiler import ResourceStats, interface_key, input_size_bucket
 from ..engine.utils import (nx, dfs_preorder, topological_sort)
 from ..engine import MapNode
-from .tools import report_crash, report_nodes_not_run, create_pyscript
+from .tools import (report_crash, report_nodes_not_run, create_pyscript,
+                    create_bundle_pyscript)
 
 logger = logging.getLogger('workflow')
 
 
+def _extend_array(array, num):
+    """Append ``num`` zeros to a numpy array in amortized O(num)
+
+    The returned array is a view onto a larger buffer, which is reused by
+    subsequent calls while it has room, and doubled in size otherwise.
+    """
+    size = len(array) + num
+    buf = array.base
+    if buf is None or len(buf) < size:
+        buf = np.zeros(max(size, 2 * len(array)), dtype=array.dtype)
+        buf[:len(array)] = array
+    return buf[:size]
+
+
 class PluginBase(object):
     """
     Base class for plugins
@@ -68,8 +85,23 @@ class DistributedPluginBase(PluginBase):
         submitted for execution
     proc_pending: a boolean numpy array (N,) signifying whether a
         process is currently running.
-    depidx: a boolean matrix (NxN) storing the dependency structure accross
-        processes. Process dependencies are derived from each column.
+    dependents: list (N) of lists with the ids of the processes that depend
+        on each process and are still waiting for it to finish.
+    dependencies: list of lists with the ids of the processes each process
+        (of the original graph) depends on, until it finishes.
+    indegree: an integer numpy array (N,) with the number of unfinished
+        dependencies of each process.
+    refcount: an integer numpy array with the number of dependents of each
+        process (of the original graph) that have not consumed its outputs
+        yet, or -1 once its directory has been removed.
+    ready_jobs: set of process ids whose dependencies are all finished and
+        that have not been submitted yet (only when ``event_driven``).
+    resource_stats: a :class:`~nipype.utils.profiler.ResourceStats` store of
+        the resources observed in previous runs (only when the
+        ``resource_stats`` plugin argument is set).
+
+    Arrays are grown in place when MapNodes are expanded (see
+    :func:`_extend_array`), so that appending k subnodes costs O(k).
 
     Combinations of ``proc_done`` and ``proc_pending``
     --------------------------------------------------
@@ -94,14 +126,25 @@ class DistributedPluginBase(PluginBase):
         """
         super(DistributedPluginBase, self).__init__(plugin_args=plugin_args)
         self.procs = None
-        self.depidx = None
-        self.refidx = None
+        self.dependents = None
+        self.dependencies = None
+        self.refcount = None
         self.mapnodes = None
         self.mapnodesubids = None
         self.proc_done = None
         self.proc_pending = None
         self.pending_tasks = []
         self.max_jobs = self.plugin_args.get('max_jobs', np.inf)
+        self.indegree = None
+        self.ready_jobs = None
+        # Event-driven scheduling: keep a set of ready jobs, updated only
+        # when a task finishes, and wake up on task completion instead of
+        # sleeping
+        self._event_driven = str2bool(
+            self.plugin_args.get('event_driven', False))
+        self._wakeup = threading.Event()
+        self.resource_stats = None
+        self._stats_keys = {}
 
     def _prerun_check(self, graph):
         """Stub method to validate/massage graph and nodes before running"""
@@ -117,6 +160,7 @@ class DistributedPluginBase(PluginBase):
         self._config = config
         poll_sleep_secs = float(config['execution']['poll_sleep_duration'])
 
+        self._open_resource_stats()
         self._prerun_check(graph)
         # Generate appropriate structures for worker-manager model
         self._generate_dependency_list(graph)
@@ -128,9 +172,7 @@ class DistributedPluginBase(PluginBase):
         old_progress_stats = None
         old_presub_stats = None
         while not np.all(self.proc_done) or np.any(self.proc_pending):
-            # Check to see if a job is available (jobs without dependencies not run)
-            # See https://github.com/nipy/nipype/pull/2200#discussion_r141605722
-            jobs_ready = np.nonzero(~self.proc_done & (self.depidx.sum(0) == 0))[1]
+            jobs_ready = self._get_ready_jobs()
 
             progress_stats = (len(self.proc_done),
                               np.sum(self.proc_done ^ self.proc_pending),
@@ -160,6 +202,7 @@ class DistributedPluginBase(PluginBase):
                             notrun.append(self._clean_queue(jobid, graph,
                                                             result=result))
                         else:
+                            self._record_resources(jobid, result['result'])
                             self._task_finished_cb(jobid)
                             self._remove_node_dirs()
                         self._clear_task(taskid)
@@ -183,13 +226,132 @@ class DistributedPluginBase(PluginBase):
             elif display_stats:
                 logger.debug('Not submitting (max jobs reached)')
 
-            sleep(poll_sleep_secs)
+            self._wait(poll_sleep_secs)
 
         self._remove_node_dirs()
-        report_nodes_not_run(notrun)
 
-        # close any open resources
+        # close any open resources, also when some nodes failed
         self._postrun_check()
+        if self.resource_stats is not None:
+            self.resource_stats.close()
+            self.resource_stats = None
+        report_nodes_not_run(notrun)
+
+    def _wait(self, timeout):
+        """Block the scheduler loop until the next iteration
+
+        In polling mode this just sleeps ``timeout`` seconds. In event-driven
+        mode, the loop is woken up as soon as a task is signaled finished
+        (see :meth:`_notify_task_done`), and ``timeout`` only bounds the wait
+        for plugins that cannot signal completion and must be polled.
+        """
+        if not self._event_driven:
+            sleep(timeout)
+            return
+        self._wakeup.wait(timeout)
+        self._wakeup.clear()
+
+    def _notify_task_done(self):
+        """Wake up the scheduler loop. Safe to call from any thread."""
+        self._wakeup.set()
+
+    def _get_ready_jobs(self):
+        """Return the (sorted) ids of jobs ready to be submitted
+
+        These are the jobs that have not been submitted yet and have no
+        pending dependencies.
+        """
+        if not self._event_driven:
+            return np.nonzero(~self.proc_done & (self.indegree == 0))[0]
+
+        # Jobs may be flagged as done without being run (e.g., dependents
+        # of a crashed node), drop them lazily
+        self.ready_jobs = set(jobid for jobid in self.ready_jobs
+                              if not self.proc_done[jobid])
+        return np.array(sorted(self.ready_jobs), dtype=int)
+
+    def _requeue_job(self, jobid):
+        """Put back a job that could not be submitted"""
+        self.proc_done[jobid] = False
+        self.proc_pending[jobid] = False
+        if self._event_driven:
+            self.ready_jobs.add(jobid)
+
+    def _open_resource_stats(self):
+        """Open the store of observed resources, if requested
+
+        The ``resource_stats`` plugin argument is either the path to the
+        SQLite database, or ``True`` to use ``resource_stats.sqlite`` in the
+        logging directory.
+        """
+        filename = self.plugin_args.get('resource_stats', False)
+        if filename is True or str(filename).lower() in ('true', 'on', 'yes'):
+            log_dir = self._config['logging']['log_directory']
+            if not os.path.isdir(log_dir):
+                os.makedirs(log_dir)
+            filename = os.path.join(log_dir, 'resource_stats.sqlite')
+        elif not filename or str(filename).lower() in ('false', 'off', 'no'):
+            return
+        logger.debug('Reading resource estimates from %s', filename)
+        self.resource_stats = ResourceStats(filename)
+        self._stats_keys = {}
+
+    def _stats_key(self, jobid):
+        """Interface and input size bucket of a job in the resource store
+
+        The bucket is computed once, from the inputs known when the job is
+        first considered, so that estimates and records use the same key.
+        """
+        if jobid not in self._stats_keys:
+            node = self.procs[jobid]
+            try:
+                key = (interface_key(node), input_size_bucket(node))
+            except Exception:
+                key = (interface_key(node), 0)
+            self._stats_keys[jobid] = key
+        return self._stats_keys[jobid]
+
+    def _resource_estimate(self, jobid):
+        """Resources observed in previous runs for a job, or ``None``
+
+        See :meth:`nipype.utils.profiler.ResourceStats.estimate`.
+        """
+        if self.resource_stats is None:
+            return None
+        return self.resource_stats.estimate(*self._stats_key(jobid))
+
+    def _record_resources(self, jobid, result):
+        """Store the resources used by a successful job"""
+        if self.resource_stats is None:
+            return
+        runtime = getattr(result, 'runtime', None)
+        # MapNodes report a list of runtimes, their subnodes are recorded
+        duration = getattr(runtime, 'duration', None)
+        if duration is None:
+            return
+        cpu_percent = getattr(runtime, 'cpu_percent', None)
+        try:
+            self.resource_stats.record(
+                *self._stats_key(jobid), duration=duration,
+                mem_gb=getattr(runtime, 'mem_peak_gb', None),
+                n_threads=None if cpu_percent is None else cpu_percent / 100)
+        except Exception:
+            logger.debug('Could not record the resources of job %d:\n%s',
+                         jobid, format_exc())
+
+    def _sort_jobs(self, jobids, scheduler='tsort'):
+        """Order the ready jobs for submission
+
+        Topological order, or the longest jobs first if runtimes are known
+        from previous runs (jobs never observed go last).
+        """
+        if self.resource_stats is None:
+            return jobids
+
+        def _key(jobid):
+            estimate = self._resource_estimate(jobid)
+            return (-estimate['duration'] if estimate else 0, jobid)
+        return sorted(jobids, key=_key)
 
     def _get_result(self, taskid):
         raise NotImplementedError
@@ -226,6 +388,8 @@ class DistributedPluginBase(PluginBase):
             jobid = self.mapnodesubids[jobid]
             self.proc_pending[jobid] = False
             self.proc_done[jobid] = True
+        if self._event_driven:
+            self._notify_task_done()
         # remove dependencies from queue
         return self._remove_node_deps(jobid, crashfile, graph)
 
@@ -237,23 +401,19 @@ class DistributedPluginBase(PluginBase):
         numnodes = len(mapnodesubids)
         logger.debug('Adding %d jobs for mapnode %s',
                      numnodes, self.procs[jobid]._id)
-        for i in range(numnodes):
-            self.mapnodesubids[self.depidx.shape[0] + i] = jobid
+        newids = range(len(self.procs), len(self.procs) + numnodes)
+        for subid in newids:
+            self.mapnodesubids[subid] = jobid
         self.procs.extend(mapnodesubids)
-        self.depidx = ssp.vstack((self.depidx,
-                                  ssp.lil_matrix(np.zeros(
-                                      (numnodes, self.depidx.shape[1])))),
-                                 'lil')
-        self.depidx = ssp.hstack((self.depidx,
-                                  ssp.lil_matrix(
-                                      np.zeros((self.depidx.shape[0],
-                                                numnodes)))),
-                                 'lil')
-        self.depidx[-numnodes:, jobid] = 1
-        self.proc_done = np.concatenate((self.proc_done,
-                                         np.zeros(numnodes, dtype=bool)))
-        self.proc_pending = np.concatenate((self.proc_pending,
-                                            np.zeros(numnodes, dtype=bool)))
+        # The subnodes have no dependencies and the mapnode waits for them
+        self.dependents.extend([jobid] for _ in newids)
+        self.proc_done = _extend_array(self.proc_done, numnodes)
+        self.proc_pending = _extend_array(self.proc_pending, numnodes)
+        self.indegree = _extend_array(self.indegree, numnodes)
+        self.indegree[jobid] += numnodes
+        if self._event_driven:
+            self.ready_jobs.discard(jobid)
+            self.ready_jobs.update(newids)
         return False
 
     def _send_procs_to_workers(self, updatehash=False, graph=None):
@@ -272,12 +432,11 @@ class DistributedPluginBase(PluginBase):
                 break
 
             # Check to see if a job is available (jobs without dependencies not run)
-            # See https://github.com/nipy/nipype/pull/2200#discussion_r141605722
-            jobids = np.nonzero(~self.proc_done & (self.depidx.sum(0) == 0))[1]
+            jobids = self._sort_jobs(self._get_ready_jobs())
 
             if len(jobids) > 0:
                 # send all available jobs
-                logger.info('Pending[%d] Submitting[%d] jobs Slots[%d]',
+                logger.info('Pending[%d] Submitting[%d] jobs Slots[%s]',
                             num_jobs, len(jobids[:slots]), slots or 'inf')
 
                 for jobid in jobids[:slots]:
@@ -306,17 +465,18 @@ class DistributedPluginBase(PluginBase):
                             logger.debug('Running node %s on master thread' %
                                          self.procs[jobid])
                             try:
-                                self.procs[jobid].run()
+                                result = self.procs[jobid].run()
                             except Exception:
                                 self._clean_queue(jobid, graph)
+                            else:
+                                self._record_resources(jobid, result)
                             self._task_finished_cb(jobid)
                             self._remove_node_dirs()
                         else:
                             tid = self._submit_job(deepcopy(self.procs[jobid]),
                                                    updatehash=updatehash)
                             if tid is None:
-                                self.proc_done[jobid] = False
-                                self.proc_pending[jobid] = False
+                                self._requeue_job(jobid)
                             else:
                                 self.pending_tasks.insert(0, (tid, jobid))
                     logger.info('Finished submitting: %s ID: %d' %
@@ -361,26 +521,37 @@ class DistributedPluginBase(PluginBase):
         # Update job and worker queues
         self.proc_pending[jobid] = False
         # update the job dependency structure
-        rowview = self.depidx.getrowview(jobid)
-        rowview[rowview.nonzero()] = 0
+        children, self.dependents[jobid] = self.dependents[jobid], []
+        for child in children:
+            self.indegree[child] -= 1
+            if self._event_driven and self.indegree[child] == 0:
+                self.ready_jobs.add(child)
         if jobid not in self.mapnodesubids:
-            self.refidx[self.refidx[:, jobid].nonzero()[0], jobid] = 0
+            parents, self.dependencies[jobid] = self.dependencies[jobid], []
+            for parent in parents:
+                self.refcount[parent] -= 1
+        if self._event_driven:
+            self._notify_task_done()
 
     def _generate_dependency_list(self, graph):
         """ Generates a dependency list for a list of graphs.
         """
         self.procs, _ = topological_sort(graph)
-        try:
-            self.depidx = nx.to_scipy_sparse_matrix(graph,
-                                                    nodelist=self.procs,
-                                                    format='lil')
-        except:
-            self.depidx = nx.to_scipy_sparse_matrix(graph,
-                                                    nodelist=self.procs)
-        self.refidx = deepcopy(self.depidx)
-        self.refidx.astype = np.int
+        jobids = dict((node, jobid) for jobid, node in enumerate(self.procs))
+        self.dependents = [[jobids[child] for child in graph.successors(node)]
+                           for node in self.procs]
+        self.dependencies = [[jobids[parent]
+                              for parent in graph.predecessors(node)]
+                             for node in self.procs]
+        self.refcount = np.array([len(children)
+                                  for children in self.dependents], dtype=int)
+        self.indegree = np.array([len(parents)
+                                  for parents in self.dependencies], dtype=int)
         self.proc_done = np.zeros(len(self.procs), dtype=bool)
         self.proc_pending = np.zeros(len(self.procs), dtype=bool)
+        if self._event_driven:
+            self.ready_jobs = set(np.nonzero(self.indegree == 0)[0])
+            self._wakeup.clear()
 
     def _remove_node_deps(self, jobid, crashfile, graph):
         subnodes = [s for s in dfs_preorder(graph, self.procs[jobid])]
@@ -396,12 +567,9 @@ class DistributedPluginBase(PluginBase):
         """Removes directories whose outputs have already been used up
         """
         if str2bool(self._config['execution']['remove_node_directories']):
-            for idx in np.nonzero(
-                                 (self.refidx.sum(axis=1) == 0).__array__())[0]:
-                if idx in self.mapnodesubids:
-                    continue
+            for idx in np.nonzero(self.refcount == 0)[0]:
                 if self.proc_done[idx] and (not self.proc_pending[idx]):
-                    self.refidx[idx, idx] = -1
+                    self.refcount[idx] = -1
                     outdir = self.procs[idx]._output_directory()
                     logger.info(('[node dependencies finished] '
                                  'removing node: %s from directory %s') %
@@ -411,12 +579,32 @@ class DistributedPluginBase(PluginBase):
 
 class SGELikeBatchManagerBase(DistributedPluginBase):
     """Execute workflow with SGE/OGE/PBS like batch system
+
+    The status of the pending tasks is queried at once for all of them, at
+    most once per ``status_interval`` seconds (the ``poll_sleep_duration``
+    by default). The batch script of each task also notifies its completion
+    in the ``finished`` subdirectory of the batch directory, which is
+    listed once per polling round, so that the completed tasks are collected
+    without waiting for the next status query. While the status query fails,
+    the tasks are considered pending, until ``max_status_failures`` (10)
+    queries in a row have failed.
+
+    With ``bundle_size`` larger than 1, the nodes submitted within a polling
+    round are grouped by resource class (number of processors, memory and
+    node plugin_args), and up to ``bundle_size`` nodes of a group are run
+    by a single batch job, sequentially or in a pool of ``bundle_procs``
+    processes. Each bundled node gets its own (negative) taskid, and its
+    results are collected as soon as its completion is notified. The nodes
+    of a bundle share an interpreter: each node script loads the
+    configuration of its node into the global config, and the global state
+    left by a node (config, logging, environment) is seen by the next ones.
     """
 
     def __init__(self, template, plugin_args=None):
         super(SGELikeBatchManagerBase, self).__init__(plugin_args=plugin_args)
         self._template = template
         self._qsub_args = None
+        self._status_interval = None
         if plugin_args:
             if 'template' in plugin_args:
                 self._template = plugin_args['template']
@@ -425,12 +613,103 @@ class SGELikeBatchManagerBase(DistributedPluginBase):
                         self._template = tpl_file.read()
             if 'qsub_args' in plugin_args:
                 self._qsub_args = plugin_args['qsub_args']
+            self._status_interval = plugin_args.get('status_interval')
+        self._bundle_size = int(self.plugin_args.get('bundle_size', 1))
+        self._bundle_procs = int(self.plugin_args.get('bundle_procs', 1))
+        self._max_status_failures = int(
+            self.plugin_args.get('max_status_failures', 10))
+        self._status_failures = 0
         self._pending = {}
+        # {resource class: [(taskid, node, pyscript), ...]} waiting for
+        # submission, and {taskid: taskid of the batch job} once submitted
+        self._bundles = {}
+        self._bundled = {}
+        self._bundle_count = 0
+        # {taskid: completion notification file}
+        self._notifications = {}
+        # the (query time, queried taskids, pending taskids) of the last
+        # status query
+        self._status = None
+        # {directory: (listing time, file names)}
+        self._listings = {}
+
+    def _get_status_interval(self):
+        if self._status_interval is not None:
+            return float(self._status_interval)
+        return float(self._config['execution']['poll_sleep_duration'])
+
+    def _query_pending(self, taskids):
+        """Query the batch system for the tasks which are still queued or
+        running, among the given ones
+
+        Implementations issue a single query for all of the tasks, and return
+        the set of pending taskids.
+        """
+        raise NotImplementedError
+
+    def _run_status_command(self, args):
+        """Run a status query command and return its standard output
+
+        Raises a :class:`RuntimeError` if the command fails, as its output
+        then tells nothing about the jobs.
+        """
+        proc = subprocess.Popen(args, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        stdout, stderr = proc.communicate()
+        if proc.returncode:
+            raise RuntimeError('%s exited with code %d: %s' % (
+                ' '.join(args), proc.returncode,
+                stderr.decode('utf-8', 'replace').strip()))
+        return stdout.decode('utf-8', 'replace')
 
     def _is_pending(self, taskid):
         """Check if a task is pending in the batch system
+
+        The answer comes from the last query of all the pending tasks, which
+        is refreshed once it is older than the status interval, or when it
+        does not cover the task yet.
         """
-        raise NotImplementedError
+        now = time()
+        if (self._status is None or taskid not in self._status[1] or
+                now - self._status[0] >= self._get_status_interval()):
+            # the bundled nodes are pending with their batch job
+            taskids = list(set(self._bundled.get(pending, pending)
+                               for pending in self._pending))
+            try:
+                pending = self._query_pending(taskids)
+                self._status_failures = 0
+            except (OSError, RuntimeError, ValueError) as exc:
+                # a transient failure of the batch system must not make
+                # the running jobs look finished, but a lasting one must not
+                # keep the run waiting forever
+                self._status_failures += 1
+                if self._status_failures >= self._max_status_failures:
+                    raise RuntimeError(
+                        'Could not query the status of the jobs %d times in '
+                        'a row: %s' % (self._status_failures, exc))
+                logger.warning('Could not query the status of the jobs, '
+                               'considering them pending: %s', exc)
+                pending = set(taskids)
+            self._status = (now, set(taskids), pending)
+        return taskid in self._status[2]
+
+    def _is_notified(self, taskid):
+        """Check if the batch script of a task notified its completion"""
+        notification = self._notifications.get(taskid)
+        if notification is None:
+            return False
+        dirname, name = os.path.split(notification)
+        now = time()
+        stamp, names = self._listings.get(dirname, (None, None))
+        # a single listing answers for all the tasks of a polling round
+        poll_sleep = float(self._config['execution']['poll_sleep_duration'])
+        if stamp is None or now - stamp >= poll_sleep:
+            try:
+                names = set(os.listdir(dirname))
+            except OSError:
+                names = set()
+            self._listings[dirname] = (now, names)
+        return name in names
 
     def _submit_batchtask(self, scriptfile, node):
         """Submit a task to the batch system
@@ -440,7 +719,8 @@ class SGELikeBatchManagerBase(DistributedPluginBase):
     def _get_result(self, taskid):
         if taskid not in self._pending:
             raise Exception('Task %d not found' % taskid)
-        if self._is_pending(taskid):
+        if not self._is_notified(taskid) and \
+                self._is_pending(self._bundled.get(taskid, taskid)):
             return None
         node_dir = self._pending[taskid]
         # MIT HACK
@@ -451,14 +731,17 @@ class SGELikeBatchManagerBase(DistributedPluginBase):
         t = time()
         timeout = float(self._config['execution']['job_finished_timeout'])
         timed_out = True
-        while (time() - t) < timeout:
-            try:
-                glob(os.path.join(node_dir, 'result_*.pklz')).pop()
+        delay = 0.1
+        while True:
+            results_files = glob(os.path.join(node_dir, 'result_*.pklz'))
+            if results_files:
                 timed_out = False
                 break
-            except Exception as e:
-                logger.debug(e)
-            sleep(2)
+            if (time() - t) >= timeout:
+                break
+            # poll quickly first, as the results are usually written already
+            sleep(delay)
+            delay = min(2 * delay, 2)
         if timed_out:
             result_data = {'hostname': 'unknown',
                            'result': None,
@@ -475,7 +758,7 @@ class SGELikeBatchManagerBase(DistributedPluginBase):
             except IOError as e:
                 result_data['traceback'] = format_exc()
         else:
-            results_file = glob(os.path.join(node_dir, 'result_*.pklz'))[0]
+            results_file = results_files[0]
             result_data = loadpkl(results_file)
         result_out = dict(result=None, traceback=None)
         if isinstance(result_data, dict):
@@ -495,15 +778,78 @@ class SGELikeBatchManagerBase(DistributedPluginBase):
         pyscript = create_pyscript(node, updatehash=updatehash)
         batch_dir, name = os.path.split(pyscript)
         name = '.'.join(name.split('.')[:-1])
+        notification = os.path.join(batch_dir, 'finished', name)
+        if not os.path.isdir(os.path.dirname(notification)):
+            os.makedirs(os.path.dirname(notification))
+        elif os.path.exists(notification):
+            os.remove(notification)
+        listing = self._listings.get(os.path.dirname(notification))
+        if listing is not None:
+            listing[1].discard(name)
+        if self._bundle_size > 1:
+            self._bundle_count += 1
+            taskid = -self._bundle_count
+            self._pending[taskid] = node.output_dir()
+            self._notifications[taskid] = notification
+            bundle = self._bundles.setdefault(self._resource_class(node), [])
+            bundle.append((taskid, node, pyscript))
+            if len(bundle) >= self._bundle_size:
+                self._submit_bundle(self._resource_class(node))
+            return taskid
+        batchscript = '\n'.join((self._template,
+                                 '%s %s' % (sys.executable, pyscript),
+                                 'touch %s' % notification))
+        batchscriptfile = os.path.join(batch_dir, 'batchscript_%s.sh' % name)
+        with open(batchscriptfile, 'wt') as fp:
+            fp.writelines(batchscript)
+        taskid = self._submit_batchtask(batchscriptfile, node)
+        self._notifications[taskid] = notification
+        return taskid
+
+    def _resource_class(self, node):
+        """Nodes of the same class can be bundled in a batch job"""
+        return (node.n_procs, node.mem_gb,
+                repr(sorted(node.plugin_args.items())))
+
+    def _submit_bundle(self, resource_class):
+        """Submit the nodes of a resource class as a single batch job"""
+        bundle = self._bundles.pop(resource_class)
+        taskids, nodes, pyscripts = zip(*bundle)
+        bundlescript = create_bundle_pyscript(
+            pyscripts, [self._notifications[taskid] for taskid in taskids],
+            n_procs=min(self._bundle_procs, len(bundle)))
+        batch_dir, name = os.path.split(bundlescript)
+        name = '.'.join(name.split('.')[:-1])
         batchscript = '\n'.join((self._template,
-                                 '%s %s' % (sys.executable, pyscript)))
+                                 '%s %s' % (sys.executable, bundlescript)))
         batchscriptfile = os.path.join(batch_dir, 'batchscript_%s.sh' % name)
         with open(batchscriptfile, 'wt') as fp:
             fp.writelines(batchscript)
-        return self._submit_batchtask(batchscriptfile, node)
+        # the batch job is submitted on behalf of the first node, but only
+        # the bundled nodes are pending
+        jobid = self._submit_batchtask(batchscriptfile, nodes[0])
+        if jobid is None:
+            # the nodes were handed over already, and cannot be requeued
+            raise RuntimeError('Could not submit the batch job of %d bundled '
+                               'nodes (%s)' % (len(bundle), batchscriptfile))
+        self._pending.pop(jobid, None)
+        logger.debug('Bundled %d nodes in batch job %s', len(bundle), jobid)
+        for taskid in taskids:
+            self._bundled[taskid] = jobid
+
+    def _send_procs_to_workers(self, updatehash=False, graph=None):
+        super(SGELikeBatchManagerBase, self)._send_procs_to_workers(
+            updatehash=updatehash, graph=graph)
+        # submit the incomplete bundles at the end of each round
+        for resource_class in list(self._bundles):
+            self._submit_bundle(resource_class)
 
     def _clear_task(self, taskid):
         del self._pending[taskid]
+        self._bundled.pop(taskid, None)
+        notification = self._notifications.pop(taskid, None)
+        if notification is not None and os.path.exists(notification):
+            os.remove(notification)
 
 
 class GraphPluginBase(PluginBase):
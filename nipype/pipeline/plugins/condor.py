@@ -46,19 +46,18 @@ class CondorPlugin(SGELikeBatchManagerBase):
                 self._max_tries = kwargs['plugin_args']['max_tries']
         super(CondorPlugin, self).__init__(template, **kwargs)
 
-    def _is_pending(self, taskid):
-        cmd = CommandLine('condor_q',
-                          resource_monitor=False,
-                          terminal_output='allatonce')
-        cmd.inputs.args = '%d' % taskid
-        # check condor cluster
-        oldlevel = iflogger.level
-        iflogger.setLevel(logging.getLevelName('CRITICAL'))
-        result = cmd.run(ignore_exception=True)
-        iflogger.setLevel(oldlevel)
-        if result.runtime.stdout.count('\n%d' % taskid):
-            return True
-        return False
+    def _query_pending(self, taskids):
+        # condor_q lists the cluster id and status of the jobs of the user,
+        # whatever its default layout; removed (3) and completed (4) jobs may
+        # stay listed for a while
+        stdout = self._run_status_command(
+            ['condor_q', '-af', 'ClusterId', 'JobStatus'])
+        queued = set()
+        for line in stdout.splitlines():
+            fields = line.split()
+            if len(fields) == 2 and fields[1] not in ('3', '4'):
+                queued.add(fields[0])
+        return set(taskid for taskid in taskids if str(taskid) in queued)
 
     def _submit_batchtask(self, scriptfile, node):
         cmd = CommandLine('condor_qsub', environ=dict(os.environ),
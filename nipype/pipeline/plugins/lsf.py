@@ -41,25 +41,19 @@ class LSFPlugin(SGELikeBatchManagerBase):
                 self._bsub_args = kwargs['plugin_args']['bsub_args']
         super(LSFPlugin, self).__init__(template, **kwargs)
 
-    def _is_pending(self, taskid):
+    def _query_pending(self, taskids):
         """LSF lists a status of 'PEND' when a job has been submitted but is waiting to be picked up,
         and 'RUN' when it is actively being processed. But _is_pending should return True until a job has
-        finished and is ready to be checked for completeness. So return True if status is either 'PEND'
-        or 'RUN'"""
-        cmd = CommandLine('bjobs',
-                          resource_monitor=False,
-                          terminal_output='allatonce')
-        cmd.inputs.args = '%d' % taskid
-        # check lsf task
-        oldlevel = iflogger.level
-        iflogger.setLevel(logging.getLevelName('CRITICAL'))
-        result = cmd.run(ignore_exception=True)
-        iflogger.setLevel(oldlevel)
-        # logger.debug(result.runtime.stdout)
-        if 'DONE' in result.runtime.stdout or 'EXIT' in result.runtime.stdout:
-            return False
-        else:
-            return True
+        finished and is ready to be checked for completeness. So the jobs are pending unless their
+        status is 'DONE' or 'EXIT'"""
+        # bjobs -a -w lists all the recent jobs as "JOBID USER STAT ..."
+        stdout = self._run_status_command(['bjobs', '-a', '-w'])
+        queued = set()
+        for line in stdout.splitlines():
+            fields = line.split()
+            if len(fields) > 2 and fields[2] not in ('DONE', 'EXIT'):
+                queued.add(fields[0])
+        return set(taskid for taskid in taskids if str(taskid) in queued)
 
     def _submit_batchtask(self, scriptfile, node):
         cmd = CommandLine('bsub', environ=dict(os.environ),
@@ -11,12 +11,15 @@ from __future__ import print_function, division, unicode_literals, absolute_impo
 # Import packages
 from multiprocessing import Process, Pool, cpu_count, pool
 from traceback import format_exception
+from time import time
+import pickle
 import sys
 
 from copy import deepcopy
 import numpy as np
 
 from ... import logging
+from ...utils.misc import str2bool
 from ...utils.profiler import get_system_total_memory_gb
 from ..engine import MapNode
 from .base import DistributedPluginBase
@@ -53,10 +56,41 @@ def run_node(node, updatehash, taskid):
         result['traceback'] = format_exception(*sys.exc_info())
         result['result'] = node.result
 
-    # Return the result dictionary
+    # Send the runtime record of the results file back to the master
+    node._compact_result(result['result'])
     return result
 
 
+def run_job(job, updatehash, taskid):
+    """Rehydrate a node from a compact job descriptor and run it
+
+    Parameters
+    ----------
+    job : tuple
+        ``(config, node)`` pair of pickled objects, as generated by
+        :meth:`MultiProcPlugin._make_job`
+    updatehash : boolean
+        flag for updating hash
+
+    Returns
+    -------
+    result : dictionary
+        dictionary containing the node runtime results and stats
+    """
+    try:
+        config, node = job
+        node = pickle.loads(node)
+        node.config = pickle.loads(config)
+    except:
+        return dict(result=None, taskid=taskid,
+                    traceback=format_exception(*sys.exc_info()))
+
+    # Don't allow streaming outputs
+    if getattr(node.interface, 'terminal_output', '') == 'stream':
+        node.interface.terminal_output = 'allatonce'
+    return run_node(node, updatehash, taskid)
+
+
 class NonDaemonProcess(Process):
     """A non-daemon process to support internal multiprocessing.
     """
@@ -102,11 +136,30 @@ class MultiProcPlugin(DistributedPluginBase):
     - raise_insufficient: raise error if the requested resources for
         a node over the maximum `n_procs` and/or `memory_gb`
         (default is ``True``).
-    - scheduler: sort jobs topologically (``'tsort'``, default value)
-        or prioritize jobs by, first, memory consumption and, second,
-        number of threads (``'mem_thread'`` option).
+    - scheduler: sort jobs topologically (``'tsort'``, default value),
+        prioritize jobs by, first, memory consumption and, second,
+        number of threads (``'mem_thread'`` option), or prioritize the
+        jobs on the critical path of the graph and backfill the
+        remaining resources (``'critical_path'``, see
+        :meth:`_sort_jobs` and :meth:`_can_backfill`).
     - maxtasksperchild: number of nodes to run on each process before
-        refreshing the worker (default: 10).
+        refreshing the worker (default: 10, or ``None`` when
+        ``job_descriptors`` is set, so that workers are kept alive
+        for the whole run).
+    - job_descriptors: instead of deep-copying each node and sending it
+        through the pool, pickle it only once and send a compact job
+        descriptor that the workers rehydrate (default: ``False``). The
+        configuration, which is shared by most nodes, is serialized once
+        per run.
+    - event_driven: track ready jobs incrementally and wake up as soon as
+        a task finishes, instead of polling every ``poll_sleep_duration``
+        seconds (default: ``False``).
+    - resource_stats: path to a database of the runtime, memory and
+        threads observed for each interface (or ``True`` to keep it in the
+        logging directory). Observations are recorded after each job, and
+        used to order jobs and to pack them by their actual consumption
+        instead of the declared ``mem_gb`` and ``n_procs`` (default:
+        ``False``, see :class:`~nipype.utils.profiler.ResourceStats`).
 
     """
 
@@ -116,30 +169,45 @@ class MultiProcPlugin(DistributedPluginBase):
         self._taskresult = {}
         self._task_obj = {}
         self._taskid = 0
+        self._config_blobs = {}
+        self._priority = None
+        self._job_start = {}
+        self._runtime_stats = [0.0, 0]  # total runtime, number of jobs
 
         # Read in options or set defaults.
         non_daemon = self.plugin_args.get('non_daemon', True)
-        maxtasks = self.plugin_args.get('maxtasksperchild', 10)
+        self._job_descriptors = str2bool(
+            self.plugin_args.get('job_descriptors', False))
+        maxtasks = self.plugin_args.get(
+            'maxtasksperchild', None if self._job_descriptors else 10)
         self.processors = self.plugin_args.get('n_procs', cpu_count())
         self.memory_gb = self.plugin_args.get('memory_gb',  # Allocate 90% of system memory
                                               get_system_total_memory_gb() * 0.9)
         self.raise_insufficient = self.plugin_args.get('raise_insufficient', True)
+        self._scheduler = self.plugin_args.get('scheduler', 'tsort')
 
         # Instantiate different thread pools for non-daemon processes
         logger.debug('MultiProcPlugin starting in "%sdaemon" mode (n_procs=%d, mem_gb=%0.2f)',
                      'non' * int(non_daemon), self.processors, self.memory_gb)
+        self._pool_args = (non_daemon, maxtasks)
+        self.pool = self._create_pool(non_daemon, maxtasks)
+
+        self._stats = None
 
+    def _create_pool(self, non_daemon, maxtasks):
         NipypePool = NonDaemonPool if non_daemon else Pool
         try:
-            self.pool = NipypePool(processes=self.processors,
-                                   maxtasksperchild=maxtasks)
+            return NipypePool(processes=self.processors,
+                              maxtasksperchild=maxtasks)
         except TypeError:
-            self.pool = NipypePool(processes=self.processors)
+            return NipypePool(processes=self.processors)
 
-        self._stats = None
+    def _now(self):
+        return time()
 
     def _async_callback(self, args):
         self._taskresult[args['taskid']] = args
+        self._notify_task_done()
 
     def _get_result(self, taskid):
         return self._taskresult.get(taskid)
@@ -147,16 +215,46 @@ class MultiProcPlugin(DistributedPluginBase):
     def _clear_task(self, taskid):
         del self._task_obj[taskid]
 
+    def _make_job(self, node):
+        """Serialize a node into a compact job descriptor
+
+        The node is pickled without its configuration, which is usually
+        identical across nodes and is serialized only once.
+        """
+        config = node.config
+        try:
+            key = tuple((section, tuple(sorted(options.items())))
+                        for section, options in sorted(config.items()))
+            hash(key)
+        except (AttributeError, TypeError):
+            key = None
+        config_blob = self._config_blobs.get(key)
+        if config_blob is None:
+            config_blob = pickle.dumps(config, pickle.HIGHEST_PROTOCOL)
+            if key is not None:
+                self._config_blobs[key] = config_blob
+
+        node.config = None
+        try:
+            node_blob = pickle.dumps(node, pickle.HIGHEST_PROTOCOL)
+        finally:
+            node.config = config
+        return config_blob, node_blob
+
     def _submit_job(self, node, updatehash=False):
         self._taskid += 1
 
-        # Don't allow streaming outputs
-        if getattr(node.interface, 'terminal_output', '') == 'stream':
-            node.interface.terminal_output = 'allatonce'
+        if self._job_descriptors:
+            func, args = run_job, (self._make_job(node), updatehash,
+                                   self._taskid)
+        else:
+            # Don't allow streaming outputs
+            if getattr(node.interface, 'terminal_output', '') == 'stream':
+                node.interface.terminal_output = 'allatonce'
+            func, args = run_node, (node, updatehash, self._taskid)
 
         self._task_obj[self._taskid] = self.pool.apply_async(
-            run_node, (node, updatehash, self._taskid),
-            callback=self._async_callback)
+            func, args, callback=self._async_callback)
 
         logger.debug('MultiProc submitted task %s (taskid=%d).',
                      node.fullname, self._taskid)
@@ -164,6 +262,9 @@ class MultiProcPlugin(DistributedPluginBase):
 
     def _prerun_check(self, graph):
         """Check if any node exeeds the available resources"""
+        if self.pool is None:
+            # the pool of a previous run was closed
+            self.pool = self._create_pool(*self._pool_args)
         tasks_mem_gb = []
         tasks_num_th = []
         for node in graph.nodes():
@@ -186,6 +287,7 @@ class MultiProcPlugin(DistributedPluginBase):
 
     def _postrun_check(self):
         self.pool.close()
+        self.pool = None
 
     def _check_resources(self, running_tasks):
         """
@@ -194,8 +296,9 @@ class MultiProcPlugin(DistributedPluginBase):
         free_memory_gb = self.memory_gb
         free_processors = self.processors
         for _, jobid in running_tasks:
-            free_memory_gb -= min(self.procs[jobid].mem_gb, free_memory_gb)
-            free_processors -= min(self.procs[jobid].n_procs, free_processors)
+            job_gb, job_th = self._job_resources(jobid)
+            free_memory_gb -= min(job_gb, free_memory_gb)
+            free_processors -= min(job_th, free_processors)
 
         return free_memory_gb, free_processors
 
@@ -205,8 +308,7 @@ class MultiProcPlugin(DistributedPluginBase):
         """
 
         # Check to see if a job is available (jobs without dependencies not run)
-        # See https://github.com/nipy/nipype/pull/2200#discussion_r141605722
-        jobids = np.nonzero(~self.proc_done & (self.depidx.sum(0) == 0))[1]
+        jobids = self._get_ready_jobs()
 
         # Check available system resources by summing all threads and memory used
         free_memory_gb, free_processors = self._check_resources(self.pending_tasks)
@@ -228,7 +330,9 @@ class MultiProcPlugin(DistributedPluginBase):
                          'be submitted to the queue. Potential deadlock')
             return
 
-        jobids = self._sort_jobs(jobids, scheduler=self.plugin_args.get('scheduler'))
+        jobids = self._sort_jobs(jobids, scheduler=self._scheduler)
+        # Resources of the first job that could not be allocated (critical_path)
+        reservation = None
 
         # Submit jobs
         for jobid in jobids:
@@ -250,13 +354,21 @@ class MultiProcPlugin(DistributedPluginBase):
                         continue
 
             # Check requirements of this job
-            next_job_gb = min(self.procs[jobid].mem_gb, self.memory_gb)
-            next_job_th = min(self.procs[jobid].n_procs, self.processors)
+            next_job_gb, next_job_th = self._job_resources(jobid)
 
             # If node does not fit, skip at this moment
             if next_job_th > free_processors or next_job_gb > free_memory_gb:
                 logger.debug('Cannot allocate job %d (%0.2fGB, %d threads).',
                              jobid, next_job_gb, next_job_th)
+                if self._scheduler == 'critical_path' and reservation is None:
+                    reservation = self._reserve(next_job_gb, next_job_th,
+                                                free_memory_gb, free_processors)
+                continue
+
+            if reservation is not None and not self._can_backfill(
+                    jobid, next_job_gb, next_job_th, reservation):
+                logger.debug('Not backfilling job %d (%0.2fGB, %d threads).',
+                             jobid, next_job_gb, next_job_th)
                 continue
 
             free_memory_gb -= next_job_gb
@@ -277,13 +389,15 @@ class MultiProcPlugin(DistributedPluginBase):
                 logger.debug('Running node %s on master thread',
                              self.procs[jobid])
                 try:
-                    self.procs[jobid].run(updatehash=updatehash)
+                    result = self.procs[jobid].run(updatehash=updatehash)
                 except Exception:
                     traceback = format_exception(*sys.exc_info())
                     self._clean_queue(
                         jobid, graph,
                         result={'result': None, 'traceback': traceback}
                     )
+                else:
+                    self._record_resources(jobid, result)
 
                 # Release resources
                 self._task_finished_cb(jobid)
@@ -298,18 +412,131 @@ class MultiProcPlugin(DistributedPluginBase):
             # Send job to task manager and add to pending tasks
             if self._status_callback:
                 self._status_callback(self.procs[jobid], 'start')
-            tid = self._submit_job(deepcopy(self.procs[jobid]),
-                                   updatehash=updatehash)
+            # Job descriptors are pickled right away, no need to copy
+            node = self.procs[jobid]
+            if not self._job_descriptors:
+                node = deepcopy(node)
+            tid = self._submit_job(node, updatehash=updatehash)
             if tid is None:
-                self.proc_done[jobid] = False
-                self.proc_pending[jobid] = False
+                self._requeue_job(jobid)
             else:
+                self._job_start[jobid] = self._now()
                 self.pending_tasks.insert(0, (tid, jobid))
             # Display stats next loop
             self._stats = None
 
+    def _task_finished_cb(self, jobid):
+        start = self._job_start.pop(jobid, None)
+        if start is not None:
+            self._runtime_stats[0] += self._now() - start
+            self._runtime_stats[1] += 1
+        super(MultiProcPlugin, self)._task_finished_cb(jobid)
+
+    def _generate_dependency_list(self, graph):
+        super(MultiProcPlugin, self)._generate_dependency_list(graph)
+        if self._scheduler == 'critical_path':
+            self._priority = self._critical_path_lengths()
+
+    def _critical_path_lengths(self):
+        """Length of the longest path from each job to a sink
+
+        Counted in number of nodes, or in expected runtime if runtimes are
+        known from previous runs. Computed in reverse topological
+        order, O(N + E).
+        """
+        if self.resource_stats is None:
+            weights = np.ones(len(self.procs))
+        else:
+            weights = np.array([self._estimate_runtime(jobid)
+                                for jobid in range(len(self.procs))])
+        lengths = weights.copy()
+        for jobid in range(len(self.procs) - 1, -1, -1):
+            for child in self.dependents[jobid]:
+                lengths[jobid] = max(lengths[jobid],
+                                     lengths[child] + weights[jobid])
+        return lengths
+
     def _sort_jobs(self, jobids, scheduler='tsort'):
         if scheduler == 'mem_thread':
-            return sorted(jobids, key=lambda item: (
-                self.procs[item].mem_gb, self.procs[item].n_procs))
-        return jobids
+            return sorted(jobids, key=self._job_resources)
+        if scheduler == 'critical_path':
+            # Longest path to the end of the graph first, then the most
+            # demanding jobs, which are the hardest to fit later on.
+            # MapNode subnodes inherit the priority of their MapNode.
+            def _key(jobid):
+                job_gb, job_th = self._job_resources(jobid)
+                priority = self._priority[
+                    self.mapnodesubids.get(jobid, jobid)]
+                return (-priority, -job_th, -job_gb, jobid)
+            return sorted(jobids, key=_key)
+        return super(MultiProcPlugin, self)._sort_jobs(jobids)
+
+    def _job_resources(self, jobid):
+        """Memory (GB) and threads to allocate for a job
+
+        The peak memory and threads observed in previous runs if known,
+        the ``mem_gb`` and ``n_procs`` of the node otherwise, capped to
+        the resources of the plugin.
+        """
+        node = self.procs[jobid]
+        job_gb, job_th = node.mem_gb, node.n_procs
+        estimate = self._resource_estimate(jobid)
+        if estimate is not None:
+            if estimate['mem_gb'] is not None:
+                job_gb = estimate['mem_gb']
+            if estimate['n_threads'] is not None:
+                job_th = max(1, int(np.ceil(estimate['n_threads'])))
+        return min(job_gb, self.memory_gb), min(job_th, self.processors)
+
+    def _estimate_runtime(self, jobid):
+        """Expected runtime (in seconds) of a job
+
+        The average runtime of the interface in previous runs if known,
+        or the average runtime of the jobs finished so far.
+        """
+        estimate = self._resource_estimate(jobid)
+        if estimate is not None:
+            return estimate['duration']
+        total, count = self._runtime_stats
+        return total / count if count else 1.0
+
+    def _reserve(self, job_gb, job_th, free_memory_gb, free_processors):
+        """Reserve resources for a job that cannot be allocated yet
+
+        Returns the time at which enough resources are expected to be
+        released for the job to start (the shadow time), and the memory and
+        processors that will still be free at that time once the job is
+        started.
+        """
+        now = self._now()
+        ending = sorted(
+            (max(now, self._job_start.get(jobid, now) +
+                 self._estimate_runtime(jobid)), jobid)
+            for _, jobid in self.pending_tasks)
+        shadow_time = now
+        for end, jobid in ending:
+            if job_gb <= free_memory_gb and job_th <= free_processors:
+                break
+            shadow_time = end
+            job_gb_end, job_th_end = self._job_resources(jobid)
+            free_memory_gb += job_gb_end
+            free_processors += job_th_end
+        return dict(time=shadow_time,
+                    memory_gb=free_memory_gb - job_gb,
+                    processors=free_processors - job_th)
+
+    def _can_backfill(self, jobid, job_gb, job_th, reservation):
+        """Check whether a job can start without delaying the reservation
+
+        A job may be backfilled if it is expected to finish before the
+        reserved job can start, or if it only uses resources that will
+        still be free after the reserved job has started (EASY backfilling).
+        """
+        if self._now() + self._estimate_runtime(jobid) <= reservation['time']:
+            return True
+        if (job_gb <= reservation['memory_gb'] and
+                job_th <= reservation['processors']):
+            reservation['memory_gb'] -= job_gb
+            reservation['processors'] -= job_th
+            return True
+        return False
@@ -7,7 +7,6 @@ from builtins import str, open
 import os
 import stat
 from time import sleep
-import subprocess
 import simplejson as json
 
 from ... import logging
@@ -51,21 +50,19 @@ class OARPlugin(SGELikeBatchManagerBase):
                     kwargs['plugin_args']['max_jobname_len']
         super(OARPlugin, self).__init__(template, **kwargs)
 
-    def _is_pending(self, taskid):
-        #  subprocess.Popen requires taskid to be a string
-        proc = subprocess.Popen(
-            ['oarstat', '-J', '-s',
-             '-j', taskid],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
-        )
-        o, e = proc.communicate()
-        parsed_result = json.loads(o)[taskid].lower()
-        is_pending = (
-            ('error' not in parsed_result) and
-            ('terminated' not in parsed_result)
-        )
-        return is_pending
+    def _query_pending(self, taskids):
+        if not taskids:
+            return set()
+        args = ['oarstat', '-J', '-s']
+        for taskid in taskids:
+            args.extend(['-j', str(taskid)])
+        states = json.loads(self._run_status_command(args))
+        pending = set()
+        for taskid in taskids:
+            state = states.get(str(taskid), 'terminated').lower()
+            if 'error' not in state and 'terminated' not in state:
+                pending.add(taskid)
+        return pending
 
     def _submit_batchtask(self, scriptfile, node):
         cmd = CommandLine('oarsub', environ=dict(os.environ),
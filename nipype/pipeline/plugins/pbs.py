@@ -4,6 +4,7 @@
 from __future__ import print_function, division, unicode_literals, absolute_import
 from builtins import str, open
 
+import getpass
 import os
 from time import sleep
 
@@ -46,19 +47,19 @@ class PBSPlugin(SGELikeBatchManagerBase):
                 self._max_jobname_len = kwargs['plugin_args']['max_jobname_len']
         super(PBSPlugin, self).__init__(template, **kwargs)
 
-    def _is_pending(self, taskid):
-        result = CommandLine('qstat {}'.format(taskid),
-                             environ=dict(os.environ),
-                             terminal_output='allatonce',
-                             resource_monitor=False,
-                             ignore_exception=True).run()
-        stderr = result.runtime.stderr
-        errmsg = 'Unknown Job Id'  # %s' % taskid
-        success = 'Job has finished'
-        if success in e:  # Fix for my PBS
-            return False
-        else:
-            return errmsg not in e
+    def _query_pending(self, taskids):
+        # qstat -u lists the jobs of the user as "<id>.<server> <user>
+        # <queue> <name> <session> <nodes> <tasks> <memory> <time> <state>
+        # <elapsed>", after a few header lines; finished jobs are either not
+        # listed anymore, or listed as completed (C) or finished (F)
+        stdout = self._run_status_command(['qstat', '-u', getpass.getuser()])
+        queued = set()
+        for line in stdout.splitlines():
+            fields = line.split()
+            if len(fields) > 2 and fields[0][:1].isdigit() and \
+                    fields[-2] not in ('C', 'F'):
+                queued.add(fields[0].split('.')[0])
+        return set(taskid for taskid in taskids if str(taskid) in queued)
 
     def _submit_batchtask(self, scriptfile, node):
         cmd = CommandLine('qsub', environ=dict(os.environ),
@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Parallel workflow execution with resident (pilot) workers
+
+The master puts the jobs in a queue directory on a shared filesystem, and
+long-lived worker processes, started once per run (locally, or through the
+batch system with ``worker_command``), pull them from the queue and run them
+in-process. The workers import nipype once, and keep their in-memory caches
+(e.g., the content hashes of the input files) from one node to the next.
+
+A worker can also be started by hand::
+
+    python -c 'from nipype.pipeline.plugins.pilot import main; main()' \
+        <queue_dir>
+"""
+from __future__ import print_function, division, unicode_literals, absolute_import
+from builtins import open
+
+import argparse
+import os
+import subprocess
+import sys
+import threading
+from multiprocessing import cpu_count
+from socket import gethostname
+from time import sleep, time
+from traceback import format_exception
+try:
+    from shlex import quote
+except ImportError:  # Python 2
+    from pipes import quote
+
+from ... import logging
+from ...utils.filemanip import loadpkl, savepkl
+from .base import SGELikeBatchManagerBase, logger
+
+# the subdirectories of the queue directory
+QUEUED = 'queued'
+RUNNING = 'running'
+FINISHED = 'finished'
+WORKERS = 'workers'
+STOP = 'stop'
+
+
+def _touch(filename):
+    with open(filename, 'a'):
+        os.utime(filename, None)
+
+
+def run_job(jobfile):
+    """Run the node of a job file in the current process
+
+    This is the in-process equivalent of the scripts created by
+    :func:`nipype.pipeline.plugins.tools.create_pyscript`: the results of
+    the node, or the traceback of its failure, are saved in the
+    ``result_<name>.pklz`` file of its output directory.
+    """
+    from ... import config
+    info = loadpkl(jobfile)
+    node = info['node']
+    cwd = os.getcwd()
+    try:
+        config.update_config(node.config)
+        logging.update_logging(config)
+        node.run(updatehash=info['updatehash'])
+    except Exception:
+        traceback = format_exception(*sys.exc_info())
+        outdir = node.output_dir()
+        if not os.path.isdir(outdir):
+            os.makedirs(outdir)
+        savepkl(os.path.join(outdir, 'result_%s.pklz' % node.name),
+                dict(result=node.result, hostname=gethostname(),
+                     traceback=traceback))
+    finally:
+        os.chdir(cwd)
+
+
+def run_worker(queue_dir, idle_timeout=300., heartbeat=5.):
+    """Pull and run the jobs of a queue directory until told to stop
+
+    The jobs are claimed by moving them from the ``queued`` to the
+    ``running`` subdirectory, which is atomic on a (POSIX) shared
+    filesystem, and their completion is notified in the ``finished``
+    subdirectory. The worker touches its file in the ``workers``
+    subdirectory every ``heartbeat`` seconds, and exits when the ``stop``
+    file appears, or after ``idle_timeout`` seconds without any job.
+    """
+    worker = '%s.%d' % (gethostname(), os.getpid())
+    workerfile = os.path.join(queue_dir, WORKERS, worker)
+    _touch(workerfile)
+    stopped = threading.Event()
+
+    def beat():
+        while not stopped.wait(heartbeat):
+            _touch(workerfile)
+    beating = threading.Thread(target=beat)
+    beating.daemon = True
+    beating.start()
+
+    last_job = time()
+    delay = 0.05
+    try:
+        while not os.path.exists(os.path.join(queue_dir, STOP)):
+            claimed = None
+            for name in sorted(os.listdir(os.path.join(queue_dir, QUEUED))):
+                jobfile = os.path.join(queue_dir, RUNNING,
+                                       '%s__%s' % (worker, name))
+                try:
+                    os.rename(os.path.join(queue_dir, QUEUED, name), jobfile)
+                except OSError:
+                    # claimed by another worker
+                    continue
+                claimed = name
+                break
+            if claimed is None:
+                if time() - last_job > idle_timeout:
+                    logger.info('Pilot worker %s idle, exiting', worker)
+                    break
+                sleep(delay)
+                delay = min(2 * delay, 1.)
+                continue
+            try:
+                run_job(jobfile)
+            except Exception:
+                logger.error('Pilot worker %s could not run %s:\n%s', worker,
+                             claimed, ''.join(format_exception(*sys.exc_info())))
+            _touch(os.path.join(queue_dir, FINISHED, claimed))
+            os.remove(jobfile)
+            last_job = time()
+            delay = 0.05
+    finally:
+        stopped.set()
+        if os.path.exists(workerfile):
+            os.remove(workerfile)
+
+
+class PilotPlugin(SGELikeBatchManagerBase):
+    """Execute using resident workers pulling the jobs from a queue
+
+    The plugin_args input to run can be used to control the workers.
+    Currently supported options are:
+
+    - n_workers : number of workers to start (default: number of CPUs)
+    - worker_command : command starting a worker on the cluster, where
+      ``{command}`` is replaced by the command line of the worker, e.g.
+      ``sbatch --wrap '{command}'``. The workers are started locally by
+      default.
+    - queue_dir : shared directory of the job queue (default: the ``pilot``
+      directory next to the ``batch`` directory of the workflow)
+    - idle_timeout : seconds after which a worker without work exits
+      (default: 300). The local workers which exited are started again when
+      new jobs are queued, but the workers started with ``worker_command``
+      are not replaced: if they all exit, the remaining jobs stay queued
+      until a worker is started by hand.
+    - heartbeat_timeout : seconds after which a worker which did not signal
+      that it is alive is considered dead, along with its running job
+      (default: 60)
+    - status_interval : seconds between two checks of the job queue
+    """
+
+    def __init__(self, **kwargs):
+        super(PilotPlugin, self).__init__('', **kwargs)
+        self._n_workers = int(self.plugin_args.get('n_workers', cpu_count()))
+        self._worker_command = self.plugin_args.get('worker_command')
+        self._queue_dir = None
+        self._idle_timeout = float(self.plugin_args.get('idle_timeout', 300))
+        self._heartbeat_timeout = float(
+            self.plugin_args.get('heartbeat_timeout', 60))
+        self._workers = []
+        self._jobnames = {}
+        self._taskid = 0
+
+    def _prerun_check(self, graph):
+        queue_dir = self.plugin_args.get('queue_dir')
+        if queue_dir is None:
+            node = next(iter(graph.nodes()))
+            if node._hierarchy:
+                queue_dir = os.path.join(node.base_dir,
+                                         node._hierarchy.split('.')[0],
+                                         'pilot')
+            else:
+                queue_dir = os.path.join(node.base_dir, 'pilot')
+        self._queue_dir = os.path.abspath(queue_dir)
+        for subdir in (QUEUED, RUNNING, FINISHED, WORKERS):
+            if not os.path.isdir(os.path.join(self._queue_dir, subdir)):
+                os.makedirs(os.path.join(self._queue_dir, subdir))
+        if os.path.exists(os.path.join(self._queue_dir, STOP)):
+            os.remove(os.path.join(self._queue_dir, STOP))
+        # drop the leftovers of an interrupted run
+        for subdir in (QUEUED, FINISHED):
+            for name in os.listdir(os.path.join(self._queue_dir, subdir)):
+                os.remove(os.path.join(self._queue_dir, subdir, name))
+        for _ in range(self._n_workers):
+            self._start_worker()
+
+    def _worker_args(self):
+        return [sys.executable, '-c',
+                'from nipype.pipeline.plugins.pilot import main; main()',
+                self._queue_dir, '--idle-timeout', str(self._idle_timeout),
+                '--heartbeat', str(self._heartbeat_timeout / 4)]
+
+    def _start_worker(self):
+        if self._worker_command is None:
+            self._workers.append(subprocess.Popen(self._worker_args()))
+            return
+        command = ' '.join(quote(arg) for arg in self._worker_args())
+        subprocess.check_call(self._worker_command.format(command=command),
+                              shell=True)
+
+    def _postrun_check(self):
+        _touch(os.path.join(self._queue_dir, STOP))
+        for worker in self._workers:
+            worker.wait()
+        self._workers = []
+
+    def _submit_job(self, node, updatehash=False):
+        self._taskid += 1
+        taskid = self._taskid
+        name = '%08d_%s.pklz' % (taskid, node._id)
+        tmpfile = os.path.join(self._queue_dir, '.%s' % name)
+        savepkl(tmpfile, dict(node=node, updatehash=updatehash))
+        self._pending[taskid] = node.output_dir()
+        self._notifications[taskid] = os.path.join(self._queue_dir,
+                                                   FINISHED, name)
+        self._jobnames[taskid] = name
+        # the job is visible to the workers once it is complete
+        os.rename(tmpfile, os.path.join(self._queue_dir, QUEUED, name))
+        return taskid
+
+    def _query_pending(self, taskids):
+        """The jobs still queued, or running on a live worker"""
+        now = time()
+        alive = set()
+        for worker in os.listdir(os.path.join(self._queue_dir, WORKERS)):
+            try:
+                stamp = os.path.getmtime(
+                    os.path.join(self._queue_dir, WORKERS, worker))
+            except OSError:
+                continue
+            if now - stamp < self._heartbeat_timeout:
+                alive.add(worker)
+        queued = os.listdir(os.path.join(self._queue_dir, QUEUED))
+        active = set(queued)
+        for name in os.listdir(os.path.join(self._queue_dir, RUNNING)):
+            worker, _, jobname = name.partition('__')
+            if worker in alive:
+                active.add(jobname)
+        # replace the local workers which exited while jobs are waiting,
+        # whether they died (e.g., in a segfault) or went idle
+        for i, worker in enumerate(self._workers):
+            if queued and worker.poll() is not None:
+                if worker.returncode:
+                    logger.warning('Restarting a pilot worker which exited '
+                                   'with code %d', worker.returncode)
+                else:
+                    logger.info('Restarting an idle pilot worker')
+                self._workers[i] = subprocess.Popen(self._worker_args())
+        return set(taskid for taskid in taskids
+                   if self._jobnames.get(taskid) in active)
+
+    def _clear_task(self, taskid):
+        super(PilotPlugin, self)._clear_task(taskid)
+        self._jobnames.pop(taskid, None)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Resident worker of the Pilot plugin')
+    parser.add_argument('queue_dir', help='directory of the job queue')
+    parser.add_argument('--idle-timeout', type=float, default=300.,
+                        help='exit after that many seconds without job')
+    parser.add_argument('--heartbeat', type=float, default=5.,
+                        help='seconds between two signs of life')
+    args = parser.parse_args(argv)
+    run_worker(args.queue_dir, idle_timeout=args.idle_timeout,
+               heartbeat=args.heartbeat)
+
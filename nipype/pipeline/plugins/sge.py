@@ -113,6 +113,7 @@ class QstatSubstitute(object):
         self._out_of_scope_jobs = list()  # Initialize first
         self._task_dictionary = dict(
         )  # {'taskid': QJobInfo(), .... }  The dictionaryObject
+        self._last_qstat = 0  # time of the last qstat request
         self._remove_old_jobs()
 
     def _remove_old_jobs(self):
@@ -242,6 +243,7 @@ class QstatSubstitute(object):
         """
         sge_debug_print("WARNING:  CONTACTING qmaster for jobs, "
                         "{0}: {1}".format(time.time(), reason_for_qstat))
+        self._last_qstat = time.time()
         if force_instant:
             this_command = self._qstat_instant_executable
         else:
@@ -277,14 +279,20 @@ class QstatSubstitute(object):
         for vv in list(self._task_dictionary.values()):
             sge_debug_print(str(vv))
 
-    def is_job_pending(self, task_id):
+    def is_job_pending(self, task_id, refresh_interval=0):
+        """
+        :param task_id: the job to check
+        :param refresh_interval: the cached job states of the pending jobs
+            are trusted for that many seconds after the last qstat request
+        """
         task_id = int(task_id)  # Ensure that it is an integer
         # Check if the task is in the dictionary first (before running qstat)
         if task_id in self._task_dictionary:
             # Trust the cache, only False if state='zombie'
             job_is_pending = self._task_dictionary[task_id].is_job_state_pending()
             # Double check pending jobs in case of change (since we don't check at the beginning)
-            if job_is_pending:
+            if job_is_pending and \
+                    time.time() - self._last_qstat >= refresh_interval:
                 self._run_qstat("checking job pending status {0}".format(task_id), False)
                 job_is_pending = self._task_dictionary[task_id].is_job_state_pending()
         else:
@@ -361,7 +369,8 @@ class SGEPlugin(SGELikeBatchManagerBase):
         super(SGEPlugin, self).__init__(template, **kwargs)
 
     def _is_pending(self, taskid):
-        return self._refQstatSubstitute.is_job_pending(int(taskid))
+        return self._refQstatSubstitute.is_job_pending(
+            int(taskid), self._get_status_interval())
 
     def _submit_batchtask(self, scriptfile, node):
         cmd = CommandLine('qsub', environ=dict(os.environ),
@@ -8,6 +8,7 @@ Parallel workflow execution with SLURM
 from __future__ import print_function, division, unicode_literals, absolute_import
 from builtins import open
 
+import getpass
 import os
 import re
 from time import sleep
@@ -60,13 +61,13 @@ class SLURMPlugin(SGELikeBatchManagerBase):
         self._pending = {}
         super(SLURMPlugin, self).__init__(self._template, **kwargs)
 
-    def _is_pending(self, taskid):
-        #  subprocess.Popen requires taskid to be a string
-        res = CommandLine('squeue',
-                          args=' '.join(['-j', '%s' % taskid]),
-                          resource_monitor=False,
-                          terminal_output='allatonce').run()
-        return res.runtime.stdout.find(str(taskid)) > -1
+    def _query_pending(self, taskids):
+        # a single squeue for all the jobs of the user, as unknown job ids
+        # make ``squeue -j`` fail
+        stdout = self._run_status_command(
+            ['squeue', '-h', '-o', '%i', '-u', getpass.getuser()])
+        queued = set(line.strip() for line in stdout.splitlines())
+        return set(taskid for taskid in taskids if str(taskid) in queued)
 
     def _submit_batchtask(self, scriptfile, node):
         """
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Tests for the status polling of the batch system plugins"""
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import nipype
+from nipype.interfaces import utility as niu
+from nipype.pipeline import engine as pe
+from nipype.pipeline.plugins.base import SGELikeBatchManagerBase
+from nipype.pipeline.plugins.condor import CondorPlugin
+from nipype.pipeline.plugins.lsf import LSFPlugin
+from nipype.pipeline.plugins.oar import OARPlugin
+from nipype.pipeline.plugins.pbs import PBSPlugin
+from nipype.pipeline.plugins.slurm import SLURMPlugin
+
+NIPYPE_ROOT = os.path.dirname(os.path.dirname(nipype.__file__))
+
+
+class LocalBatchPlugin(SGELikeBatchManagerBase):
+    """Run the batch scripts as local background processes"""
+
+    def __init__(self, **kwargs):
+        super(LocalBatchPlugin, self).__init__('#!/bin/sh', **kwargs)
+        self.jobs = {}
+        self.queries = 0
+
+    def _query_pending(self, taskids):
+        self.queries += 1
+        return set(taskid for taskid in taskids
+                   if self.jobs[taskid].poll() is None)
+
+    def _submit_batchtask(self, scriptfile, node):
+        taskid = len(self.jobs) + 1
+        # the jobs import the same nipype as the tests
+        environ = dict(os.environ, PYTHONPATH=os.pathsep.join(
+            [NIPYPE_ROOT] + [os.environ.get('PYTHONPATH', '')]))
+        self.jobs[taskid] = subprocess.Popen(['sh', scriptfile], env=environ)
+        self._pending[taskid] = node.output_dir()
+        return taskid
+
+
+def add_one(value):
+    return value + 1
+
+
+def test_local_batch_plugin(tmpdir):
+    wf = pe.Workflow(name='batch', base_dir=tmpdir.strpath)
+    source = pe.Node(niu.IdentityInterface(fields=['value']), name='source')
+    source.iterables = ('value', [1, 2, 3])
+    inc = pe.Node(niu.Function(function=add_one, input_names=['value'],
+                               output_names=['out']), name='inc')
+    wf.connect(source, 'value', inc, 'value')
+    wf.config['execution']['poll_sleep_duration'] = 0.1
+
+    plugin = LocalBatchPlugin(plugin_args={'status_interval': 60})
+    execgraph = wf.run(plugin=plugin)
+    assert sorted(node.get_output('out') for node in execgraph.nodes()
+                  if node.name == 'inc') == [2, 3, 4]
+    # the completions were notified long before the status was refreshed
+    assert plugin.queries <= len(plugin.jobs)
+    assert plugin._notifications == {}
+    assert os.listdir(tmpdir.join('batch', 'batch', 'finished').strpath) == []
+
+
+@pytest.mark.parametrize('bundle_procs', [1, 2])
+def test_bundles(tmpdir, bundle_procs):
+    wf = pe.Workflow(name='bundles', base_dir=tmpdir.strpath)
+    source = pe.Node(niu.IdentityInterface(fields=['value']), name='source')
+    source.iterables = ('value', [1, 2, 3, 4, 5])
+    inc = pe.Node(niu.Function(function=add_one, input_names=['value'],
+                               output_names=['out']), name='inc')
+    inc2 = pe.Node(niu.Function(function=add_one, input_names=['value'],
+                                output_names=['out']), name='inc2', n_procs=2)
+    wf.connect([(source, inc, [('value', 'value')]),
+                (source, inc2, [('value', 'value')])])
+    wf.config['execution']['poll_sleep_duration'] = 0.1
+
+    plugin = LocalBatchPlugin(plugin_args={
+        'bundle_size': 3, 'bundle_procs': bundle_procs})
+    execgraph = wf.run(plugin=plugin)
+    assert sorted(node.get_output('out') for node in execgraph.nodes()
+                  if node.name in ('inc', 'inc2')) == [2, 2, 3, 3, 4, 4, 5, 5,
+                                                        6, 6]
+    # 5 nodes of each resource class, in bundles of at most 3 nodes
+    assert len(plugin.jobs) == 4
+    assert plugin._pending == plugin._bundled == {}
+
+
+def test_bundle_submission_failure(tmpdir, monkeypatch):
+    wf = pe.Workflow(name='bundles', base_dir=tmpdir.strpath)
+    source = pe.Node(niu.IdentityInterface(fields=['value']), name='source')
+    source.iterables = ('value', [1, 2])
+    inc = pe.Node(niu.Function(function=add_one, input_names=['value'],
+                               output_names=['out']), name='inc')
+    wf.connect(source, 'value', inc, 'value')
+    wf.config['execution']['poll_sleep_duration'] = 0.1
+
+    plugin = LocalBatchPlugin(plugin_args={'bundle_size': 2})
+    monkeypatch.setattr(plugin, '_submit_batchtask',
+                        lambda scriptfile, node: None)
+    with pytest.raises(RuntimeError) as excinfo:
+        wf.run(plugin=plugin)
+    assert 'bundled nodes' in str(excinfo.value)
+
+
+def _plugin(plugin_class, taskids, stdout, monkeypatch):
+    plugin = plugin_class(plugin_args={'status_interval': 60})
+    plugin._pending = dict((taskid, None) for taskid in taskids)
+    commands = []
+
+    def run_status_command(args):
+        commands.append(args)
+        return stdout
+    monkeypatch.setattr(plugin, '_run_status_command', run_status_command)
+    return plugin, commands
+
+
+@pytest.mark.parametrize('plugin_class, taskids, stdout, pending', [
+    (SLURMPlugin, [11, 12, 13], '11\n13\n', [11, 13]),
+    (PBSPlugin, ['21', '22', '23'],
+     '\nserver:\n'
+     '                                                   Req\'d  Req\'d   Elap\n'
+     'Job ID     Username Queue Jobname SessID NDS TSK Memory Time  S Time\n'
+     '---------- -------- ----- ------- ------ --- --- ------ ----- - -----\n'
+     '21.server  me       batch job1      1234   1   1    --  01:00 R 00:01\n'
+     '22.server  me       batch job2      1235   1   1    --  01:00 C 00:02\n',
+     ['21']),
+    (LSFPlugin, [31, 32, 33],
+     'JOBID   USER    STAT  QUEUE\n'
+     '31      me      RUN   normal\n'
+     '32      me      DONE  normal\n'
+     '33      me      PEND  normal\n', [31, 33]),
+    (OARPlugin, [41, 42, 43],
+     json.dumps({'41': 'Running', '42': 'Terminated', '43': 'Error'}),
+     [41]),
+    (CondorPlugin, [51, 52, 53, 54],
+     '51 2\n51 2\n53 1\n54 4\n', [51, 53]),
+])
+def test_query_pending(monkeypatch, plugin_class, taskids, stdout, pending):
+    plugin, commands = _plugin(plugin_class, taskids, stdout, monkeypatch)
+    assert [taskid for taskid in taskids if plugin._is_pending(taskid)] == \
+        pending
+    # a single query answers for all the tasks within the status interval
+    assert len(commands) == 1
+
+    plugin._status = (plugin._status[0] - 60, ) + plugin._status[1:]
+    plugin._is_pending(taskids[0])
+    assert len(commands) == 2
+
+
+@pytest.mark.parametrize('plugin_class', [SLURMPlugin, PBSPlugin, LSFPlugin,
+                                          OARPlugin, CondorPlugin])
+def test_query_failure(monkeypatch, plugin_class):
+    plugin = plugin_class(plugin_args={'status_interval': 60})
+    plugin._pending = {1: None, 2: None}
+    # e.g. the scheduler is briefly unreachable
+    run_status_command = plugin._run_status_command
+    monkeypatch.setattr(
+        plugin, '_run_status_command', lambda args: run_status_command(
+            [sys.executable, '-c', 'import sys; sys.exit(1)']))
+    assert plugin._is_pending(1) and plugin._is_pending(2)
+
+    # until the failures last
+    for _ in range(8):
+        plugin._status = None
+        assert plugin._is_pending(1)
+    plugin._status = None
+    with pytest.raises(RuntimeError):
+        plugin._is_pending(1)
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Tests and benchmark for the dependency bookkeeping of DistributedPluginBase
+
+The tests count the array copies; run as a script to print the MapNode
+expansion timings::
+
+    python test_mapnode_expansion.py
+"""
+from __future__ import print_function, division
+import gc
+from time import time
+
+import numpy as np
+import networkx as nx
+
+from nipype.pipeline.plugins import base
+from nipype.pipeline.plugins.base import DistributedPluginBase, _extend_array
+
+
+class FakeNode(object):
+    """Minimal stand-in for a (Map)Node, as seen by the scheduler"""
+
+    def __init__(self, name, num_subnodes=0):
+        self._id = name
+        self.num_subnodes = num_subnodes
+
+    def get_subnodes(self):
+        return [FakeNode('%s.%d' % (self._id, i))
+                for i in range(self.num_subnodes)]
+
+    def __repr__(self):
+        return self._id
+
+
+def _setup_plugin(num_mapnodes, num_subnodes):
+    """A chain of MapNodes, all of them sharing a common source node"""
+    graph = nx.DiGraph()
+    source = FakeNode('source')
+    graph.add_node(source)
+    for i in range(num_mapnodes):
+        graph.add_edge(source, FakeNode('mapnode%d' % i, num_subnodes))
+    plugin = DistributedPluginBase()
+    plugin._generate_dependency_list(graph)
+    plugin.mapnodes = []
+    plugin.mapnodesubids = {}
+    return plugin
+
+
+def _time_expansion(num_mapnodes, num_subnodes):
+    plugin = _setup_plugin(num_mapnodes, num_subnodes)
+    jobids = [jobid for jobid, node in enumerate(plugin.procs)
+              if node.num_subnodes]
+    # Keep garbage collection pauses out of the measurement
+    gc.collect()
+    gc.disable()
+    try:
+        tic = time()
+        for jobid in jobids:
+            plugin._submit_mapnode(jobid)
+        return time() - tic
+    finally:
+        gc.enable()
+
+
+def test_extend_array():
+    array = np.arange(3)
+    for num in (1, 5, 0, 20):
+        expected = np.concatenate((array, np.zeros(num, dtype=array.dtype)))
+        array = _extend_array(array, num)
+        assert array.dtype == expected.dtype
+        assert np.all(array == expected)
+        array[-1] = 99
+
+
+def test_mapnode_expansion_dependencies():
+    plugin = _setup_plugin(2, 3)
+    assert plugin.indegree.tolist() == [0, 1, 1]
+    assert plugin._get_ready_jobs().tolist() == [0]
+
+    plugin.proc_done[0] = True
+    plugin._task_finished_cb(0)
+    assert plugin._get_ready_jobs().tolist() == [1, 2]
+
+    # Expanding a mapnode makes its subnodes ready, and blocks the mapnode
+    assert plugin._submit_mapnode(1) is False
+    assert len(plugin.procs) == len(plugin.proc_done) == 6
+    assert plugin.indegree[1] == 3
+    assert plugin._get_ready_jobs().tolist() == [2, 3, 4, 5]
+    assert plugin._submit_mapnode(1) is True
+
+    for subid in (3, 4, 5):
+        plugin.proc_done[subid] = True
+        plugin._task_finished_cb(subid)
+    assert plugin._get_ready_jobs().tolist() == [1, 2]
+    assert plugin.refcount.tolist() == [2, 0, 0]
+
+    plugin.proc_done[1] = True
+    plugin._task_finished_cb(1)
+    assert plugin._get_ready_jobs().tolist() == [2]
+    assert plugin.refcount.tolist() == [1, 0, 0]
+
+
+def test_mapnode_expansion_scaling(monkeypatch):
+    """Expanding MapNodes must do work linear in the number of subnodes"""
+    copied = []
+
+    def count_copies(array, num):
+        extended = _extend_array(array, num)
+        assert len(extended) == len(array) + num
+        if extended.base is not array.base:
+            copied.append(len(array))
+        return extended
+    monkeypatch.setattr(base, '_extend_array', count_copies)
+    for num_mapnodes in (50, 200):
+        del copied[:]
+        plugin = _setup_plugin(num_mapnodes, 200)
+        for jobid in range(1, num_mapnodes + 1):
+            assert plugin._submit_mapnode(jobid) is False
+        num_jobs = num_mapnodes * 201 + 1
+        assert len(plugin.procs) == len(plugin.proc_done) == num_jobs
+        # The buffers double in size, so that each of the three arrays is
+        # copied a logarithmic number of times, and less than twice its
+        # final length in total; copying on every expansion would be
+        # quadratic in the number of subnodes
+        assert len(copied) <= 3 * np.ceil(np.log2(num_jobs))
+        assert sum(copied) < 3 * 2 * num_jobs
+
+
+if __name__ == '__main__':
+    print('mapnodes  subnodes  total subnodes  time (s)  us/subnode')
+    for num_mapnodes in (50, 100, 200, 400, 800):
+        elapsed = _time_expansion(num_mapnodes, 200)
+        total = num_mapnodes * 200
+        print('%8d  %8d  %14d  %8.3f  %10.2f' % (
+            num_mapnodes, 200, total, elapsed, 1e6 * elapsed / total))
@@ -52,6 +52,59 @@ def test_run_multiproc(tmpdir):
     assert result == [1, 1]
 
 
+def _sum(values):
+    return sum(values)
+
+
+def test_run_multiproc_event_driven(tmpdir):
+    tmpdir.chdir()
+
+    pipe = pe.Workflow(name='pipe')
+    mod1 = pe.Node(MultiprocTestInterface(), name='mod1')
+    mod2 = pe.MapNode(MultiprocTestInterface(),
+                      iterfield=['input1'],
+                      name='mod2')
+    mod3 = pe.Node(MultiprocTestInterface(), name='mod3')
+    pipe.connect([(mod1, mod2, [('output1', 'input1')]),
+                  (mod1, mod3, [(('output1', _sum), 'input1')])])
+    pipe.base_dir = os.getcwd()
+    mod1.inputs.input1 = 1
+    # A long poll interval would make the test time out if the
+    # scheduler were not woken up by task completion
+    pipe.config['execution']['poll_sleep_duration'] = 60
+    execgraph = pipe.run(plugin="MultiProc",
+                         plugin_args={'event_driven': True, 'n_procs': 2})
+    names = [node.fullname for node in execgraph.nodes()]
+    node = list(execgraph.nodes())[names.index('pipe.mod3')]
+    assert node.get_output('output1') == [1, 2]
+    node = list(execgraph.nodes())[names.index('pipe.mod2')]
+    assert node.get_output('output1') == [[1, 1], [1, 1]]
+
+
+class CrashingTestInterface(MultiprocTestInterface):
+    def _run_interface(self, runtime):
+        raise ValueError('crash')
+
+
+def test_multiproc_event_driven_crash(tmpdir):
+    tmpdir.chdir()
+
+    pipe = pe.Workflow(name='pipe')
+    mod1 = pe.Node(MultiprocTestInterface(), name='mod1')
+    mod2 = pe.Node(CrashingTestInterface(), name='mod2')
+    mod3 = pe.Node(MultiprocTestInterface(), name='mod3')
+    pipe.connect([(mod1, mod2, [(('output1', _sum), 'input1')]),
+                  (mod2, mod3, [(('output1', _sum), 'input1')])])
+    pipe.base_dir = os.getcwd()
+    pipe.config['execution']['poll_sleep_duration'] = 60
+    pipe.config['execution']['crashdump_dir'] = os.getcwd()
+    mod1.inputs.input1 = 1
+    with pytest.raises(RuntimeError) as excinfo:
+        pipe.run(plugin="MultiProc",
+                 plugin_args={'event_driven': True, 'n_procs': 2})
+    assert 'Workflow did not execute cleanly' in str(excinfo.value)
+
+
 class InputSpecSingleNode(nib.TraitedSpec):
     input1 = nib.traits.Int(desc='a random int')
     input2 = nib.traits.Int(desc='a random int')
@@ -135,3 +188,55 @@ def test_hold_job_until_procs_available(tmpdir):
     max_threads = 2
     pipe.run(plugin='MultiProc',
              plugin_args={'n_procs': max_threads})
+
+
+def test_critical_path_scheduler(tmpdir):
+    tmpdir.chdir()
+
+    pipe = pe.Workflow(name='pipe')
+    n1 = pe.Node(SingleNodeTestInterface(), name='n1', n_procs=2)
+    n2 = pe.Node(SingleNodeTestInterface(), name='n2', n_procs=1)
+    n3 = pe.Node(SingleNodeTestInterface(), name='n3', n_procs=2)
+    n4 = pe.Node(SingleNodeTestInterface(), name='n4', n_procs=1)
+
+    pipe.connect(n1, 'output1', n2, 'input1')
+    pipe.connect(n1, 'output1', n3, 'input1')
+    pipe.connect(n3, 'output1', n4, 'input1')
+    n1.inputs.input1 = 4
+    pipe.config['execution']['poll_sleep_duration'] = 0.1
+
+    execgraph = pipe.run(plugin='MultiProc',
+                         plugin_args={'n_procs': 2, 'event_driven': True,
+                                      'scheduler': 'critical_path'})
+    outputs = dict((node.name, node.get_output('output1'))
+                   for node in execgraph.nodes())
+    assert outputs == {'n1': 4, 'n2': 4, 'n3': 4, 'n4': 4}
+
+
+def test_resource_stats(tmpdir):
+    from nipype.utils.profiler import ResourceStats, interface_key
+    tmpdir.chdir()
+
+    def _run(name):
+        pipe = pe.Workflow(name=name, base_dir=tmpdir.strpath)
+        n1 = pe.Node(SingleNodeTestInterface(), name='n1')
+        n2 = pe.Node(SingleNodeTestInterface(), name='n2')
+        pipe.connect(n1, 'output1', n2, 'input1')
+        n1.inputs.input1 = 4
+        pipe.config['execution']['poll_sleep_duration'] = 0.1
+        pipe.run(plugin='MultiProc',
+                 plugin_args={'n_procs': 2, 'event_driven': True,
+                              'scheduler': 'critical_path',
+                              'resource_stats': 'stats.sqlite'})
+        return n1
+
+    node = _run('first')
+    stats = ResourceStats('stats.sqlite')
+    assert stats.estimate(interface_key(node), 0)['count'] == 2
+    stats.close()
+
+    # estimates are used by the second run, which records its own jobs
+    _run('second')
+    stats = ResourceStats('stats.sqlite')
+    assert stats.estimate(interface_key(node), 0)['count'] == 4
+    stats.close()
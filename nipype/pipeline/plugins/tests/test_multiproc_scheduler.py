@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Simulation harness for the MultiProc scheduling policies
+
+The actual scheduling code of :class:`MultiProcPlugin` is run against
+synthetic graphs on a virtual clock, without spawning any worker. Run as a
+script to compare the makespan of the different policies::
+
+    python test_multiproc_scheduler.py [num_graphs]
+"""
+from __future__ import print_function, division
+import heapq
+import sys
+
+import networkx as nx
+import numpy as np
+import pytest
+
+from nipype import logging
+from nipype.pipeline.plugins.multiproc import MultiProcPlugin
+from nipype.utils.profiler import ResourceStats, interface_key
+
+SCHEDULERS = ('tsort', 'mem_thread', 'critical_path')
+
+
+class FakeInterface(object):
+    pass
+
+
+class FakeNode(object):
+    """Minimal stand-in for a Node, as seen by the scheduler"""
+    run_without_submitting = False
+    interface = FakeInterface()
+
+    def __init__(self, name, runtime=1., mem_gb=0.2, n_procs=1):
+        self._id = self.fullname = name
+        self.runtime = runtime
+        self.mem_gb = mem_gb
+        self.n_procs = n_procs
+
+    def __repr__(self):
+        return self._id
+
+
+class SimulatedMultiProc(MultiProcPlugin):
+    """MultiProc scheduling on a virtual clock"""
+
+    def __init__(self, plugin_args=None):
+        super(SimulatedMultiProc, self).__init__(plugin_args=plugin_args)
+        self.clock = 0.
+        self.running = []
+
+    def _create_pool(self, non_daemon, maxtasks):
+        return None
+
+    def _now(self):
+        return self.clock
+
+    def _local_hash_check(self, jobid, graph):
+        return False
+
+    def _submit_job(self, node, updatehash=False):
+        self._taskid += 1
+        heapq.heappush(self.running, (self.clock + node.runtime, self._taskid))
+        jobid = self.procs.index(node)
+        used = np.sum([self._job_resources(other)
+                       for _, other in self.pending_tasks + [(0, jobid)]], 0)
+        used_gb, used_th = used
+        assert used_gb <= self.memory_gb + 1e-6
+        assert used_th <= self.processors
+        return self._taskid
+
+    def simulate(self, graph):
+        """Run the graph and return its makespan"""
+        self._generate_dependency_list(graph)
+        self.mapnodes = []
+        self.mapnodesubids = {}
+        while not np.all(self.proc_done) or np.any(self.proc_pending):
+            self._send_procs_to_workers()
+            end, taskid = heapq.heappop(self.running)
+            self.clock = end
+            jobid = dict(self.pending_tasks).pop(taskid)
+            self.pending_tasks.remove((taskid, jobid))
+            self._task_finished_cb(jobid)
+        return self.clock
+
+
+def simulate(graph, scheduler, n_procs=4, memory_gb=8., resource_stats=None):
+    plugin = SimulatedMultiProc(plugin_args={
+        'n_procs': n_procs, 'memory_gb': memory_gb, 'scheduler': scheduler,
+        'job_descriptors': True})
+    plugin.resource_stats = resource_stats
+    return plugin.simulate(graph)
+
+
+def random_graph(num_nodes, n_procs=4, memory_gb=8., edge_prob=0.1, seed=0):
+    """Random DAG with a few large jobs among many small ones"""
+    rng = np.random.RandomState(seed)
+    nodes = []
+    for i in range(num_nodes):
+        large = rng.rand() < 0.1
+        nodes.append(FakeNode(
+            'node%d' % i, runtime=rng.uniform(1, 10),
+            mem_gb=rng.uniform(0.5, 1.) * (memory_gb if large else 1.),
+            n_procs=rng.randint(1, n_procs + 1) if large else 1))
+    graph = nx.DiGraph()
+    graph.add_nodes_from(nodes)
+    for i in range(num_nodes):
+        for j in range(i + 1, num_nodes):
+            if rng.rand() < edge_prob:
+                graph.add_edge(nodes[i], nodes[j])
+    return graph
+
+
+def critical_path_length(graph):
+    length = {}
+    for node in nx.topological_sort(graph):
+        length[node] = node.runtime + max(
+            [length[parent] for parent in graph.predecessors(node)] or [0])
+    return max(length.values())
+
+
+def test_critical_path_first():
+    graph = nx.DiGraph()
+    # Independent short jobs, which come first in topological order
+    graph.add_nodes_from(FakeNode('small%d' % i, runtime=10)
+                         for i in range(6))
+    chain = [FakeNode('chain%d' % i, runtime=10, n_procs=2)
+             for i in range(3)]
+    graph.add_edges_from(zip(chain[:-1], chain[1:]))
+    # the chain runs along with two short jobs at a time
+    assert simulate(graph, 'critical_path') == 30
+    # small jobs first delays the chain
+    assert simulate(graph, 'mem_thread') == 40
+
+
+def test_backfill_does_not_starve_large_jobs():
+    graph = nx.DiGraph()
+    graph.add_nodes_from(FakeNode('small%d' % i, runtime=10)
+                         for i in range(12))
+    graph.add_node(FakeNode('large', runtime=10, n_procs=4))
+    first = FakeNode('first', runtime=15, n_procs=2)
+    graph.add_edge(first, FakeNode('second', runtime=10, n_procs=2))
+    # 210 processor-time units of work on 4 processors take at least 52.5
+    assert simulate(graph, 'critical_path') <= 55
+
+
+@pytest.mark.parametrize('scheduler', SCHEDULERS)
+def test_pack_observed_resources(scheduler):
+    graph = nx.DiGraph()
+    graph.add_nodes_from(FakeNode('node%d' % i, runtime=10, mem_gb=4)
+                         for i in range(8))
+    assert simulate(graph, scheduler) == 40
+
+    # the nodes were observed to use much less than they declare
+    stats = ResourceStats(':memory:')
+    key = interface_key(FakeNode('node0'))
+    stats.record(key, 0, duration=10., mem_gb=1., n_threads=1.)
+    assert simulate(graph, scheduler, resource_stats=stats) == 20
+
+
+def test_longest_observed_first():
+    graph = nx.DiGraph()
+    graph.add_nodes_from(FakeNode('short%d' % i, runtime=10)
+                         for i in range(4))
+    long_node = FakeNode('long', runtime=40)
+    long_node.interface = object()
+    graph.add_node(long_node)
+
+    stats = ResourceStats(':memory:')
+    stats.record(interface_key(long_node), 0, duration=40.)
+    stats.record(interface_key(FakeNode('short0')), 0, duration=10.)
+    plugin = SimulatedMultiProc(plugin_args={'n_procs': 2, 'memory_gb': 8.})
+    plugin.resource_stats = stats
+    plugin._generate_dependency_list(graph)
+    assert plugin.procs[plugin._sort_jobs(range(5))[0]] is long_node
+    # the long job starts right away, whatever its topological order
+    for scheduler in ('tsort', 'critical_path'):
+        assert simulate(graph, scheduler, n_procs=2,
+                        resource_stats=stats) == 40
+
+
+@pytest.mark.parametrize('scheduler', SCHEDULERS)
+def test_random_graphs(scheduler):
+    for seed in range(3):
+        graph = random_graph(40, seed=seed)
+        makespan = simulate(graph, scheduler)
+        # never better than the critical path, never worse than serial
+        total = sum(node.runtime for node in graph.nodes())
+        assert makespan <= total
+        assert makespan >= critical_path_length(graph)
+
+
+if __name__ == '__main__':
+    logging.getLogger('workflow').setLevel('ERROR')
+    num_graphs = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    print('%5s  %6s  ' % ('nodes', 'procs') +
+          '  '.join('%13s' % name for name in SCHEDULERS))
+    for num_nodes, n_procs in ((50, 4), (200, 16), (500, 64)):
+        makespans = np.array([
+            [simulate(random_graph(num_nodes, n_procs=n_procs,
+                                   memory_gb=2. * n_procs,
+                                   edge_prob=2. / num_nodes, seed=seed),
+                      scheduler, n_procs=n_procs, memory_gb=2. * n_procs)
+             for scheduler in SCHEDULERS]
+            for seed in range(num_graphs)])
+        print('%5d  %6d  ' % (num_nodes, n_procs) +
+              '  '.join('%13.1f' % value for value in makespans.mean(0)))
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Tests and benchmark for the submission of small nodes with MultiProc
+
+Run as a script to print the throughput (nodes per second) of the different
+submission modes::
+
+    python test_multiproc_throughput.py [num_nodes]
+"""
+from __future__ import print_function, division
+import sys
+from multiprocessing import cpu_count
+from tempfile import mkdtemp
+from shutil import rmtree
+from time import time
+
+import pytest
+
+from nipype import logging
+from nipype.pipeline import engine as pe
+from nipype.interfaces import utility as niu
+from nipype.pipeline.plugins.multiproc import MultiProcPlugin, run_job
+
+
+def add_one(value):
+    return value + 1
+
+
+def _small_nodes_workflow(base_dir, num_nodes):
+    wf = pe.Workflow(name='throughput', base_dir=base_dir)
+    source = pe.Node(niu.IdentityInterface(fields=['value']), name='source')
+    source.iterables = ('value', list(range(num_nodes)))
+    inc = pe.Node(niu.Function(function=add_one, input_names=['value'],
+                               output_names=['out']), name='inc')
+    inc.interface.terminal_output = 'stream'
+    wf.connect(source, 'value', inc, 'value')
+    wf.config['execution']['poll_sleep_duration'] = 0.1
+    return wf
+
+
+def _run(wf, **plugin_args):
+    plugin_args.setdefault('n_procs', 2)
+    plugin_args.setdefault('event_driven', True)
+    execgraph = wf.run(plugin='MultiProc', plugin_args=plugin_args)
+    return sorted(node.get_output('out') for node in execgraph.nodes()
+                  if node.name == 'inc')
+
+
+def test_make_job(tmpdir):
+    node = pe.Node(niu.Function(function=add_one, input_names=['value'],
+                                output_names=['out']),
+                   name='inc', base_dir=str(tmpdir))
+    node.inputs.value = 1
+    node.config = {'execution': {'stop_on_first_crash': 'false'}}
+    node.interface.terminal_output = 'stream'
+
+    plugin = MultiProcPlugin(plugin_args={'n_procs': 1,
+                                          'job_descriptors': True})
+    job = plugin._make_job(node)
+    # the config is serialized only once and the node left untouched
+    assert plugin._make_job(node)[0] is job[0]
+    assert node.config == {'execution': {'stop_on_first_crash': 'false'}}
+    assert node.interface.terminal_output == 'stream'
+
+    result = run_job(job, False, 1)
+    assert result['traceback'] is None
+    assert result['result'].outputs.out == 2
+
+    result = run_job((job[0], b'garbage'), False, 2)
+    assert result['taskid'] == 2
+    assert result['traceback']
+    plugin._postrun_check()
+
+
+@pytest.mark.parametrize('job_descriptors', ['false', 'true'])
+def test_job_descriptors_option(job_descriptors):
+    # e.g. from a configuration file
+    plugin = MultiProcPlugin(plugin_args={'n_procs': 1,
+                                          'job_descriptors': job_descriptors})
+    assert plugin._job_descriptors is (job_descriptors == 'true')
+    plugin._postrun_check()
+
+
+@pytest.mark.parametrize('job_descriptors', [False, True])
+def test_small_nodes(tmpdir, job_descriptors):
+    wf = _small_nodes_workflow(str(tmpdir), 10)
+    outputs = _run(wf, job_descriptors=job_descriptors)
+    assert outputs == list(range(1, 11))
+
+
+def _benchmark(num_nodes):
+    logging.getLogger('workflow').setLevel('ERROR')
+    print('mode             nodes  time (s)  nodes/s')
+    for label, plugin_args in (('deepcopy', {}),
+                               ('job descriptors', {'job_descriptors': True})):
+        base_dir = mkdtemp()
+        try:
+            wf = _small_nodes_workflow(base_dir, num_nodes)
+            tic = time()
+            _run(wf, n_procs=cpu_count(), **plugin_args)
+            elapsed = time() - tic
+        finally:
+            rmtree(base_dir)
+        print('%-15s  %5d  %8.2f  %7.1f' % (label, num_nodes, elapsed,
+                                             num_nodes / elapsed))
+
+
+if __name__ == '__main__':
+    _benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 500)
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Tests for the Pilot plugin, with local workers"""
+import os
+
+import pytest
+
+import nipype
+from nipype.interfaces import utility as niu
+from nipype.pipeline import engine as pe
+from nipype.pipeline.plugins.pilot import PilotPlugin
+from nipype.utils.filemanip import loadpkl
+
+NIPYPE_ROOT = os.path.dirname(os.path.dirname(nipype.__file__))
+
+
+@pytest.fixture
+def worker_environ(monkeypatch):
+    # the workers import the same nipype as the tests
+    monkeypatch.setenv('PYTHONPATH', os.pathsep.join(
+        [NIPYPE_ROOT, os.environ.get('PYTHONPATH', '')]))
+
+
+def worker_pid(value):
+    import os
+    if value < 0:
+        raise ValueError('negative value')
+    return os.getpid()
+
+
+def test_pilot(tmpdir, worker_environ):
+    wf = pe.Workflow(name='pilot', base_dir=tmpdir.strpath)
+    source = pe.Node(niu.IdentityInterface(fields=['value']), name='source')
+    source.iterables = ('value', [1, 2, 3, 4, 5, 6, -1])
+    pid = pe.Node(niu.Function(function=worker_pid, input_names=['value'],
+                               output_names=['pid']), name='pid')
+    wf.connect(source, 'value', pid, 'value')
+    wf.config['execution']['poll_sleep_duration'] = 0.1
+    wf.config['execution']['crashdump_dir'] = tmpdir.strpath
+
+    plugin = PilotPlugin(plugin_args={'n_workers': 2})
+    with pytest.raises(RuntimeError):
+        wf.run(plugin=plugin)
+    # the nodes were run by the resident workers, which then stopped
+    pids = set()
+    for value in range(1, 7):
+        result = tmpdir.join('pilot', '_value_%d' % value, 'pid',
+                             'result_pid.pklz')
+        assert result.check()
+        pids.add(loadpkl(result.strpath).outputs.pid)
+    assert len(pids) <= 2
+    assert os.getpid() not in pids
+    assert plugin._workers == []
+    assert tmpdir.join('pilot', 'pilot', 'workers').listdir() == []
+    assert len(tmpdir.listdir(fil='crash-*')) == 1
+
+
+def test_dead_worker(tmpdir):
+    plugin = PilotPlugin(plugin_args={'n_workers': 0, 'heartbeat_timeout': 10})
+    plugin._queue_dir = tmpdir.strpath
+    for subdir in ('queued', 'running', 'workers'):
+        tmpdir.mkdir(subdir)
+    plugin._jobnames = {1: 'job1', 2: 'job2', 3: 'job3', 4: 'job4'}
+    tmpdir.join('queued', 'job1').write('')
+    tmpdir.join('workers', 'alive').write('')
+    tmpdir.join('running', 'alive__job2').write('')
+    tmpdir.join('workers', 'dead').write('')
+    os.utime(tmpdir.join('workers', 'dead').strpath, (0, 0))
+    tmpdir.join('running', 'dead__job3').write('')
+    assert plugin._query_pending([1, 2, 3, 4]) == set([1, 2])
+
+
+def test_restart_workers(tmpdir, worker_environ):
+    plugin = PilotPlugin(plugin_args={'n_workers': 2, 'idle_timeout': 0})
+    plugin._queue_dir = tmpdir.strpath
+    for subdir in ('queued', 'running', 'finished', 'workers'):
+        tmpdir.mkdir(subdir)
+    for _ in range(2):
+        plugin._start_worker()
+    workers = list(plugin._workers)
+    # the idle workers exit
+    for worker in workers:
+        assert worker.wait() == 0
+    plugin._query_pending([])
+    assert plugin._workers == workers
+
+    # and are started again for new jobs
+    tmpdir.join('queued', 'job1').write('')
+    plugin._query_pending([])
+    assert all(worker not in workers for worker in plugin._workers)
+    plugin._postrun_check()
@@ -8,8 +8,13 @@ import scipy.sparse as ssp
 import re
 
 import mock
+import pytest
 
-from nipype.pipeline.plugins.tools import report_crash
+from nipype.interfaces import utility as niu
+from nipype.pipeline import engine as pe
+from nipype.pipeline.plugins.tools import (report_crash, create_pyscript,
+                                           run_pyscript)
+from nipype.utils.filemanip import loadpkl
 
 def test_report_crash():
     with mock.patch('pickle.dump', mock.MagicMock()) as mock_pickle_dump:
@@ -31,6 +36,52 @@ def test_report_crash():
             assert expected_crashfile.match(actual_crashfile).group() == actual_crashfile
             assert mock_pickle_dump.call_count == 1
 
+
+def divide(a, b):
+    return a / b
+
+
+def test_create_pyscript(tmpdir):
+    nodes = []
+    for b in (2, 0):
+        node = pe.Node(niu.Function(function=divide, input_names=['a', 'b'],
+                                    output_names=['out']),
+                       name='divide%d' % b, base_dir=tmpdir.strpath)
+        node.inputs.a = 6
+        node.inputs.b = b
+        node.config = {'execution': {'crashdump_dir': tmpdir.strpath,
+                                     'matplotlib_backend': 'Agg',
+                                     'crashfile_format': 'pklz'}}
+        nodes.append(node)
+    pyscripts = [create_pyscript(node) for node in nodes]
+    # the nodes share a single snapshot of the configuration
+    assert len(tmpdir.join('batch').listdir(fil='config_*.json')) == 1
+    assert "MPLBACKEND'] = 'Agg'" in open(pyscripts[0]).read()
+
+    def run(pyscript):
+        # run the script in-process
+        code = open(pyscript).read().replace(
+            'from nipype.pipeline.plugins.tools import run_pyscript', '')
+        exec(code, {'run_pyscript': run_pyscript})
+
+    run(pyscripts[0])
+    result = loadpkl(tmpdir.join('divide2', 'result_divide2.pklz').strpath)
+    assert result.outputs.out == 3
+
+    run(pyscripts[1])
+    result = loadpkl(tmpdir.join('divide0', 'result_divide0.pklz').strpath)
+    assert 'ZeroDivisionError' in ''.join(result['traceback'])
+
+    pyscript = create_pyscript(nodes[1], store_exception=False)
+    with pytest.raises(ZeroDivisionError):
+        run(pyscript)
+    assert len(tmpdir.listdir(fil='crash-*')) == 1
+
+    # a removed batch directory gets a new snapshot
+    tmpdir.join('batch').remove()
+    run(create_pyscript(nodes[0]))
+    assert len(tmpdir.join('batch').listdir(fil='config_*.json')) == 1
+
 '''
 Can use the following code to test that a mapnode crash continues successfully
 Need to put this into a nose-test with a timeout
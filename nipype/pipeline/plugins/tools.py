@@ -8,6 +8,8 @@ from builtins import open
 
 import os
 import getpass
+import hashlib
+import json
 from socket import gethostname
 import sys
 import uuid
@@ -15,7 +17,7 @@ from time import strftime
 from traceback import format_exception
 
 from ... import logging
-from ...utils.filemanip import savepkl, crash2txt
+from ...utils.filemanip import loadpkl, savepkl, crash2txt
 
 logger = logging.getLogger('workflow')
 
@@ -52,10 +54,18 @@ def report_crash(node, traceback=None, hostname=None):
         crashfile += '.pklz'
 
     logger.error('Saving crash info to %s\n%s', crashfile, ''.join(traceback))
-    if crashfile.endswith('.txt'):
-        crash2txt(crashfile, dict(node=node, traceback=traceback))
-    else:
-        savepkl(crashfile, dict(node=node, traceback=traceback))
+    # the crash files hold the runtime record of the results files
+    compacted = []
+    if hasattr(node, '_compact_result'):
+        compacted = node._compact_result(getattr(node, '_result', None))
+    try:
+        if crashfile.endswith('.txt'):
+            crash2txt(crashfile, dict(node=node, traceback=traceback))
+        else:
+            savepkl(crashfile, dict(node=node, traceback=traceback))
+    finally:
+        if compacted:
+            node._restore_environ(compacted)
     return crashfile
 
 
@@ -80,8 +90,39 @@ def report_nodes_not_run(notrun):
                             'Check log for details'))
 
 
+def _config_snapshot(batch_dir, node_config):
+    """Write the configuration of a node to the batch directory
+
+    The nodes of a run usually share the same configuration, which is
+    written only once, under the digest of its content.
+    """
+    serialized = json.dumps(node_config, sort_keys=True, default=str)
+    key = (batch_dir, serialized)
+    if key not in _config_snapshots:
+        digest = hashlib.sha1(serialized.encode('utf-8')).hexdigest()
+        _config_snapshots[key] = os.path.join(batch_dir,
+                                              'config_%s.json' % digest)
+    config_file = _config_snapshots[key]
+    # the batch directory may have been cleaned up since the last snapshot
+    if not os.path.exists(config_file):
+        tmpfile = '%s.%s' % (config_file, uuid.uuid4().hex)
+        with open(tmpfile, 'wb') as fp:
+            fp.write(serialized.encode('utf-8'))
+        os.rename(tmpfile, config_file)
+    return config_file
+
+
+# {(batch directory, serialized config): config file}
+_config_snapshots = {}
+
+
 def create_pyscript(node, updatehash=False, store_exception=True):
-    # pickle node
+    """Pickle a node and create the python script running it
+
+    The script only sets the matplotlib backend and hands the pickled node
+    over to :func:`run_pyscript`, along with the configuration snapshot of
+    the run.
+    """
     timestamp = strftime('%Y%m%d_%H%M%S')
     if node._hierarchy:
         suffix = '%s_%s_%s' % (timestamp, node._hierarchy, node._id)
@@ -96,68 +137,105 @@ def create_pyscript(node, updatehash=False, store_exception=True):
     pkl_file = os.path.join(batch_dir, 'node_%s.pklz' % suffix)
     savepkl(pkl_file, dict(node=node, updatehash=updatehash))
     mpl_backend = node.config["execution"]["matplotlib_backend"]
-    # create python script to load and trap exception
+    config_file = _config_snapshot(batch_dir, node.config)
+    # matplotlib picks its backend from the environment, when and if it is
+    # imported by the node
+    cmdstr = """import os
+os.environ['MPLBACKEND'] = %r
+from nipype.pipeline.plugins.tools import run_pyscript
+run_pyscript(%r, %r, %r, %r, store_exception=%r)
+""" % (str(mpl_backend), str(pkl_file), str(batch_dir), str(suffix),
+       str(config_file), store_exception)
+    pyscript = os.path.join(batch_dir, 'pyscript_%s.py' % suffix)
+    with open(pyscript, 'wt') as fp:
+        fp.writelines(cmdstr)
+    return pyscript
+
+
+def run_pyscript(pklfile, batch_dir, suffix, config_file,
+                 store_exception=True):
+    """Run a node pickled by :func:`create_pyscript`
+
+    The results of the node, or the traceback of its failure, are saved in
+    its ``result_<name>.pklz`` file, or in a crashdump of the batch directory
+    if the node could not be loaded. With ``store_exception=False`` the crash
+    is reported instead, and the exception raised again.
+    """
+    from ... import config
+    info = None
+    cwd = os.getcwd()
+    try:
+        with open(config_file) as fp:
+            config.update_config(json.load(fp))
+        logging.update_logging(config)
+        info = loadpkl(pklfile)
+        info['node'].run(updatehash=info['updatehash'])
+    except Exception:
+        traceback = format_exception(*sys.exc_info())
+        # a failing node may leave us in its working directory
+        os.chdir(cwd)
+        if info is None or not os.path.exists(info['node'].output_dir()):
+            result = None
+            resultsfile = os.path.join(batch_dir, 'crashdump_%s.pklz' % suffix)
+        else:
+            result = info['node'].result
+            resultsfile = os.path.join(info['node'].output_dir(),
+                                       'result_%s.pklz' % info['node'].name)
+        if store_exception or info is None:
+            savepkl(resultsfile, dict(result=result, hostname=gethostname(),
+                                      traceback=traceback))
+        if not store_exception:
+            if info is not None:
+                report_crash(info['node'], traceback, gethostname())
+            raise
+
+
+def create_bundle_pyscript(pyscripts, notifications, n_procs=1):
+    """Create a python script running several node scripts in one job
+
+    The node scripts (see :func:`create_pyscript`) are run in the same
+    interpreter, one after the other, or in a pool of ``n_procs`` forked
+    processes, so that nipype is imported only once per job. The completion
+    of each node is notified by touching its file in ``notifications``.
+    """
     cmdstr = """import os
 import sys
+from runpy import run_path
+from traceback import print_exc
 
-can_import_matplotlib = True #Silently allow matplotlib to be ignored
-try:
-    import matplotlib
-    matplotlib.use('%s')
-except ImportError:
-    can_import_matplotlib = False
-    pass
+# import nipype once for all the nodes of the bundle
+import nipype.pipeline.engine
 
-from nipype import config, logging
-from nipype.utils.filemanip import loadpkl, savepkl
-from socket import gethostname
-from traceback import format_exception
-info = None
-pklfile = '%s'
-batchdir = '%s'
-from nipype.utils.filemanip import loadpkl, savepkl
-try:
-    if not sys.version_info < (2, 7):
-        from collections import OrderedDict
-    config_dict=%s
-    config.update_config(config_dict)
-    ## Only configure matplotlib if it was successfully imported,
-    ## matplotlib is an optional component to nipype
-    if can_import_matplotlib:
-        config.update_matplotlib()
-    logging.update_logging(config)
-    traceback=None
+pyscripts = %r
+notifications = %r
+n_procs = %d
+
+
+def run_node(args):
+    pyscript, notification = args
     cwd = os.getcwd()
-    info = loadpkl(pklfile)
-    result = info['node'].run(updatehash=info['updatehash'])
-except Exception as e:
-    etype, eval, etr = sys.exc_info()
-    traceback = format_exception(etype,eval,etr)
-    if info is None or not os.path.exists(info['node'].output_dir()):
-        result = None
-        resultsfile = os.path.join(batchdir, 'crashdump_%s.pklz')
-    else:
-        result = info['node'].result
-        resultsfile = os.path.join(info['node'].output_dir(),
-                               'result_%%s.pklz'%%info['node'].name)
-"""
-    if store_exception:
-        cmdstr += """
-    savepkl(resultsfile, dict(result=result, hostname=gethostname(),
-                              traceback=traceback))
-"""
-    else:
-        cmdstr += """
-    if info is None:
-        savepkl(resultsfile, dict(result=result, hostname=gethostname(),
-                              traceback=traceback))
-    else:
-        from nipype.pipeline.plugins.base import report_crash
-        report_crash(info['node'], traceback, gethostname())
-    raise Exception(e)
-"""
-    cmdstr = cmdstr % (mpl_backend, pkl_file, batch_dir, node.config, suffix)
-    pyscript = os.path.join(batch_dir, 'pyscript_%s.py' % suffix)
-    with open(pyscript, 'wt') as fp:
+    try:
+        run_path(pyscript)
+    except Exception:
+        print_exc()
+    finally:
+        os.chdir(cwd)
+        open(notification, 'a').close()
+
+
+if n_procs > 1:
+    from multiprocessing import Pool
+    pool = Pool(n_procs)
+    pool.map(run_node, list(zip(pyscripts, notifications)), chunksize=1)
+    pool.close()
+    pool.join()
+else:
+    for args in zip(pyscripts, notifications):
+        run_node(args)
+""" % ([str(name) for name in pyscripts],
+       [str(name) for name in notifications], n_procs)
+    batch_dir, name = os.path.split(pyscripts[0])
+    bundlescript = os.path.join(batch_dir, 'bundle_%s' % name)
+    with open(bundlescript, 'wt') as fp:
         fp.writelines(cmdstr)
-    return pyscript
+    return bundlescript
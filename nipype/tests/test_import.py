@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Tests and benchmark for the time taken by ``import nipype``
+
+Run as a script to print the import timings::
+
+    python test_import.py
+"""
+from __future__ import print_function, division
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import nipype
+
+NIPYPE_ROOT = os.path.dirname(os.path.dirname(nipype.__file__))
+
+# never imported by ``import nipype``
+HEAVY_MODULES = ('nipype.pipeline', 'nipype.interfaces.io', 'networkx',
+                 'scipy', 'nibabel', 'prov')
+
+IMPORT_CODE = """
+import json, sys, time
+tic = time.time()
+%s
+elapsed = time.time() - tic
+print(json.dumps([elapsed, sorted(sys.modules)]))
+"""
+
+
+def _import(statement):
+    """Time an import statement in a fresh interpreter"""
+    environ = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [NIPYPE_ROOT, os.environ.get('PYTHONPATH', '')]))
+    output = subprocess.check_output(
+        [sys.executable, '-c', IMPORT_CODE % statement], env=environ)
+    return json.loads(output.decode().splitlines()[-1])
+
+
+def test_lazy_attributes():
+    from nipype import Workflow, interfaces
+    from nipype.interfaces import Function
+    assert Workflow is nipype.pipeline.engine.Workflow
+    assert Function is interfaces.utility.Function
+    assert 'DataSink' in dir(interfaces)
+    with pytest.raises(AttributeError):
+        nipype.NotAnAttribute
+
+
+def test_import_budget():
+    """``import nipype`` leaves the pipeline and interfaces alone
+
+    The timings are left to the benchmark (run this file as a script), as
+    they vary too much across machines and loads to be asserted.
+    """
+    _, modules = _import('import nipype')
+    assert [module for module in HEAVY_MODULES if module in modules] == []
+    _, full = _import('import nipype; nipype.Workflow; nipype.DataSink')
+    assert all(module in full for module in HEAVY_MODULES[:2])
+    assert set(modules) < set(full)
+
+
+if __name__ == '__main__':
+    for statement in ('import nipype',
+                      'import nipype.interfaces.base',
+                      'import nipype.pipeline.engine',
+                      'import nipype; nipype.Workflow; nipype.DataSink'):
+        elapsed, modules = _import(statement)
+        print('%-50s %6.3f s  %4d modules' % (statement, elapsed,
+                                               len(modules)))
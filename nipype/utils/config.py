@@ -53,6 +53,15 @@ log_rotate = 4
 create_report = true
 crashdump_dir = %s
 hash_method = timestamp
+content_hash_algorithm = md5
+hash_cache_size = 10000
+hash_cache_file =
+hash_threads = 1
+hash_index = false
+result_index = false
+directory_index = false
+runtime_environ = compact
+expansion_batch_size = 0
 job_finished_timeout = 5
 keep_inputs = false
 local_hash_check = true
@@ -60,6 +69,7 @@ matplotlib_backend = Agg
 plugin = Linear
 remove_node_directories = false
 remove_unnecessary_outputs = true
+background_cleanup = false
 try_hard_link_datasink = true
 single_thread_matlab = true
 crashfile_format = pklz
@@ -7,6 +7,9 @@
 from __future__ import print_function, division, unicode_literals, absolute_import
 
 import sys
+import errno
+import fnmatch
+import glob
 import pickle
 import subprocess
 import gzip
@@ -17,13 +20,25 @@ import os
 import re
 import shutil
 import posixpath
+import threading
+from collections import OrderedDict
+from functools import partial
+from time import time
+from types import GeneratorType
 import simplejson as json
 import numpy as np
 
 from builtins import str, bytes, open
+try:
+    from os import scandir
+except ImportError:  # Python 2
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 from .. import logging, config
-from .misc import is_container
+from .misc import is_container, str2bool
 from ..interfaces.traits_extension import isdefined
 
 from future import standard_library
@@ -213,11 +228,379 @@ def check_forhash(filename):
         return False, None
 
 
-def hash_infile(afile, chunk_len=8192, crypto=hashlib.md5):
-    """ Computes hash of a file using 'crypto' module"""
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def get_hash_algorithm(name=None):
+    """Return the constructor of hash objects for a content hash algorithm
+
+    ``name`` is one of ``md5``, ``sha1``, ``sha256``, ``blake2b`` (128 bits,
+    much faster than md5 on 64-bit machines, needs Python 3.6) or ``xxhash``
+    (non-cryptographic, needs the ``xxhash`` package). Defaults to the
+    ``content_hash_algorithm`` configuration option.
+
+    >>> get_hash_algorithm('md5')().hexdigest()
+    'd41d8cd98f00b204e9800998ecf8427e'
+    """
+    if name is None:
+        name = config.get('execution', 'content_hash_algorithm', 'md5')
+    name = name.lower()
+    if name == 'blake2b':
+        try:
+            return partial(hashlib.blake2b, digest_size=16)
+        except AttributeError:
+            raise RuntimeError('blake2b requires Python 3.6 or later')
+    if name == 'xxhash':
+        try:
+            import xxhash
+        except ImportError:
+            raise RuntimeError('the xxhash hash algorithm requires the '
+                               'xxhash package')
+        return xxhash.xxh64
+    if name in ('md5', 'sha1', 'sha256', 'sha512'):
+        return getattr(hashlib, name)
+    raise ValueError('Unknown content hash algorithm: %s' % name)
+
+
+class FileHashCache(object):
+    """
+    A memo of the content hashes of files
+
+    Entries are keyed by the device, inode, size and modification time
+    (in ns) of the file, and the hash algorithm, so that a file is only
+    hashed again when modified. The most recently used ``maxsize``
+    entries are kept in memory and, if ``filename`` is given, in a SQLite
+    database shared by all the processes of a run (and later runs).
+    As the modification times of some filesystems (e.g., NFS) only have a
+    resolution of a second, :func:`hash_infile` does not remember the hashes
+    of files modified less than ``granularity`` seconds before hashing.
+
+    >>> cache = FileHashCache(maxsize=2)
+    >>> cache.get(('md5', 1, 2, 3, 4)) is None
+    True
+    >>> cache.set(('md5', 1, 2, 3, 4), 'abc')
+    >>> cache.get(('md5', 1, 2, 3, 4))
+    'abc'
+    """
+
+    def __init__(self, maxsize=10000, filename=None, granularity=2.):
+        self.maxsize = maxsize
+        self.filename = filename
+        self.granularity = granularity
+        self._memo = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._inserts = 0
+
+    def _connect(self):
+        # Connections cannot be shared across forked processes
+        if self._db is None or self._db[0] != os.getpid():
+            import sqlite3
+            db = sqlite3.connect(self.filename, timeout=30,
+                                 check_same_thread=False)
+            db.execute('CREATE TABLE IF NOT EXISTS hashes (algorithm TEXT, '
+                       'dev INTEGER, ino INTEGER, size INTEGER, '
+                       'mtime INTEGER, hash TEXT, used REAL, '
+                       'PRIMARY KEY (algorithm, dev, ino, size, mtime))')
+            db.commit()
+            self._db = (os.getpid(), db)
+        return self._db[1]
+
+    def get(self, key):
+        """Return the hash stored for ``key``, or ``None``"""
+        with self._lock:
+            value = self._memo.pop(key, None)
+            if value is not None:
+                self._memo[key] = value
+                return value
+            if self.filename is None:
+                return None
+            try:
+                db = self._connect()
+                row = db.execute(
+                    'SELECT hash FROM hashes WHERE algorithm = ? AND dev = ? '
+                    'AND ino = ? AND size = ? AND mtime = ?', key).fetchone()
+                if row is not None:
+                    with db:
+                        db.execute(
+                            'UPDATE hashes SET used = ? WHERE algorithm = ? '
+                            'AND dev = ? AND ino = ? AND size = ? AND '
+                            'mtime = ?', (time(),) + tuple(key))
+            except Exception as exc:
+                fmlogger.debug('Error reading the hash cache %s: %s',
+                               self.filename, exc)
+                return None
+        if row is not None:
+            self._remember(key, row[0])
+            return row[0]
+        return None
+
+    def set(self, key, value):
+        """Store the hash of a file"""
+        self._remember(key, value)
+        if self.filename is None:
+            return
+        with self._lock:
+            try:
+                db = self._connect()
+                with db:
+                    db.execute('INSERT OR REPLACE INTO hashes VALUES '
+                               '(?, ?, ?, ?, ?, ?, ?)',
+                               tuple(key) + (value, time()))
+                    self._inserts += 1
+                    if self._inserts % 100 == 0:
+                        # Least recently used entries go first
+                        db.execute('DELETE FROM hashes WHERE rowid NOT IN '
+                                   '(SELECT rowid FROM hashes ORDER BY used '
+                                   'DESC LIMIT ?)', (self.maxsize,))
+            except Exception as exc:
+                fmlogger.debug('Error writing the hash cache %s: %s',
+                               self.filename, exc)
+
+    def _remember(self, key, value):
+        with self._lock:
+            self._memo.pop(key, None)
+            self._memo[key] = value
+            while len(self._memo) > self.maxsize:
+                self._memo.popitem(last=False)
+
+    def clear(self):
+        """Empty the in-memory cache"""
+        with self._lock:
+            self._memo.clear()
+
+
+_hash_cache = None
+
+
+def get_hash_cache():
+    """Return the process-wide :class:`FileHashCache`, or ``None`` if disabled
+
+    Configured by the ``hash_cache_size`` and ``hash_cache_file`` options of
+    the ``execution`` section.
+    """
+    global _hash_cache
+    maxsize = int(config.get('execution', 'hash_cache_size', 10000))
+    filename = config.get('execution', 'hash_cache_file', '') or None
+    if maxsize <= 0:
+        return None
+    if filename is not None:
+        filename = os.path.abspath(os.path.expanduser(filename))
+    if (_hash_cache is None or _hash_cache.maxsize != maxsize or
+            _hash_cache.filename != filename):
+        _hash_cache = FileHashCache(maxsize, filename)
+    return _hash_cache
+
+
+def _hash_cache_key(afile, algorithm):
+    stat = os.stat(afile)
+    mtime = getattr(stat, 'st_mtime_ns', None)
+    if mtime is None:
+        mtime = int(stat.st_mtime * 1e9)
+    return (algorithm, stat.st_dev, stat.st_ino, stat.st_size, mtime)
+
+
+class DirectoryIndex(object):
+    """
+    A memo of the listings of directories, answering :func:`glob.glob` and
+    :func:`os.walk`
+
+    A listing is revalidated with the modification time of its directory,
+    so that a directory is only listed again when entries were added or
+    removed. As the modification times of some filesystems (e.g., NFS) only
+    have a resolution of a second, listings taken less than ``granularity``
+    seconds after a modification of their directory are not remembered.
+
+    >>> index = DirectoryIndex()
+    >>> pattern = os.path.join(os.path.dirname(__file__), 'filemanip.py*')
+    >>> index.glob(pattern) == glob.glob(pattern)
+    True
+    """
+
+    def __init__(self, granularity=2.):
+        self.granularity = granularity
+        self._listings = {}
+        self._lock = threading.Lock()
+
+    def listdir(self, path):
+        """Return the {name: (is a directory, is a symbolic link)} entries of
+        a directory, in the order of :func:`os.listdir`
+
+        Raises an :class:`OSError` if ``path`` cannot be listed.
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        mtime = getattr(stat, 'st_mtime_ns', None)
+        if mtime is None:
+            mtime = int(stat.st_mtime * 1e9)
+        with self._lock:
+            cached = self._listings.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        listed = time()
+        entries = OrderedDict()
+        if scandir is None:
+            for name in os.listdir(path):
+                fullname = os.path.join(path, name)
+                entries[name] = (os.path.isdir(fullname),
+                                 os.path.islink(fullname))
+        else:
+            for entry in scandir(path):
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                entries[entry.name] = (is_dir, entry.is_symlink())
+        if listed - mtime / 1e9 > self.granularity:
+            with self._lock:
+                self._listings[path] = (mtime, entries)
+        return entries
+
+    def _entry(self, path):
+        dirname, basename = os.path.split(path)
+        if basename in ('', os.curdir, os.pardir):
+            return None
+        try:
+            return self.listdir(dirname or os.curdir).get(basename, False)
+        except OSError:
+            return False
+
+    def lexists(self, path):
+        """Same as :func:`os.path.lexists`"""
+        entry = self._entry(path)
+        if entry is None:
+            return os.path.lexists(path)
+        return entry is not False
+
+    def isdir(self, path):
+        """Same as :func:`os.path.isdir`"""
+        entry = self._entry(path)
+        if entry is None:
+            return os.path.isdir(path)
+        return entry is not False and entry[0]
+
+    def glob(self, pathname):
+        """Same as :func:`glob.glob` (without ``recursive``)"""
+        return list(self._iglob(pathname, False))
+
+    def _iglob(self, pathname, dironly):
+        # follows the implementation of the glob module
+        dirname, basename = os.path.split(pathname)
+        if not glob.has_magic(pathname):
+            if basename:
+                if self.lexists(pathname):
+                    yield pathname
+            elif self.isdir(dirname):
+                yield pathname
+            return
+        if not dirname:
+            for name in self._glob1(dirname, basename, dironly):
+                yield name
+            return
+        if dirname != pathname and glob.has_magic(dirname):
+            dirs = self._iglob(dirname, True)
+        else:
+            dirs = [dirname]
+        for dirname in dirs:
+            if glob.has_magic(basename):
+                names = self._glob1(dirname, basename, dironly)
+            elif basename:
+                names = [basename] if self.lexists(
+                    os.path.join(dirname, basename)) else []
+            else:
+                names = [basename] if self.isdir(dirname) else []
+            for name in names:
+                yield os.path.join(dirname, name)
+
+    def _glob1(self, dirname, pattern, dironly):
+        try:
+            entries = self.listdir(dirname or os.curdir)
+        except OSError:
+            return []
+        names = [name for name, (is_dir, _) in entries.items()
+                 if is_dir or not dironly]
+        if not pattern.startswith('.'):
+            names = [name for name in names if not name.startswith('.')]
+        return fnmatch.filter(names, pattern)
+
+    def walk(self, top):
+        """Same as :func:`os.walk` (top-down, without following symbolic
+        links)"""
+        try:
+            entries = self.listdir(top)
+        except OSError:
+            return
+        dirs = [name for name, (is_dir, _) in entries.items() if is_dir]
+        nondirs = [name for name, (is_dir, _) in entries.items()
+                   if not is_dir]
+        yield top, dirs, nondirs
+        for name in dirs:
+            path = os.path.join(top, name)
+            if name in entries:
+                is_link = entries[name][1]
+            else:
+                is_link = os.path.islink(path)
+            if not is_link:
+                for result in self.walk(path):
+                    yield result
+
+    def clear(self):
+        """Forget all the listings"""
+        with self._lock:
+            self._listings.clear()
+
+
+_directory_index = DirectoryIndex()
+# the directory_index option of the node running in the current thread
+_directory_index_option = threading.local()
+
+
+def set_directory_index_option(enabled):
+    """Override the ``directory_index`` option of the global configuration in
+    the current thread, and return the previous override
+
+    Nodes set their own option while their interface runs; ``None`` restores
+    the global option.
+    """
+    previous = getattr(_directory_index_option, 'enabled', None)
+    _directory_index_option.enabled = enabled
+    return previous
+
+
+def get_directory_index(enabled=None):
+    """Return the process-wide :class:`DirectoryIndex`, or ``None`` if
+    disabled
+
+    Enabled by the ``directory_index`` option of the ``execution`` section,
+    taken from ``enabled``, from the node running in the current thread (see
+    :func:`set_directory_index_option`), or from the global configuration.
+    """
+    if enabled is None:
+        enabled = getattr(_directory_index_option, 'enabled', None)
+    if enabled is None:
+        enabled = config.get('execution', 'directory_index', 'false')
+    if not str2bool(enabled):
+        return None
+    return _directory_index
+
+
+def hash_infile(afile, chunk_len=HASH_CHUNK_SIZE, crypto=hashlib.md5):
+    """ Computes hash of a file using 'crypto' module
+
+    Hashes are memoized by the process-wide :class:`FileHashCache`
+    (see :func:`get_hash_cache`), and only recomputed if the file changes.
+    """
     hex = None
     if os.path.isfile(afile):
         crypto_obj = crypto()
+        cache = get_hash_cache()
+        if cache is not None:
+            key = _hash_cache_key(afile, '%s-%d' % (
+                getattr(crypto_obj, 'name', crypto), crypto_obj.digest_size))
+            hex = cache.get(key)
+            if hex is not None:
+                return hex
+            started = time()
         with open(afile, 'rb') as fp:
             while True:
                 data = fp.read(chunk_len)
@@ -225,6 +608,11 @@ def hash_infile(afile, chunk_len=8192, crypto=hashlib.md5):
                     break
                 crypto_obj.update(data)
         hex = crypto_obj.hexdigest()
+        # Do not remember files modified while being read, or so recently that
+        # a later modification may not change their modification time
+        if cache is not None and key == _hash_cache_key(afile, key[0]) and \
+                started - key[4] / 1e9 > cache.granularity:
+            cache.set(key, hex)
     return hex
 
 
@@ -240,32 +628,209 @@ def hash_timestamp(afile):
     return md5hex
 
 
-def _generate_cifs_table():
+def _parse_mountinfo(content):
+    """Parse the ``/proc/<pid>/mountinfo`` table of Linux
+
+    Returns the (mount point, filesystem type) of each mount.
+    """
+    mounts = []
+    for line in content.splitlines():
+        fields = line.split()
+        if '-' not in fields[6:]:
+            continue
+        separator = fields.index('-', 6)
+        # spaces, tabs and backslashes are octal-escaped
+        mountpoint = re.sub(r'\\([0-7]{3})',
+                            lambda m: chr(int(m.group(1), 8)), fields[4])
+        mounts.append((mountpoint, fields[separator + 1]))
+    return mounts
+
+
+def _generate_mount_table():
+    """Construct a reverse-length-ordered list of the (mount point,
+    filesystem type) of the mounts.
+
+    The table is read from ``/proc/self/mountinfo`` on Linux, and from the
+    output of the ``mount`` command on other POSIX systems. On systems with
+    neither, returns an empty list.
+    """
+    try:
+        with open('/proc/self/mountinfo') as fp:
+            mount_info = _parse_mountinfo(fp.read())
+    except (IOError, OSError):
+        exit_code, output = subprocess.getstatusoutput("mount")
+        # Not POSIX
+        if exit_code != 0:
+            return []
+        mount_info = [tuple(line.split()[2:5:2])
+                      for line in output.splitlines()]
+
+    # sorted by path length (longest first)
+    return sorted(mount_info, key=lambda x: len(x[0]), reverse=True)
+
+
+def _generate_cifs_table(mount_info=None):
     """Construct a reverse-length-ordered list of mount points that
     fall under a CIFS mount.
 
     This precomputation allows efficient checking for whether a given path
     would be on a CIFS filesystem.
 
-    On systems without a ``mount`` command, or with no CIFS mounts, returns an
-    empty list.
+    With no CIFS mounts, returns an empty list.
     """
-    exit_code, output = subprocess.getstatusoutput("mount")
-    # Not POSIX
-    if exit_code != 0:
-        return []
-
-    # (path, fstype) tuples, sorted by path length (longest first)
-    mount_info = sorted((line.split()[2:5:2] for line in output.splitlines()),
-                        key=lambda x: len(x[0]),
-                        reverse=True)
+    if mount_info is None:
+        mount_info = _get_mount_table()
     cifs_paths = [path for path, fstype in mount_info if fstype == 'cifs']
 
     return [mount for mount in mount_info
             if any(mount[0].startswith(path) for path in cifs_paths)]
 
 
-_cifs_table = _generate_cifs_table()
+# generated on first use
+_mount_table = []
+_cifs_table = []
+_cifs_table_generated = []
+_cifs_table_lock = threading.Lock()
+
+
+def _get_mount_table():
+    if not _mount_table:
+        with _cifs_table_lock:
+            if not _mount_table:
+                _mount_table.extend(_generate_mount_table() or [('/', None)])
+    return _mount_table
+
+
+def _get_cifs_table():
+    if not _cifs_table_generated:
+        mount_info = _get_mount_table()
+        with _cifs_table_lock:
+            if not _cifs_table_generated:
+                _cifs_table.extend(_generate_cifs_table(mount_info))
+                _cifs_table_generated.append(True)
+    return _cifs_table
+
+
+# The errors telling that an operation is not supported between two
+# filesystems, as opposed to failures specific to one file (e.g. permissions)
+_UNSUPPORTED_ERRNOS = set(
+    getattr(errno, name) for name in ('EXDEV', 'EOPNOTSUPP', 'ENOTSUP',
+                                      'ENOSYS')
+    if hasattr(errno, name))
+# the FICLONE ioctl fails with these on the filesystems without reflinks
+_UNSUPPORTED_REFLINK_ERRNOS = _UNSUPPORTED_ERRNOS | set(
+    getattr(errno, name) for name in ('ENOTTY', 'EINVAL')
+    if hasattr(errno, name))
+
+# {(operation, source device, destination device): supported}, learnt from
+# the first attempt of each operation between two filesystems
+_fs_capabilities = {}
+
+
+def _fs_devices(originalfile, newfile):
+    """The devices of the filesystems holding ``originalfile`` (symbolic links
+    resolved) and the directory of ``newfile``, or ``None``"""
+    try:
+        return (os.stat(originalfile).st_dev,
+                os.stat(os.path.dirname(os.path.abspath(newfile))).st_dev)
+    except OSError:
+        return None
+
+
+# the FICLONE ioctl of Linux, cloning the content of a file (reflink) on
+# copy-on-write filesystems (btrfs, xfs, ...)
+_FICLONE = 0x40049409
+
+
+def _reflink(originalfile, newfile):
+    import fcntl
+    # never truncate an existing file, e.g. a link to originalfile
+    fd = os.open(newfile, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        with open(originalfile, 'rb') as src:
+            fcntl.ioctl(fd, _FICLONE, src.fileno())
+    except (IOError, OSError):
+        os.close(fd)
+        os.unlink(newfile)
+        raise
+    os.close(fd)
+
+
+def _try_fs_operation(operation, func, originalfile, newfile,
+                      unsupported=_UNSUPPORTED_ERRNOS):
+    """Run ``func(originalfile, newfile)``, unless ``operation`` is known
+    to be unsupported between the filesystems of the two files.
+
+    The operation is remembered as unsupported when it fails with one of the
+    ``unsupported`` errnos. Returns whether the operation succeeded.
+    """
+    devices = _fs_devices(originalfile, newfile)
+    key = None if devices is None else (operation, ) + devices
+    if key is not None and _fs_capabilities.get(key) is False:
+        return False
+    try:
+        func(originalfile, newfile)
+    except (IOError, OSError) as e:
+        if key is not None and e.errno in unsupported:
+            fmlogger.debug('%s not supported from device %d to %d',
+                           operation, key[1], key[2])
+            _fs_capabilities[key] = False
+        return False
+    if key is not None:
+        _fs_capabilities[key] = True
+    return True
+
+
+def _link_or_copy(originalfile, newfile, copy=False, use_hardlink=False):
+    """Hard-link, symlink or copy ``originalfile`` to the new file
+    ``newfile``.
+
+    Returns the ``copy`` and ``use_hardlink`` options for the associated
+    files, disabling the links which failed.
+    """
+    # use_hardlink & can_hardlink => hardlink
+    # ~hardlink & ~copy & can_symlink => symlink
+    # ~hardlink & ~symlink => reflink or copy
+    if use_hardlink:
+        fmlogger.debug('Linking File: %s->%s', newfile, originalfile)
+        # Use realpath to avoid hardlinking symlinks
+        if _try_fs_operation('hardlink', lambda src, dst: os.link(
+                os.path.realpath(src), dst), originalfile, newfile):
+            return copy, use_hardlink
+        use_hardlink = False  # Disable hardlink for associated files
+
+    if not copy and os.name == 'posix':
+        fmlogger.debug('Symlinking File: %s->%s', newfile, originalfile)
+        if _try_fs_operation('symlink', os.symlink, originalfile, newfile):
+            return copy, use_hardlink
+        copy = True  # Disable symlink for associated files
+
+    fmlogger.debug('Copying File: %s->%s', newfile, originalfile)
+    if sys.platform.startswith('linux') and _try_fs_operation(
+            'reflink', _reflink, originalfile, newfile,
+            unsupported=_UNSUPPORTED_REFLINK_ERRNOS):
+        return copy, use_hardlink
+    try:
+        shutil.copyfile(originalfile, newfile)
+    except shutil.Error as e:
+        fmlogger.warn(e.message)
+    return copy, use_hardlink
+
+
+def _new_filename(newfile, exists=os.path.exists):
+    """Add or increment a ``_cXXXX`` suffix to ``newfile`` until it does not
+    exist"""
+    while exists(newfile):
+        base, fname, ext = split_filename(newfile)
+        s = re.search('_c[0-9]{4,4}$', fname)
+        i = 0
+        if s:
+            i = int(s.group()[2:]) + 1
+            fname = fname[:-6] + "_c%04d" % i
+        else:
+            fname += "_c%04d" % i
+        newfile = base + os.sep + fname + ext
+    return newfile
 
 
 def on_cifs(fname):
@@ -282,7 +847,7 @@ def on_cifs(fname):
     This check is written to support disabling symlinks on CIFS shares.
     """
     # Only the first match (most recent parent) counts
-    for fspath, fstype in _cifs_table:
+    for fspath, fstype in _get_cifs_table():
         if fname.startswith(fspath):
             return fstype == 'cifs'
     return False
@@ -325,16 +890,7 @@ def copyfile(originalfile, newfile, copy=False, create_new=False,
     fmlogger.debug(newfile)
 
     if create_new:
-        while os.path.exists(newfile):
-            base, fname, ext = split_filename(newfile)
-            s = re.search('_c[0-9]{4,4}$', fname)
-            i = 0
-            if s:
-                i = int(s.group()[2:]) + 1
-                fname = fname[:-6] + "_c%04d" % i
-            else:
-                fname += "_c%04d" % i
-            newfile = base + os.sep + fname + ext
+        newfile = _new_filename(newfile)
 
     if hashmethod is None:
         hashmethod = config.get('execution', 'hash_method').lower()
@@ -380,34 +936,9 @@ def copyfile(originalfile, newfile, copy=False, create_new=False,
 
     # New file
     # --------
-    # use_hardlink & can_hardlink => hardlink
-    # ~hardlink & ~copy & can_symlink => symlink
-    # ~hardlink & ~symlink => copy
-    if not keep and use_hardlink:
-        try:
-            fmlogger.debug('Linking File: %s->%s', newfile, originalfile)
-            # Use realpath to avoid hardlinking symlinks
-            os.link(os.path.realpath(originalfile), newfile)
-        except OSError:
-            use_hardlink = False  # Disable hardlink for associated files
-        else:
-            keep = True
-
-    if not keep and not copy and os.name == 'posix':
-        try:
-            fmlogger.debug('Symlinking File: %s->%s', newfile, originalfile)
-            os.symlink(originalfile, newfile)
-        except OSError:
-            copy = True  # Disable symlink for associated files
-        else:
-            keep = True
-
     if not keep:
-        try:
-            fmlogger.debug('Copying File: %s->%s', newfile, originalfile)
-            shutil.copyfile(originalfile, newfile)
-        except shutil.Error as e:
-            fmlogger.warn(e.message)
+        copy, use_hardlink = _link_or_copy(originalfile, newfile, copy,
+                                           use_hardlink)
 
     # Associated files
     if copy_related_files:
@@ -460,24 +991,68 @@ def copyfiles(filelist, dest, copy=False, create_new=False):
         specifies whether to copy or symlink files
         (default=False) but only for posix systems
 
+    The destination directories are listed once for the whole list, and the
+    links (or copies) of the new files are created without further checks,
+    the existing files being handled as in :func:`copyfile`.
+
     Returns
     -------
     None
 
     """
     outfiles = filename_to_list(dest)
+    hashmethod = config.get('execution', 'hash_method').lower()
+    # the content of the destination directories, listed once instead of
+    # checking for each new file whether it already exists
+    listings = {}
+
+    def exists(fname):
+        dirname, basename = os.path.split(fname)
+        if dirname not in listings:
+            try:
+                listings[dirname] = set(os.listdir(dirname))
+            except OSError:
+                listings[dirname] = None
+        if listings[dirname] is None:
+            return os.path.lexists(fname)
+        return basename in listings[dirname]
+
     newfiles = []
     for i, f in enumerate(filename_to_list(filelist)):
         if isinstance(f, list):
             newfiles.insert(i, copyfiles(f, dest, copy=copy,
                                          create_new=create_new))
+            continue
+        if len(outfiles) > 1:
+            destfile = outfiles[i]
         else:
-            if len(outfiles) > 1:
-                destfile = outfiles[i]
-            else:
-                destfile = fname_presuffix(f, newpath=outfiles[0])
-            destfile = copyfile(f, destfile, copy, create_new=create_new)
-            newfiles.insert(i, destfile)
+            destfile = fname_presuffix(f, newpath=outfiles[0])
+        if create_new:
+            destfile = _new_filename(destfile, exists)
+        related_pairs = [pair for pair in zip(get_related_files(f, False),
+                                              get_related_files(destfile,
+                                                                False))
+                         if pair[0] != f]
+        if exists(destfile) or any(exists(alt_nfile)
+                                   for _, alt_nfile in related_pairs):
+            # compare with the existing files
+            destfile = copyfile(f, destfile, copy, hashmethod=hashmethod)
+            created = [destfile]
+        else:
+            # Don't try creating symlinks on CIFS
+            file_copy, use_hardlink = _link_or_copy(
+                f, destfile, copy or on_cifs(destfile))
+            created = [destfile]
+            for alt_ofile, alt_nfile in related_pairs:
+                if os.path.exists(alt_ofile):
+                    _link_or_copy(alt_ofile, alt_nfile, file_copy,
+                                  use_hardlink)
+                    created.append(alt_nfile)
+        for fname in created:
+            dirname, basename = os.path.split(fname)
+            if listings.get(dirname) is not None:
+                listings[dirname].add(basename)
+        newfiles.insert(i, destfile)
     return newfiles
 
 
@@ -516,7 +1091,7 @@ def check_depends(targets, dependencies):
         max(list(map(os.path.getmtime, deps)) + [0])
 
 
-def save_json(filename, data):
+def save_json(filename, data, stream=False):
     """Save data to a json file
 
     Parameters
@@ -525,13 +1100,75 @@ def save_json(filename, data):
         Filename to save data in.
     data : dict
         Dictionary to save in json file.
+    stream : bool
+        Encode the data with :func:`iter_json`, which consumes generators
+        one item at a time instead of requiring the data to be built in
+        memory.
 
     """
     mode = 'w'
     if sys.version_info[0] < 3:
         mode = 'wb'
     with open(filename, mode) as fp:
-        json.dump(data, fp, sort_keys=True, indent=4)
+        if stream:
+            for chunk in iter_json(data):
+                fp.write(chunk)
+        else:
+            json.dump(data, fp, sort_keys=True, indent=4)
+
+
+def _json_key(key):
+    """The string encoding a dict key in json, e.g. ``'1'`` for ``1`` or
+    ``'null'`` for ``None``"""
+    if isinstance(key, bytes):
+        return key.decode('utf-8')
+    if isinstance(key, str):
+        return key
+    if key is None or isinstance(key, (bool, int, float)):
+        return json.dumps(key)
+    raise TypeError('keys must be str, int, float, bool or None, not %s' %
+                    type(key).__name__)
+
+
+def iter_json(data, indent=4, _level=0):
+    """Yields the json encoding of data in chunks, as written by
+    ``json.dump(data, fp, sort_keys=True, indent=indent)``
+
+    Generators are encoded as lists, and are consumed one item at a time.
+
+    >>> print(''.join(iter_json({'b': (i for i in range(2)), 'a': []},
+    ...                         indent=1)))
+    {
+     "a": [],
+     "b": [
+      0,
+      1
+     ]
+    }
+    """
+    if isinstance(data, dict):
+        # sorted by their encoding, as json does
+        keys = sorted(((_json_key(key), key) for key in data),
+                      key=lambda item: item[0])
+        members = ((json.dumps(name) + ': ', data[key]) for name, key in keys)
+        opening, closing = '{', '}'
+    elif isinstance(data, (list, tuple, GeneratorType)):
+        members = (('', item) for item in data)
+        opening, closing = '[', ']'
+    else:
+        yield json.dumps(data)
+        return
+    separator = opening
+    inner = '\n' + ' ' * (indent * (_level + 1))
+    for prefix, value in members:
+        yield separator + inner + prefix
+        separator = ','
+        for chunk in iter_json(value, indent, _level + 1):
+            yield chunk
+    if separator == opening:
+        yield opening + closing
+    else:
+        yield '\n' + ' ' * (indent * _level) + closing
 
 
 def load_json(filename):
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Lazy loading of the attributes of a package
+
+The packages of nipype expose a few names of their submodules, e.g.
+``nipype.Workflow``. Importing these submodules only when such a name is
+first accessed keeps ``import nipype`` cheap for the processes that never
+need them, e.g. the jobs of the batch system plugins.
+"""
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+from importlib import import_module
+import sys
+from types import ModuleType
+
+
+class LazyModule(ModuleType):
+    """A module importing its ``_lazy_attributes`` on first access"""
+
+    def __getattr__(self, name):
+        lazy = self.__dict__.get('_lazy_attributes', {})
+        if name not in lazy:
+            raise AttributeError("module '%s' has no attribute '%s'" %
+                                 (self.__name__, name))
+        value = _load(self.__name__, name, lazy[name])
+        setattr(self, name, value)
+        return value
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) |
+                      set(self.__dict__.get('_lazy_attributes', {})))
+
+
+def _load(module_name, name, source):
+    module = import_module(source, module_name)
+    if source.lstrip('.') == name:
+        # a submodule
+        return module
+    return getattr(module, name)
+
+
+def lazy_attributes(module_name, attributes):
+    """Load the attributes of a module on first access
+
+    Parameters
+    ----------
+    module_name : str
+        the name of the module, usually ``__name__``
+    attributes : dict
+        the (relative) module providing each attribute. An attribute named
+        after its module, e.g. ``{'pipeline': '.pipeline'}``, is the module
+        itself.
+    """
+    module = sys.modules[module_name]
+    module._lazy_attributes = dict(attributes)
+    try:
+        module.__class__ = LazyModule
+    except TypeError:  # Python 2 modules cannot change their class
+        for name, source in list(attributes.items()):
+            setattr(module, name, _load(module_name, name, source))
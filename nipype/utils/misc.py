@@ -18,17 +18,52 @@ from distutils.version import LooseVersion
 from textwrap import dedent
 import numpy as np
 
-def human_order_sorted(l):
-    """Sorts string in human order (i.e. 'stat10' will go after 'stat2')"""
-    def atoi(text):
-        return int(text) if text.isdigit() else text
+_digits = re.compile(r'(\d+)')
+
+# {text: natural sort key}, shared by all the sorts of a process
+_natural_keys = {}
+_natural_keys_maxsize = 100000
+
+
+def natural_sort_key(text):
+    """The key sorting strings in human order (i.e. 'stat10' after 'stat2')
+
+    Keys are memoized, so that sorting the same strings again (e.g. the
+    matches of a grabber, for each of its outputs) does not split them again.
+
+    >>> natural_sort_key('stat10.nii')
+    ('stat', 10, '.nii')
+    """
+    try:
+        return _natural_keys[text]
+    except KeyError:
+        pass
+    key = tuple(int(c) if c.isdigit() else c for c in _digits.split(text))
+    if len(_natural_keys) >= _natural_keys_maxsize:
+        _natural_keys.clear()
+    _natural_keys[text] = key
+    return key
+
+
+def human_order_argsort(l):
+    """The indices sorting strings, or tuples by their first item, in human
+    order (i.e. 'stat10' will go after 'stat2')
+
+    The same order can then be applied to lists running along ``l``.
+
+    >>> human_order_argsort(['stat10', 'stat2', 'stat1'])
+    [2, 1, 0]
+    """
+    keys = [natural_sort_key(text[0] if isinstance(text, tuple) else text)
+            for text in l]
+    return sorted(range(len(keys)), key=keys.__getitem__)
 
-    def natural_keys(text):
-        if isinstance(text, tuple):
-            text = text[0]
-        return [atoi(c) for c in re.split('(\d+)', text)]
 
-    return sorted(l, key=natural_keys)
+def human_order_sorted(l):
+    """Sorts string in human order (i.e. 'stat10' will go after 'stat2')"""
+    # any iterable, e.g. a set or a generator
+    l = list(l)
+    return [l[i] for i in human_order_argsort(l)]
 
 
 def trim(docstring, marker=None):
@@ -13,7 +13,7 @@ try:
 except ImportError as exc:
     psutil = None
 
-from builtins import open, range
+from builtins import open, range, str, bytes
 from .. import config, logging
 
 proflogger = logging.getLogger('utils')
@@ -148,6 +148,112 @@ def log_nodes_cb(node, status):
     logging.getLogger('callback').debug(json.dumps(status_dict))
 
 
+class ResourceStats(object):
+    """
+    A persistent store of the runtime, memory and threads observed for
+    each interface, used to estimate the resources of future jobs
+
+    Observations are kept in a SQLite database and keyed by the interface
+    class and a bucket of the total size of the input files of the node
+    (powers of two, in bytes).
+
+    >>> stats = ResourceStats(':memory:')
+    >>> stats.record('nipype.interfaces.fsl.BET', 20, duration=10.,
+    ...              mem_gb=1.0, n_threads=1.)
+    >>> stats.record('nipype.interfaces.fsl.BET', 20, duration=12.,
+    ...              mem_gb=1.5)
+    >>> est = stats.estimate('nipype.interfaces.fsl.BET', 20)
+    >>> est['duration'], est['mem_gb'], est['n_threads'], est['count']
+    (11.0, 1.5, 1.0, 2)
+    >>> stats.estimate('nipype.interfaces.fsl.BET', 30)['count']
+    2
+    >>> stats.estimate('nipype.interfaces.fsl.FAST', 20) is None
+    True
+
+    """
+
+    def __init__(self, filename):
+        import sqlite3
+        self._filename = filename
+        self._db = sqlite3.connect(filename, timeout=30)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS observations ('
+            'interface TEXT, bucket INTEGER, duration REAL, mem_gb REAL, '
+            'n_threads REAL, recorded REAL)')
+        self._db.execute(
+            'CREATE INDEX IF NOT EXISTS observations_key '
+            'ON observations (interface, bucket)')
+        self._db.commit()
+        self._cache = {}
+
+    @property
+    def filename(self):
+        return self._filename
+
+    def record(self, interface, bucket, duration, mem_gb=None,
+               n_threads=None):
+        """Store one observation"""
+        with self._db:
+            self._db.execute(
+                'INSERT INTO observations VALUES (?, ?, ?, ?, ?, ?)',
+                (interface, bucket, duration, mem_gb, n_threads, time()))
+        self._cache.pop((interface, bucket), None)
+        self._cache.pop((interface, None), None)
+
+    def estimate(self, interface, bucket=None):
+        """
+        Return the mean duration (s), the peak memory (GB), the peak number
+        of threads and the number of observations for an interface.
+
+        If there are no observations for the bucket, the observations
+        of all buckets are used. Returns ``None`` if the interface was never
+        observed.
+        """
+        key = (interface, bucket)
+        if key not in self._cache:
+            query = ('SELECT AVG(duration), MAX(mem_gb), MAX(n_threads), '
+                     'COUNT(*) FROM observations WHERE interface = ?')
+            args = (interface,)
+            if bucket is not None:
+                query += ' AND bucket = ?'
+                args += (bucket,)
+            row = self._db.execute(query, args).fetchone()
+            self._cache[key] = None if not row[3] else dict(
+                zip(('duration', 'mem_gb', 'n_threads', 'count'), row))
+        if self._cache[key] is None and bucket is not None:
+            return self.estimate(interface)
+        return self._cache[key]
+
+    def close(self):
+        self._db.close()
+
+
+def interface_key(node):
+    """Key identifying the interface of a node in :class:`ResourceStats`"""
+    interface = node.interface.__class__
+    return '%s.%s' % (interface.__module__, interface.__name__)
+
+
+def input_size_bucket(node):
+    """
+    Bucket of the total size of the existing input files of a node:
+    the base-2 logarithm of the size in bytes (0 if there are no files)
+    """
+    import os
+    from math import log
+
+    def _sizes(value):
+        if isinstance(value, (list, tuple)):
+            for item in value:
+                for size in _sizes(item):
+                    yield size
+        elif isinstance(value, (str, bytes)) and os.path.isfile(value):
+            yield os.path.getsize(value)
+
+    total = sum(_sizes(list(node.inputs.get().values())))
+    return int(log(total, 2)) if total > 1 else 0
+
+
 # Get total system RAM
 def get_system_total_memory_gb():
     """
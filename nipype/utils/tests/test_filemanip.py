@@ -4,10 +4,16 @@
 from __future__ import unicode_literals
 from builtins import open
 
+import errno
+import glob
+import hashlib
 import os
+import shutil
 import time
 import warnings
+from tempfile import mkdtemp
 
+import mock
 import pytest
 from ...testing import TempFATFS
 from ...utils.filemanip import (save_json, load_json,
@@ -17,7 +23,11 @@ from ...utils.filemanip import (save_json, load_json,
                                 copyfile, copyfiles,
                                 filename_to_list, list_to_filename,
                                 check_depends,
-                                split_filename, get_related_files)
+                                split_filename, get_related_files,
+                                hash_infile, get_hash_algorithm,
+                                FileHashCache)
+from ...utils import filemanip
+from ... import config
 
 import numpy as np
 
@@ -131,6 +141,96 @@ def test_copyfiles(_temp_analyze_files, _temp_analyze_files_prime):
     assert os.path.exists(new_hdr2)
 
 
+def test_copyfiles_batch(tmpdir, monkeypatch):
+    src = tmpdir.mkdir('src')
+    dest = tmpdir.mkdir('dest')
+    for name in ('a.img', 'a.hdr', 'b.nii', 'c.txt'):
+        src.join(name).write(name)
+    dest.join('c.txt').write('other')
+    infiles = [src.join(name).strpath for name in ('a.img', 'b.nii', 'c.txt')]
+    listdir = mock.Mock(wraps=os.listdir)
+    monkeypatch.setattr(os, 'listdir', listdir)
+    newfiles = copyfiles(infiles, [dest.strpath], create_new=True)
+    # a single listing of the destination
+    assert listdir.call_count == 1
+    assert newfiles == [dest.join(name).strpath
+                        for name in ('a.img', 'b.nii', 'c_c0000.txt')]
+    assert sorted(dest.listdir()) == sorted(
+        dest.join(name) for name in ('a.img', 'a.hdr', 'b.nii', 'c.txt',
+                                     'c_c0000.txt'))
+    assert dest.join('a.hdr').read() == 'a.hdr'
+    assert dest.join('c.txt').read() == 'other'
+    if os.name == 'posix':
+        assert dest.join('a.hdr').islink()
+    newfiles = copyfiles(infiles[:2], [dest.strpath])
+    # the existing links are kept
+    assert newfiles == [dest.join('a.img').strpath, dest.join('b.nii').strpath]
+
+
+MOUNTINFO = """\
+22 1 8:1 / / rw,relatime shared:1 - ext4 /dev/sda1 rw
+25 22 0:21 / /proc rw,nosuid - proc proc rw
+40 22 0:35 / /mnt/my\\040share rw,relatime shared:9 - cifs //host/share rw
+41 22 0:36 / /data rw,relatime shared:10 master:2 - btrfs /dev/sdb rw
+"""
+
+
+def test_parse_mountinfo():
+    assert filemanip._parse_mountinfo(MOUNTINFO) == [
+        ('/', 'ext4'), ('/proc', 'proc'), ('/mnt/my share', 'cifs'),
+        ('/data', 'btrfs')]
+
+
+def test_fs_capabilities(tmpdir, monkeypatch):
+    monkeypatch.setattr(filemanip, '_fs_capabilities', {})
+    link = mock.Mock(side_effect=OSError(errno.EXDEV, 'cross-device'))
+    monkeypatch.setattr(os, 'link', link)
+    for name in ('a', 'b', 'c'):
+        tmpdir.join(name).write(name)
+        filemanip._link_or_copy(tmpdir.join(name).strpath,
+                                tmpdir.join(name + '_new').strpath,
+                                copy=True, use_hardlink=True)
+        assert tmpdir.join(name + '_new').read() == name
+    # the unsupported hard links were tried once
+    assert link.call_count == 1
+    device = os.stat(tmpdir.strpath).st_dev
+    assert filemanip._fs_capabilities[('hardlink', device, device)] is False
+
+    # failures specific to a file are not remembered
+    for error in (errno.EPERM, errno.EINVAL):
+        link.side_effect = OSError(error, 'failed')
+        filemanip._fs_capabilities.clear()
+        for name in ('a', 'b'):
+            filemanip._link_or_copy(tmpdir.join(name).strpath,
+                                    tmpdir.join(name + '_%d' % error).strpath,
+                                    copy=True, use_hardlink=True)
+        assert ('hardlink', device, device) not in filemanip._fs_capabilities
+    assert link.call_count == 5
+
+
+def test_fs_capabilities_symlinked_source(tmpdir, monkeypatch):
+    if not os.path.isdir('/dev/shm') or \
+            os.stat('/dev/shm').st_dev == os.stat(tmpdir.strpath).st_dev:
+        pytest.skip('no other filesystem in /dev/shm')
+    monkeypatch.setattr(filemanip, '_fs_capabilities', {})
+    shm = mkdtemp(dir='/dev/shm')
+    try:
+        # a source reached through a symbolic link to another filesystem
+        with open(os.path.join(shm, 'a.txt'), 'w') as fp:
+            fp.write('a')
+        os.symlink(shm, tmpdir.join('shmlink').strpath)
+        copyfile(tmpdir.join('shmlink', 'a.txt').strpath,
+                 tmpdir.join('a.txt').strpath, copy=True, use_hardlink=True)
+        assert os.stat(tmpdir.join('a.txt').strpath).st_nlink == 1
+    finally:
+        shutil.rmtree(shm)
+    # does not prevent the hard links within the filesystem
+    tmpdir.join('b.txt').write('b')
+    copyfile(tmpdir.join('b.txt').strpath, tmpdir.join('c.txt').strpath,
+             copy=True, use_hardlink=True)
+    assert os.stat(tmpdir.join('c.txt').strpath).st_nlink == 2
+
+
 def test_linkchain(_temp_analyze_files):
     if os.name is not 'posix':
         return
@@ -315,6 +415,27 @@ def test_json(tmpdir):
     assert sorted(adict.items()) == sorted(new_dict.items())
 
 
+def test_json_stream(tmpdir):
+    data = {'nodes': [dict(name='a', group=1, value=1.5),
+                      dict(name='b', group=1, value=None)],
+            'links': [], 'groups': {'empty': {}, 'list': [[1, 2], 'x']},
+            'maxN': 2}
+    expected = tmpdir.join('expected.json').strpath
+    save_json(expected, data)
+    streamed = tmpdir.join('streamed.json').strpath
+    # generators are written as lists
+    save_json(streamed, dict(data, nodes=(node for node in data['nodes'])),
+              stream=True)
+    assert open(streamed).read() == open(expected).read()
+    assert load_json(streamed) == data
+
+    # the keys which are not strings are encoded as json does
+    data = {2: 'a', 10: 'b', 1.5: 'c', True: 'd', None: 'e', 'x': {3: []}}
+    save_json(expected, data)
+    save_json(streamed, data, stream=True)
+    assert open(streamed).read() == open(expected).read()
+
+
 @pytest.mark.parametrize("file, length, expected_files", [
         ('/path/test.img',  3, ['/path/test.hdr', '/path/test.img', '/path/test.mat']),
         ('/path/test.hdr',  3, ['/path/test.hdr', '/path/test.img', '/path/test.mat']),
@@ -331,6 +452,143 @@ def test_related_files(file, length, expected_files):
         assert ef in related_files
 
 
+@pytest.fixture()
+def hash_cache_config():
+    """Restore the hash cache configuration after a test"""
+    saved = dict((option, config.get('execution', option))
+                 for option in ('hash_cache_size', 'hash_cache_file'))
+    yield
+    for option, value in saved.items():
+        config.set('execution', option, value)
+    filemanip._hash_cache = None
+
+
+def test_hash_infile_cache(tmpdir, hash_cache_config):
+    afile = tmpdir.join('file.txt')
+    afile.write('x' * 100)
+    config.set('execution', 'hash_cache_size', '0')
+    expected = hash_infile(afile.strpath)
+    assert filemanip.get_hash_cache() is None
+
+    config.set('execution', 'hash_cache_size', '10')
+    cache = filemanip.get_hash_cache()
+    # files modified just now are not remembered
+    assert hash_infile(afile.strpath) == expected
+    assert list(cache._memo.values()) == []
+    os.utime(afile.strpath, (0, 12345))
+    assert hash_infile(afile.strpath) == expected
+    assert list(cache._memo.values()) == [expected]
+    # cached hashes are returned without reading the file
+    key = list(cache._memo)[0]
+    cache._memo[key] = 'cached'
+    assert hash_infile(afile.strpath) == 'cached'
+    # other algorithms are cached separately
+    assert hash_infile(afile.strpath, crypto=get_hash_algorithm('sha1')) \
+        != 'cached'
+
+    # modified files are hashed again
+    afile.write('y' * 100)
+    os.utime(afile.strpath, (0, 23456))
+    assert hash_infile(afile.strpath) not in ('cached', expected)
+    config.set('execution', 'hash_cache_size', '0')
+    assert hash_infile(afile.strpath) != expected
+
+
+def test_hash_cache_lru():
+    cache = FileHashCache(maxsize=2)
+    cache.set(('md5', 0, 0, 0, 1), 'a')
+    cache.set(('md5', 0, 0, 0, 2), 'b')
+    assert cache.get(('md5', 0, 0, 0, 1)) == 'a'
+    cache.set(('md5', 0, 0, 0, 3), 'c')
+    # the least recently used entry is evicted
+    assert cache.get(('md5', 0, 0, 0, 2)) is None
+    assert cache.get(('md5', 0, 0, 0, 1)) == 'a'
+    assert cache.get(('md5', 0, 0, 0, 3)) == 'c'
+
+
+def test_hash_cache_file(tmpdir):
+    filename = tmpdir.join('hashes.sqlite').strpath
+    cache = FileHashCache(maxsize=2, filename=filename)
+    cache.set(('md5', 1, 2, 3, 4), 'abc')
+    # shared with other processes
+    other = FileHashCache(maxsize=2, filename=filename)
+    assert other.get(('md5', 1, 2, 3, 4)) == 'abc'
+    assert other.get(('sha1', 1, 2, 3, 4)) is None
+
+
+@pytest.mark.parametrize('algorithm', ['md5', 'sha1', 'blake2b'])
+def test_hash_algorithms(tmpdir, hash_cache_config, algorithm):
+    if algorithm == 'blake2b' and not hasattr(hashlib, 'blake2b'):
+        pytest.skip('blake2b not available')
+    config.set('execution', 'hash_cache_size', '0')
+    afile = tmpdir.join('file.txt')
+    afile.write('x' * 3000000)
+    crypto = get_hash_algorithm(algorithm)
+    expected = crypto(b'x' * 3000000).hexdigest()
+    # the buffer size does not change the hash
+    assert hash_infile(afile.strpath, crypto=crypto) == expected
+    assert hash_infile(afile.strpath, chunk_len=1000, crypto=crypto) == \
+        expected
+    if algorithm != 'sha1':
+        assert len(expected) == 32
+    with pytest.raises(ValueError):
+        get_hash_algorithm('crc')
+
+
+@pytest.fixture()
+def _directory_tree(tmpdir):
+    for name in ('sub-01/anat/T1w.nii.gz', 'sub-01/func/bold.nii.gz',
+                 'sub-02/anat/T1w.nii.gz', 'sub-02/.hidden', '.git/HEAD',
+                 'README'):
+        tmpdir.join(name).ensure()
+    if os.name == 'posix':
+        tmpdir.join('sub-03').mksymlinkto(tmpdir.join('sub-01'))
+        tmpdir.join('sub-02', 'link.nii.gz').mksymlinkto('missing')
+    return tmpdir
+
+
+@pytest.mark.parametrize('pattern', [
+    '*', '.*', '*/', 'sub-*/anat/*.nii.gz', 'sub-0[12]/*', 'sub-*/*/',
+    'sub-02/*', 'sub-02/.*', 'sub-01/anat/T1w.nii.gz', 'sub-01/anat/',
+    'sub-02/link.nii.gz', 'sub-04/*', 'README/*', '*/../README',
+    'sub-01/anat/T1w.nii.gz/'])
+def test_directory_index_glob(_directory_tree, pattern):
+    index = filemanip.DirectoryIndex(granularity=0)
+    for pathname in (_directory_tree.join(pattern).strpath, pattern):
+        with _directory_tree.as_cwd():
+            assert index.glob(pathname) == glob.glob(pathname)
+            # answered from the remembered listings
+            assert index.glob(pathname) == glob.glob(pathname)
+
+
+def test_directory_index_walk(_directory_tree, monkeypatch):
+    index = filemanip.DirectoryIndex(granularity=0)
+    top = _directory_tree.strpath
+    assert list(index.walk(top)) == list(os.walk(top))
+    if filemanip.scandir is None:
+        pytest.skip('scandir is not available')
+    scandir = mock.Mock(wraps=filemanip.scandir)
+    monkeypatch.setattr(filemanip, 'scandir', scandir)
+    assert list(index.walk(top)) == list(os.walk(top))
+    assert scandir.call_count == 0
+    # listed again when modified
+    _directory_tree.join('sub-01', 'anat', 'T2w.nii.gz').ensure()
+    os.utime(_directory_tree.join('sub-01', 'anat').strpath, (0, 0))
+    assert list(index.walk(top)) == list(os.walk(top))
+    assert scandir.call_count == 1
+
+
+def test_directory_index_granularity(tmpdir):
+    index = filemanip.DirectoryIndex()
+    tmpdir.join('a').ensure()
+    # just modified, so the modification time cannot be trusted yet
+    assert index.glob(tmpdir.join('*').strpath) == [tmpdir.join('a').strpath]
+    assert index._listings == {}
+    os.utime(tmpdir.strpath, (0, 0))
+    index.glob(tmpdir.join('*').strpath)
+    assert list(index._listings) == [tmpdir.strpath]
+
+
 def test_cifs_check():
     assert isinstance(_cifs_table, list)
     assert isinstance(on_cifs('/'), bool)
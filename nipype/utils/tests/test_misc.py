@@ -4,12 +4,16 @@
 from future import standard_library
 standard_library.install_aliases()
 
-from builtins import next
+from builtins import next, range
+
+import random
+import re
 
 import pytest
 
 from nipype.utils.misc import (container_to_string, str2bool,
-                               flatten, unflatten)
+                               flatten, unflatten, human_order_sorted,
+                               human_order_argsort)
 
 
 def test_cont_to_str():
@@ -60,3 +64,30 @@ def test_flatten():
 
     back = unflatten([], [])
     assert back == []
+
+
+def test_human_order_sorted():
+    def natural_keys(text):
+        # the key of the original implementation
+        if isinstance(text, tuple):
+            text = text[0]
+        return [int(c) if c.isdigit() else c for c in re.split(r'(\d+)', text)]
+
+    rng = random.Random(0)
+    paths = [''.join(rng.choice('ab0123456789_/.') for _ in range(rng.randint(0, 12)))
+             for _ in range(2000)]
+    expected = sorted(paths, key=natural_keys)
+    assert human_order_sorted(paths) == expected
+    # twice, with the memoized keys
+    assert human_order_sorted(paths) == expected
+    assert human_order_sorted(['stat10', 'stat2', 'stat1']) == \
+        ['stat1', 'stat2', 'stat10']
+    unique = set(paths)
+    assert human_order_sorted(unique) == sorted(unique, key=natural_keys)
+    assert human_order_sorted(path for path in paths) == expected
+    # tuples are sorted by their first item, and ties keep their order
+    pairs = list(zip(paths, range(len(paths))))
+    assert human_order_sorted(pairs) == sorted(pairs, key=natural_keys)
+    order = human_order_argsort(paths)
+    assert [paths[i] for i in order] == expected
+    assert human_order_argsort([]) == []
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+from __future__ import division
+
+from nipype.interfaces import utility as niu
+from nipype.pipeline import engine as pe
+from nipype.utils.profiler import (ResourceStats, interface_key,
+                                   input_size_bucket)
+
+
+def test_resource_stats_persistent(tmpdir):
+    filename = tmpdir.join('stats.sqlite').strpath
+    stats = ResourceStats(filename)
+    stats.record('a.A', 3, duration=2.)
+    assert stats.estimate('a.A', 3)['duration'] == 2.
+    stats.record('a.A', 3, duration=4., mem_gb=2., n_threads=3.)
+    stats.record('a.A', 10, duration=100.)
+    stats.close()
+
+    stats = ResourceStats(filename)
+    assert stats.estimate('a.A', 3) == dict(duration=3., mem_gb=2.,
+                                            n_threads=3., count=2)
+    assert stats.estimate('a.A', 10)['duration'] == 100.
+    # unknown buckets fall back to all the observations of the interface
+    assert stats.estimate('a.A', 5)['count'] == 3
+    assert stats.estimate('b.B', 3) is None
+    stats.close()
+
+
+def test_input_size_bucket(tmpdir):
+    node = pe.Node(niu.IdentityInterface(fields=['a', 'b', 'c']), name='node')
+    assert interface_key(node) == \
+        'nipype.interfaces.utility.base.IdentityInterface'
+    assert input_size_bucket(node) == 0
+
+    small, large = tmpdir.join('small'), tmpdir.join('large')
+    small.write('x' * 1000)
+    large.write('x' * 3000)
+    node.inputs.a = small.strpath
+    assert input_size_bucket(node) == 9
+    node.inputs.b = [large.strpath, 'not a file']
+    node.inputs.c = 12
+    assert input_size_bucket(node) == 11